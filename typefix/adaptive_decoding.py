@@ -0,0 +1,64 @@
+from __init__ import logger
+
+
+
+class AdaptiveDecoding(object):
+    # Decodes a prompt one max_length at a time, as model.generate(max_length = i, num_beams = n, num_return_sequences = n) does, starting with a small beam.
+    # The beam is widened after every step that yields new distinct valid patches, and decoding stops once saturation steps in a row
+    # yield none or the compute budget of the prompt is used up.
+    def __init__(self, start_beams = 10, max_beams = 50, growth = 2, saturation = 2, max_tokens = None):
+        # start_beams, max_beams - beam widths of the first step and the widest step
+        # growth - factor applied to the beam width after a step with new patches
+        # saturation - number of steps in a row without new patches after which decoding stops
+        # max_tokens - compute budget of a prompt, counted as beam width times max_length summed over steps, None means unlimited
+        self.start_beams = start_beams
+        self.max_beams = max_beams
+        self.growth = growth
+        self.saturation = saturation
+        self.max_tokens = max_tokens
+
+    def settings(self):
+        return {
+            "start_beams": self.start_beams,
+            "max_beams": self.max_beams,
+            "growth": self.growth,
+            "saturation": self.saturation,
+            "max_tokens": self.max_tokens
+        }
+
+    def decode(self, backend, prompt, validate):
+        # validate - maps a list of raw predictions to the masked code of the valid ones
+        # Return the raw predictions in the order they are first generated and the log of all steps
+        predictions = {}
+        patches = {}
+        steps = []
+        beams = min(self.start_beams, self.max_beams)
+        idle = 0
+        used = 0
+        stop = "max_len"
+        for i in range(prompt["min_len"], prompt["max_len"]):
+            if self.max_tokens != None and used + beams * i > self.max_tokens:
+                stop = "budget"
+                break
+            new_predictions = []
+            for p in backend.decode_length(prompt, i, beams):
+                if p not in predictions:
+                    predictions[p] = True
+                    new_predictions.append(p)
+            used += beams * i
+            new_patches = 0
+            for c in validate(new_predictions):
+                if c not in patches:
+                    patches[c] = True
+                    new_patches += 1
+            steps.append({"max_length": i, "num_beams": beams, "new_predictions": len(new_predictions), "new_patches": new_patches})
+            logger.debug('Decoded max_length {} with {} beams: {} new predictions, {} new patches.'.format(i, beams, len(new_predictions), new_patches))
+            if new_patches > 0:
+                idle = 0
+                beams = min(beams * self.growth, self.max_beams)
+            else:
+                idle += 1
+                if idle >= self.saturation:
+                    stop = "saturated"
+                    break
+        return list(predictions.keys()), {"steps": steps, "stop": stop, "tokens": used, "patches": len(patches)}
@@ -2,6 +2,8 @@ import json
 import os
 import ast
 import re
+import hashlib
+from collections import ChainMap
 from copy import deepcopy
 from graphviz import Digraph
 from tqdm import tqdm
@@ -9,6 +11,7 @@ from __init__ import logger, stmt_types, expr_types, elem_types, op2cat, stdtype
 from change_tree import ChangeNode, ChangeTree, ChangePair
 from fix_template import FixTemplate, TemplateTree, Context, TemplateNode
 from difflib import Differ
+import work_budget
 
 
 
@@ -214,6 +217,77 @@ class ASTDiffer(object):
             return False
         
 
+class ASTHasher(object):
+    # Canonical hash of ASTs ignoring the same fields as ASTDiffer.compare, trees equal under ASTDiffer.compare always have the same hash.
+    # Each node is hashed from the hashes of its children, so the hash of a tree with one subtree replaced only needs the ancestors of the subtree.
+    IGNORED_FIELDS = ['ctx', 'lineno', 'end_lienno', 'col_offset', 'end_col_offset', 'type_comment']
+
+    @staticmethod
+    def encode_value(value, typed = False):
+        # Values of fields are compared with !=, so numbers equal to each other, e.g., 1 and True, share the same encoding
+        # Values in lists are compared with their types as well
+        if isinstance(value, (bool, int, float, complex)):
+            encoded = ("number", hash(value))
+        elif isinstance(value, (str, bytes)) or value == None:
+            encoded = value
+        else:
+            encoded = (value.__class__.__name__, repr(value))
+        if typed:
+            return (value.__class__.__name__, encoded)
+        return encoded
+
+    @staticmethod
+    def digest(node, digests, overrides = {}):
+        # digests - hashes of the children by id, overrides - encoded fields used instead of the ones of node
+        items = [node.__class__.__name__]
+        for name, value in ast.iter_fields(node):
+            if name in ASTHasher.IGNORED_FIELDS:
+                continue
+            if name in overrides:
+                items.append((name, overrides[name]))
+            elif isinstance(value, list):
+                items.append((name, [digests[id(v)] if isinstance(v, ast.AST) else ASTHasher.encode_value(v, typed = True) for v in value]))
+            elif isinstance(value, ast.AST):
+                items.append((name, digests[id(value)]))
+            else:
+                items.append((name, ASTHasher.encode_value(value)))
+        return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def encode_field(node, name, digests):
+        value = getattr(node, name)
+        if isinstance(value, list):
+            return [digests[id(v)] if isinstance(v, ast.AST) else ASTHasher.encode_value(v, typed = True) for v in value]
+        elif isinstance(value, ast.AST):
+            return digests[id(value)]
+        return ASTHasher.encode_value(value)
+
+    @staticmethod
+    def hash(root, digests = None, overrides = {}):
+        # Return the hash of root, digests is filled with the hashes of all nodes by id if given
+        # overrides - encoded fields used instead of the ones of root
+        if digests == None:
+            digests = {}
+        stack = [(root, False)]
+        while len(stack) > 0:
+            node, visited = stack.pop()
+            if visited:
+                digests[id(node)] = ASTHasher.digest(node, digests, overrides = overrides if node is root else {})
+            elif id(node) not in digests or node is root:
+                stack.append((node, True))
+                for n in ast.iter_child_nodes(node):
+                    stack.append((n, False))
+        return digests[id(root)]
+
+    @staticmethod
+    def rehash(path, digest, digests):
+        # Hash of the tree whose root is path[0] after path[-1] is replaced by a subtree with the given hash
+        # digests - hashes of the nodes of the original tree by id
+        for i in range(len(path) - 2, -1, -1):
+            digest = ASTHasher.digest(path[i], ChainMap({id(path[i + 1]): digest}, digests))
+        return digest
+
+
 class ASTVisitor(ast.NodeVisitor):
     def __init__(self, buglines, remove_import = False):
         self.buglines = buglines
@@ -699,6 +773,7 @@ class ASTNodeGenerator(object):
         return node
 
     def build_ast_node(self, node, parent_ast_node, modify_parent = False):
+        work_budget.charge('node_visits')
         ast_node = None
         if modify_parent:
             parent_ast_node = deepcopy(parent_ast_node)
@@ -907,6 +982,7 @@ class ASTNodeGenerator(object):
         pass
 
     def replace_one(self, root, case, morenodes):
+        work_budget.charge('match_states')
         new_root = deepcopy(root)
         for i, n in enumerate(morenodes):
             if case[i] == 0:
@@ -925,6 +1001,7 @@ class ASTNodeGenerator(object):
                             
 
     def gen_index(self, max_index, extra = True):
+        work_budget.charge('match_states')
         if len(max_index) == 1:
             if extra:
                 return [[i] for i in range(0, max_index[0] + 1)]
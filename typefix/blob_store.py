@@ -0,0 +1,69 @@
+import os
+import ast
+import zlib
+import hashlib
+
+
+
+BLOB_SUFFIX = '.zlib'
+
+
+# Sources and parse results of blobs in this process, keyed by the blob path, blobs never change so they are read and parsed once
+source_cache = {}
+parse_cache = {}
+MAX_SOURCE_CACHE_SIZE = 2000
+MAX_PARSE_CACHE_SIZE = 500
+
+
+class BlobStore(object):
+    # Content-addressed store of file versions, each distinct content is kept once as a zlib compressed file named by its sha1.
+    # Commit metadata refers to a version by its blob path, e.g., file_repo/3f/3f786850e387550fdab836ed7e6dc881de23001b.zlib
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self, key):
+        return os.path.join(self.path, key[:2], key + BLOB_SUFFIX)
+
+    def put(self, content):
+        # Store content (bytes) if it is not stored yet and return its blob path
+        path = self.get_path(hashlib.sha1(content).hexdigest())
+        if not os.path.exists(path):
+            if not os.path.exists(os.path.dirname(path)):
+                os.system('mkdir -p {}'.format(os.path.dirname(path)))
+            # Write to a temporary file first so that concurrent writers and crashes never leave a partial blob
+            with open('{}.{}.tmp'.format(path, os.getpid()), 'wb') as bf:
+                bf.write(zlib.compress(content))
+            os.replace('{}.{}.tmp'.format(path, os.getpid()), path)
+        return path
+
+
+def is_blob(path):
+    return path.endswith(BLOB_SUFFIX)
+
+
+def read_source(path):
+    # Text of a file version, either a blob path or a plain file, newlines are translated as open(path, 'r') does
+    if not is_blob(path):
+        return open(path, 'r', encoding = 'utf-8').read()
+    if path not in source_cache:
+        if len(source_cache) >= MAX_SOURCE_CACHE_SIZE:
+            source_cache.clear()
+        with open(path, 'rb') as bf:
+            source_cache[path] = zlib.decompress(bf.read()).decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    return source_cache[path]
+
+
+def parse_source(path):
+    # AST of a file version, the same tree is returned for every read of a blob, so callers must not change it
+    if not is_blob(path):
+        return ast.parse(read_source(path))
+    if path not in parse_cache:
+        if len(parse_cache) >= MAX_PARSE_CACHE_SIZE:
+            parse_cache.clear()
+        try:
+            parse_cache[path] = ast.parse(read_source(path))
+        except Exception as e:
+            parse_cache[path] = e
+    if isinstance(parse_cache[path], Exception):
+        raise parse_cache[path]
+    return parse_cache[path]
@@ -10,6 +10,7 @@ from evaluate import compare_file
 from ast_operation import ASTDiffer, CommentRemover, ASTTransformer
 from bug_locator import FunctionLocator
 from change_tree import ChangePair
+from blob_store import read_source, parse_source
 from __init__ import logger, stmt_types, expr_types, elem_types, op2cat, stdtypes, builtins, errors, warnings, cat2op, op2code
 from difflib import Differ
 import ast
@@ -608,7 +609,7 @@ def gen_training_set(datafile):
                     beforefile, afterfile = commitinfo[f]['files']
                     try:
                         if beforefile:
-                            beforeroot = ast.parse(open(beforefile, 'r').read())
+                            beforeroot = parse_source(beforefile)
                         else:
                             continue
                     except Exception as e:
@@ -734,7 +735,7 @@ def build_prompt_trainset(template_file, metadata_file):
         files = metadata[data["repo"]][data["commit"]][data["file"]]["files"]
         buggy_file = files[0]
         try:
-            buggy_root = ast.parse(open(buggy_file, "r").read())
+            buggy_root = ast.parse(read_source(buggy_file))
         except:
             logger.debug("Cannot parse buggy file, skipped.")
             continue
@@ -1162,8 +1163,8 @@ def build_prompt_trainset(metadata_file):
                 buggy_file, fix_file = metadata[instance["repo"]][instance["commit"]][instance["file"]]["files"]
                 logger.debug("Handling {}:{}:{}:{}".format(instance["repo"], instance["commit"], instance["file"], instance["loc"]))
                 try:
-                    source = open(fix_file, "r").read()
-                    buggy_source = open(buggy_file, "r").read()
+                    source = read_source(fix_file)
+                    buggy_source = read_source(buggy_file)
                     buggy_sourcelines = buggy_source.splitlines()
                     root = ast.parse(source)
                 except Exception as e:
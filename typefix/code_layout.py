@@ -0,0 +1,213 @@
+import ast
+import io
+import hashlib
+import tokenize
+from __init__ import logger
+
+
+
+SKIPPED_TOKENS = [tokenize.COMMENT, tokenize.NL, tokenize.ENCODING]
+
+
+# Parse results of sources in this process, keyed by the hash of the source
+parse_cache = {}
+MAX_PARSE_CACHE_SIZE = 200000
+
+
+def is_parsable(source):
+    key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    if key not in parse_cache:
+        if len(parse_cache) >= MAX_PARSE_CACHE_SIZE:
+            parse_cache.clear()
+        try:
+            ast.parse(source)
+            parse_cache[key] = True
+        except Exception:
+            parse_cache[key] = False
+    return parse_cache[key]
+
+
+def get_column(indent):
+    return len(indent.expandtabs(8))
+
+
+def get_indent(line):
+    return line[:len(line) - len(line.lstrip())]
+
+
+class CodeLayout(object):
+    # Block structure around masked lines, built from one tokenization of the file with the original masked lines.
+    # It is used to infer the indentation of predicted lines and to parse candidates within the enclosing function only.
+    def __init__(self, pre_code, masked_code, post_code):
+        self.pre_code = pre_code
+        self.masked_code = masked_code
+        self.post_code = post_code
+        self.valid = False
+        # blocks - open blocks before the masked lines as [column, indentation, header row, header keyword], the first one is the module
+        self.blocks = None
+        # opener - whether the last logical line before the masked lines opens a block
+        self.opener = False
+        # post_column - column of the first logical line after the masked lines, None if there is none
+        self.post_column = None
+        # start, end - rows of the enclosing function, None if the masked lines are not within a function
+        self.start = None
+        self.end = None
+        self.header_column = None
+        self.prefix = []
+        try:
+            self.scan()
+        except (tokenize.TokenError, IndentationError, SyntaxError) as e:
+            logger.debug(f'Cannot tokenize the code around masked lines, reason: {e}, use the whole file instead.')
+            self.valid = False
+
+    def scan(self):
+        lines = self.pre_code + self.masked_code + self.post_code
+        try:
+            ast.parse("\n".join(lines))
+        except Exception:
+            return
+        pre_end = len(self.pre_code)
+        post_start = len(self.pre_code) + len(self.masked_code)
+        blocks = [[0, "", None, None]]
+        opener = False
+        pending_header = None
+        logical_start = None
+        logical_starts = []
+        last = None
+        for tok in tokenize.generate_tokens(io.StringIO("\n".join(lines) + "\n").readline):
+            row = tok.start[0] - 1
+            if row >= pre_end and self.blocks == None:
+                # Masked lines must start a new logical line
+                if logical_start != None:
+                    return
+                self.blocks = [list(b) for b in blocks]
+                self.opener = opener
+            if row >= post_start and logical_start != None and logical_start[0] < post_start:
+                return
+            if tok.type == tokenize.INDENT:
+                blocks.append([get_column(tok.string), tok.string, pending_header[0] if pending_header else None, self.get_keyword(pending_header)])
+            elif tok.type == tokenize.DEDENT:
+                blocks.pop()
+            elif tok.type == tokenize.NEWLINE:
+                opener = last != None and last.type == tokenize.OP and last.string == ':'
+                pending_header = logical_start if opener else None
+                logical_start = None
+            elif tok.type in SKIPPED_TOKENS or tok.type == tokenize.ENDMARKER:
+                pass
+            else:
+                if logical_start == None:
+                    logical_start = [row, tok.string, get_column(tok.line[:tok.start[1]])]
+                    logical_starts.append(logical_start)
+                elif len(logical_start) == 3:
+                    # Keep the second token to recognize async functions
+                    logical_start.append(tok.string)
+                last = tok
+        if self.blocks == None:
+            self.blocks = [list(b) for b in blocks]
+            self.opener = opener
+        post_starts = [l for l in logical_starts if l[0] >= post_start]
+        self.post_column = post_starts[0][2] if len(post_starts) > 0 else None
+        for i in range(len(self.blocks) - 1, 0, -1):
+            header = self.blocks[i]
+            if header[3] == 'def':
+                # The original masked lines must stay inside the function, otherwise the code after it may depend on them
+                if len([l for l in logical_starts if l[0] >= pre_end and l[0] < post_start and l[2] <= self.blocks[i - 1][0]]) > 0:
+                    break
+                self.start = header[2]
+                self.header_column = self.blocks[i - 1][0]
+                self.end = len(lines)
+                for l in post_starts:
+                    if l[2] <= self.header_column:
+                        self.end = l[0]
+                        break
+                # Open the outer blocks of the function so that it can be parsed without changing its indentation
+                self.prefix = [b[1] + "if True:" for b in self.blocks[:i - 1]]
+                break
+        self.valid = True
+
+    @staticmethod
+    def get_keyword(logical_start):
+        # Keyword of a block header, async functions are treated as functions
+        if logical_start == None:
+            return None
+        if logical_start[1] == 'async' and len(logical_start) > 3:
+            return logical_start[3] if logical_start[3] == 'def' else 'async'
+        return logical_start[1]
+
+    def check_indent(self, stack, opener, column):
+        # Return the block columns after a logical line at column, None if Python would reject the indentation
+        if opener:
+            if column > stack[-1]:
+                return stack + [column]
+            return None
+        if column > stack[-1]:
+            return None
+        stack = list(stack)
+        while stack[-1] > column:
+            stack.pop()
+        if stack[-1] != column:
+            return None
+        return stack
+
+    @staticmethod
+    def scan_line(line):
+        # "blank" for empty and comment lines, "opener" for lines opening a block, "simple" for the others, None if the line is not a complete logical line
+        if "\n" in line or "\r" in line:
+            return None
+        if len(line.strip()) == 0 or line.strip().startswith("#"):
+            return "blank"
+        try:
+            tokens = [t for t in tokenize.generate_tokens(io.StringIO(line.strip() + "\n").readline) if t.type not in SKIPPED_TOKENS and t.type not in [tokenize.NEWLINE, tokenize.ENDMARKER, tokenize.INDENT, tokenize.DEDENT]]
+        except (tokenize.TokenError, IndentationError, SyntaxError):
+            return None
+        if len(tokens) == 0:
+            return "blank"
+        if tokens[-1].type == tokenize.OP and tokens[-1].string == ':':
+            return "opener"
+        return "simple"
+
+    def infer_layouts(self, lines, levels = 4):
+        # Indent each line with one of the levels so that the indentation is accepted by Python, None if it cannot be inferred
+        if not self.valid:
+            return None
+        kinds = [CodeLayout.scan_line(l) for l in lines]
+        if None in kinds:
+            return None
+        layouts = []
+        def visit(k, stack, opener, layout):
+            if k == len(lines):
+                if self.post_column == None:
+                    if not opener:
+                        layouts.append(layout)
+                elif self.check_indent(stack, opener, self.post_column) != None:
+                    layouts.append(layout)
+                return
+            for i in range(0, levels):
+                line = "    " * i + lines[k]
+                # Lines are joined as Prompt.validate_patch does, a leading empty line is dropped
+                new_layout = layout + "\n" + line if len(layout) != 0 else layout + line
+                if kinds[k] == "blank":
+                    visit(k + 1, stack, opener, new_layout)
+                    continue
+                new_stack = self.check_indent(stack, opener, get_column(get_indent(line)))
+                if new_stack != None:
+                    visit(k + 1, new_stack, kinds[k] == "opener", new_layout)
+        visit(0, [b[0] for b in self.blocks], self.opener, "")
+        return layouts
+
+    def get_source(self, masked_code, whole = False):
+        # Source to parse for a candidate of the masked lines, only the enclosing function if all candidate lines stay inside it
+        # whole - always the whole file, for candidates whose lines may not be complete logical lines
+        if self.valid and self.start != None and not whole:
+            inside = True
+            for line in masked_code.split("\n"):
+                if len(line.strip()) > 0 and get_column(get_indent(line)) <= self.header_column:
+                    inside = False
+                    break
+            if inside:
+                post_end = self.end - len(self.pre_code) - len(self.masked_code)
+                return "\n".join(self.prefix + self.pre_code[self.start:] + [masked_code] + self.post_code[:post_end])
+        return "\n".join(self.pre_code) + "\n" + masked_code + "\n" + "\n".join(self.post_code)
+
+    def is_valid(self, masked_code, whole = False):
+        return is_parsable(self.get_source(masked_code, whole = whole))
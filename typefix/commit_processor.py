@@ -1,9 +1,14 @@
 from git.repo import Repo
 import os
 import json
+import subprocess
+import multiprocessing
+import shutil
+from itertools import groupby
 from tqdm import tqdm
 from copy import deepcopy
 import ast
+from blob_store import BlobStore, parse_source
 from __init__ import logger
 
 
@@ -38,30 +43,25 @@ def fetch_pr_branch(jsonfile, repopath):
 
 
 
-def process_commit(commit):
-    info = {}
+def iter_diff(lines):
+    # Yield the modified python files and hunks of one commit from its diff lines as (file, loc, hunk), loc and hunk are None for the file header
     curfile = None
     curloc = None
     changes = []
-    lines = []
+    lines_info = []
     passdiff = False
-    for line in commit.splitlines():
+    for line in lines:
         if line.startswith('diff --git a/'):
             files = [l[2:] for l in line.replace('diff --git ', '').split()]
             if len(files) != 2:
                 logger.error('Cannot recognize modified files in commit: {}, skipping...'.format(line))
             if curfile != None and curloc != None:
-                if curloc not in info[curfile]:
-                    info[curfile][curloc] = []
-                temp = {}
-                temp["content"] = "\n".join(changes)
-                temp["lines"] = lines
-                info[curfile][curloc].append(temp)
+                yield curfile, curloc, {"content": "\n".join(changes), "lines": lines_info}
             if not files[0].endswith('.py'):
                 curfile = None
                 curloc = None
                 changes = []
-                lines = []
+                lines_info = []
                 continue
             passdiff = True
             curloc = None
@@ -79,19 +79,14 @@ def process_commit(commit):
                     curfile += 'None'
                 else:
                     curfile += f'{item[2:]}'
-                info[curfile] = {}
+                yield curfile, None, None
                 curloc = None
                 passdiff = False
 
 
         elif line.startswith('@@') and curfile:
             if curloc != None:
-                if curloc not in info[curfile]:
-                    info[curfile][curloc] = []
-                temp = {}
-                temp["content"] = "\n".join(changes)
-                temp["lines"] = lines
-                info[curfile][curloc].append(temp)
+                yield curfile, curloc, {"content": "\n".join(changes), "lines": lines_info}
             curloc = line.split('@@')[-1].strip().replace(':', '')
             changes = []
             items = line.split('@@')[1].strip().split()
@@ -102,25 +97,39 @@ def process_commit(commit):
                     prevs.append('1')
                 if len(afters) == 1:
                     afters.append('1')
-                lines = [int(prevs[0]), int(prevs[1]), int(afters[0]), int(afters[1])]
+                lines_info = [int(prevs[0]), int(prevs[1]), int(afters[0]), int(afters[1])]
             else:
                 raise ValueError('Cannot recognize line changes')
         elif curfile != None and curloc != None:
             changes.append(line)
     if curfile != None and curloc != None:
-        if curloc not in info[curfile]:
-            info[curfile][curloc] = []
-        temp = {}
-        temp["content"] = "\n".join(changes)
-        temp["lines"] = lines
-        info[curfile][curloc].append(temp)
-    
+        yield curfile, curloc, {"content": "\n".join(changes), "lines": lines_info}
+
+
+def add_diff_record(info, f, loc, hunk):
+    # A file header starts the file over, as a file diffed twice in a commit keeps its last diff only
+    if loc == None:
+        info[f] = {}
+    else:
+        if loc not in info[f]:
+            info[f][loc] = []
+        info[f][loc].append(hunk)
+
+
+def count_diff(info):
     numloc = 0
     for f in info:
         for l in info[f]:
             numloc += len(info[f][l])
-    
-    return info, len(info), numloc
+    return len(info), numloc
+
+
+def process_commit(commit):
+    info = {}
+    for f, loc, hunk in iter_diff(commit.splitlines()):
+        add_diff_record(info, f, loc, hunk)
+    numfile, numloc = count_diff(info)
+    return info, numfile, numloc
 
 
 def fecth_commits(jsonfile, repopath):
@@ -150,54 +159,128 @@ def fecth_commits(jsonfile, repopath):
         jf.write(json.dumps(commits, sort_keys=True, indent=4, separators=(',', ': ')))
 
 
+def is_commit_header(line):
+    if line.startswith("From "):
+        items = line.split()
+        return len(items) == 7 and len(items[1]) == 40
+    return False
+
+
+def iter_pr_patch(patchfile):
+    # Yield the commits, modified python files and hunks of a patch file as (commit, file, loc, hunk), reading it one line at a time
+    # file, loc and hunk are None for the commit header, loc and hunk are None for the file header
+    # Lines before the first commit header are skipped
+    header = [0, None]
+    def get_commit(line):
+        if is_commit_header(line):
+            header[0] += 1
+            header[1] = line.split()[1]
+        return header[0], header[1]
+    with open(patchfile, "r", encoding = "utf-8") as patch:
+        lines = (line.rstrip('\n') for line in patch)
+        for (index, c), commit_lines in groupby(lines, key = get_commit):
+            if c == None:
+                continue
+            yield c, None, None, None
+            for f, loc, hunk in iter_diff(commit_lines):
+                yield c, f, loc, hunk
+
+
+def add_pr_record(commits, c, f, loc, hunk):
+    if f == None:
+        commits[c] = {"content": {}}
+    else:
+        add_diff_record(commits[c]["content"], f, loc, hunk)
+
+
+def count_pr(commits):
+    for c in commits:
+        commits[c]["modified_files"], commits[c]["modified_locs"] = count_diff(commits[c]["content"])
+
+
 def process_pr_patch(patchfile):
-    patch = open(patchfile, "r", encoding = "utf-8")
     commits = {}
-    buffer = []
-    previous_commit = None
     try:
-        for line in patch.read().splitlines():
-            if line.startswith("From "):
-                items = line.split()
-                if len(items) == 7 and len(items[1]) == 40:
-                    commits[items[1]] = {}
-                    if previous_commit:
-                        commits[previous_commit]["content"] = "\n".join(buffer)
-                        buffer = []
-                    previous_commit = items[1]
-            if previous_commit:
-                buffer.append(line)
+        for c, f, loc, hunk in iter_pr_patch(patchfile):
+            add_pr_record(commits, c, f, loc, hunk)
     except Exception as e:
         logger.error("Error occurred when reading patch files: {}".format(e))
         return {}
-    if previous_commit:
-        commits[previous_commit]["content"] = "\n".join(buffer)
-
-    for c in commits:
-        info, numfile, numloc = process_commit(commits[c]["content"])
-        commits[c]["modified_files"] = numfile
-        commits[c]["modified_locs"] = numloc
-        commits[c]["content"] = info
-
+    count_pr(commits)
     return commits
 
 
+def _fetch_repo_prs(args):
+    # Write the records of all prs of repo r to partfile as they are parsed
+    r, patches, partfile = args
+    with open(partfile, "w", encoding = "utf-8") as pf:
+        pf.write(json.dumps({"repo": r}) + "\n")
+        for p in patches:
+            pf.write(json.dumps({"repo": r, "pr": p}) + "\n")
+            try:
+                for c, f, loc, hunk in iter_pr_patch(patches[p]):
+                    record = {"repo": r, "pr": p, "commit": c}
+                    if f != None:
+                        record["file"] = f
+                    if loc != None:
+                        record["loc"] = loc
+                        record["hunk"] = hunk
+                    pf.write(json.dumps(record) + "\n")
+            except Exception as e:
+                # The records of the pr written so far are dropped by load_pr_contents
+                logger.error("Error occurred when reading patch file {}: {}".format(patches[p], e))
+                pf.write(json.dumps({"repo": r, "pr": p, "error": str(e)}) + "\n")
+    return r
 
 
-def fetch_prs(jsonfile):
+def fetch_prs(jsonfile, workers = None):
+    # Parse the patch files of all prs into a jsonl file of repo, pr, commit, file and hunk records, see load_pr_contents
+    # workers - number of repos handled in parallel, the number of cores if None
     repos = json.loads(open(jsonfile, "r", encoding = "utf-8").read())
-    prs = {}
-    for r in tqdm(repos):
-        prs[r] = {}
-        for p in repos[r]:
-            prs[r][p] = process_pr_patch(repos[r][p]["patch"])
+    contentfile = jsonfile.replace(".json", "_contents_temp.jsonl")
+    partdir = contentfile + ".parts"
+    if not os.path.exists(partdir):
+        os.system('mkdir -p {}'.format(partdir))
+    workers = workers if workers != None else (os.cpu_count() or 1)
+    jobs = [(r, {p: repos[r][p]["patch"] for p in repos[r]}, os.path.join(partdir, '{}.jsonl'.format(i))) for i, r in enumerate(repos)]
+    del repos
+    if workers > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(processes = workers) as pool:
+            for r in tqdm(pool.imap_unordered(_fetch_repo_prs, jobs, chunksize = 1), total = len(jobs)):
+                pass
+    else:
+        for job in tqdm(jobs):
+            _fetch_repo_prs(job)
     
-    with open(jsonfile.replace(".json", "_contents_temp.json"), "w", encoding = "utf-8") as jf:
-        jf.write(json.dumps(prs, sort_keys=True, indent=4, separators=(',', ': ')))
+    with open(contentfile, "w", encoding = "utf-8") as cf:
+        for r, patches, partfile in jobs:
+            with open(partfile, "r", encoding = "utf-8") as pf:
+                shutil.copyfileobj(pf, cf)
+    shutil.rmtree(partdir)
+
+
+def load_pr_contents(contentfile):
+    # Load the contents of prs as repo -> pr -> commit -> {"content", "modified_files", "modified_locs"}, from a jsonl file written by fetch_prs or an old json file
+    if not contentfile.endswith('.jsonl'):
+        return json.loads(open(contentfile, "r", encoding = "utf-8").read())
+    prs = {}
+    for line in open(contentfile, "r", encoding = "utf-8"):
+        record = json.loads(line)
+        r = record["repo"]
+        if "pr" not in record:
+            prs[r] = {}
+        elif "error" in record or "commit" not in record:
+            prs[r][record["pr"]] = {}
+        else:
+            add_pr_record(prs[r][record["pr"]], record["commit"], record.get("file"), record.get("loc"), record.get("hunk"))
+    for r in prs:
+        for p in prs[r]:
+            count_pr(prs[r][p])
+    return prs
 
 
 def filter_multifile_or_automatic_prs(meta_jsonfile, content_jsonfile, threshold = 10):
-    repos = json.loads(open(content_jsonfile, "r", encoding = "utf-8").read())
+    repos = load_pr_contents(content_jsonfile)
     metadata = json.loads(open(meta_jsonfile, "r", encoding = "utf-8").read())
     new_repos = {}
     new_metadata = {}
@@ -228,7 +311,7 @@ def filter_multifile_or_automatic_prs(meta_jsonfile, content_jsonfile, threshold
     with open(meta_jsonfile, "w", encoding = "utf-8") as jf:
         jf.write(json.dumps(new_metadata, sort_keys=True, indent=4, separators=(',', ': ')))
     
-    with open(content_jsonfile, 'w', encoding = 'utf-8') as cf:
+    with open(content_jsonfile.replace('.jsonl', '.json'), 'w', encoding = 'utf-8') as cf:
         cf.write(json.dumps(new_repos, sort_keys=True, indent=4, separators=(',', ': ')))
 
 
@@ -349,34 +432,87 @@ def remove_duplicated_commits(processed_file, base_file):
 
 
 
-def get_modified_files(jsonfile, project_repo, file_repo):
-    repos = json.loads(open(jsonfile, "r", encoding = "utf-8").read())
-    for r in tqdm(repos):
-        for c in repos[r]:
-            for f in repos[r][c]:
+class GitBlobReader(object):
+    # Reads files of any commit from the object database of a repository through one long-lived git cat-file --batch process, without checkouts
+    def __init__(self, path):
+        self.path = path
+        self.process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd = path, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+
+    def read(self, rev, filename):
+        # Content of filename at rev as bytes, None if the file does not exist at rev
+        self.process.stdin.write('{}:{}\n'.format(rev, filename).encode('utf-8'))
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if len(header) == 0:
+            raise ValueError('git cat-file exited in repo {}.'.format(self.path))
+        if header.endswith(b' missing\n') or header.endswith(b' ambiguous\n'):
+            return None
+        items = header.split()
+        content = self.process.stdout.read(int(items[-1]))
+        # Each object is followed by a newline
+        self.process.stdout.read(1)
+        if items[-2] != b'blob':
+            return None
+        return content
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def extract_modified_files(r, commits, project_repo, file_repo):
+    # Store the BEFORE and AFTER files of all commits of repo r in the blob store at file_repo, BEFORE files are read from the first parent of the commit
+    # The files of each modified file in the metadata are the blob paths of its BEFORE and AFTER versions
+    reader = GitBlobReader(os.path.join(project_repo, r))
+    store = BlobStore(file_repo)
+    try:
+        for c in commits:
+            for f in commits[c]:
                 if f == 'pr_branch':
                     continue
                 try:
                     files = f.split('@@@@@@')
                     before_file = files[0] if files[0] != 'None' else None
                     after_file = files[1]if files[1] != 'None' else None
-                    source_path = os.path.join(project_repo, r)
-                    repo = Repo(source_path)
-                    repo.git.checkout(repos[r][c]['pr_branch'])
-                    head = repo.commit('HEAD')
-                    os.system('mkdir -p {}'.format(os.path.join(file_repo, r, c)))
-                    before_filepath = os.path.join(file_repo, r, c, 'BEFORE_' + before_file.replace('/', '@')) if before_file else None
-                    after_filepath = os.path.join(file_repo, r, c, 'AFTER_' + after_file.replace('/', '@')) if after_file else None
-                    repo.git.reset('--hard', c)
-                    if after_filepath:
-                        os.system('cp {} {}'.format(os.path.join(source_path, after_file), after_filepath))
-                    repo.git.reset('--hard', 'HEAD~1')
-                    if before_filepath:
-                        os.system('cp {} {}'.format(os.path.join(source_path, before_file), before_filepath))
-                    repo.git.reset('--hard', head)
-                    repos[r][c][f]["files"] = [before_filepath, after_filepath]
+                    blobs = []
+                    for rev, filename in [(f'{c}~1', before_file), (c, after_file)]:
+                        if filename == None:
+                            blobs.append(None)
+                            continue
+                        content = reader.read(rev, filename)
+                        if content == None:
+                            raise ValueError('Cannot find {} at {}.'.format(filename, rev))
+                        blobs.append(store.put(content))
+                    commits[c][f]["files"] = blobs
                 except Exception as e:
                     print('Failed when handling {}/{}/{}, reason: {}'.format(r, c, f, e))
+    finally:
+        reader.close()
+    return commits
+
+
+def _extract_repo(args):
+    r, commits, project_repo, file_repo = args
+    try:
+        return r, extract_modified_files(r, commits, project_repo, file_repo)
+    except Exception as e:
+        print('Failed when handling repo {}, reason: {}'.format(r, e))
+        return r, commits
+
+
+def get_modified_files(jsonfile, project_repo, file_repo, workers = None):
+    # workers - number of repos handled in parallel, the number of cores if None
+    repos = json.loads(open(jsonfile, "r", encoding = "utf-8").read())
+    workers = workers if workers != None else (os.cpu_count() or 1)
+    jobs = [(r, repos[r], project_repo, file_repo) for r in repos]
+    if workers > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(processes = workers) as pool:
+            for r, commits in tqdm(pool.imap_unordered(_extract_repo, jobs, chunksize = 1), total = len(jobs)):
+                repos[r] = commits
+    else:
+        for job in tqdm(jobs):
+            r, commits = _extract_repo(job)
+            repos[r] = commits
     
     with open(jsonfile, 'w', encoding = 'utf-8') as jf:
         jf.write(json.dumps(repos, sort_keys=True, indent=4, separators=(',', ': ')))
@@ -389,8 +525,8 @@ def check_modified_files(jsonfile):
         for c in repos[r]:
             for f in repos[r][c]:
                 try:
-                    a = ast.parse(open(repos[r][c][f]['files'][0], 'r', encoding = 'utf-8').read())
-                    b = ast.parse(open(repos[r][c][f]['files'][1], 'r', encoding = 'utf-8').read())
+                    a = parse_source(repos[r][c][f]['files'][0])
+                    b = parse_source(repos[r][c][f]['files'][1])
                 except Exception as e:
                     num += 1
                     continue
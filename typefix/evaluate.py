@@ -1,11 +1,14 @@
 import json
 import os
 import ast
+import hashlib
+import multiprocessing
 from tqdm import tqdm
-from difflib import Differ
+from difflib import Differ, SequenceMatcher
 from patch_generator import PatchGenerator
-from bug_locator import FunctionLocator
-from ast_operation import ASTDiffer, CommentRemover
+from match_cache import MatchCache
+from ast_operation import ASTDiffer, ASTHasher, CommentRemover
+from code_layout import get_column, get_indent
 from __init__ import logger
 import traceback
 
@@ -35,41 +38,109 @@ def split_lines(buglines, added, metadata):
             new_added.append(added[prev:])
         return new_buglines, new_added
 
-def compare_file(patch, correct, stmt_sensitive = False):
+# Parse result of the last correct file, compare_file is called with the same correct file for all patches of a buggy file
+correct_cache = {"source": None, "root": None, "lines": None}
+
+
+def count_diff_lines(diff_lines, counter):
+    # Same line numbers as counting the lines of "\n".join(Differ().compare(...)).splitlines(), guide lines end with "\n" and thus are followed by an empty line
+    for line in diff_lines:
+        for l in (line + "\n").splitlines():
+            if l.startswith('-'):
+                counter[0] += 1
+                counter[2].append(counter[0])
+            elif l.startswith('+'):
+                counter[1] += 1
+                counter[3].append(counter[1])
+            elif not l.startswith('?'):
+                counter[0] += 1
+                counter[1] += 1
+            else:
+                counter[0] -= 1
+                counter[1] -= 1
+
+
+def get_changed_lines(patch_lines, correct_lines, max_lines = 20):
+    # Changed line numbers of both sides as counted on the output of Differ().compare, None if either side has more than max_lines changed lines.
+    # Equal regions are skipped without formatting them, and the character level comparison of Differ is only run on replaced regions
+    # once they cannot exceed max_lines, the lines of a replaced region absent from the other side are always reported as changed.
     d = Differ()
+    opcodes = SequenceMatcher(d.linejunk, patch_lines, correct_lines).get_opcodes()
+    patch_bound = 0
+    correct_bound = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'delete':
+            patch_bound += i2 - i1
+        elif tag == 'insert':
+            correct_bound += j2 - j1
+        elif tag == 'replace':
+            correct_set = set(correct_lines[j1:j2])
+            patch_set = set(patch_lines[i1:i2])
+            patch_bound += len([l for l in patch_lines[i1:i2] if l not in correct_set])
+            correct_bound += len([l for l in correct_lines[j1:j2] if l not in patch_set])
+        if patch_bound > max_lines or correct_bound > max_lines:
+            return None
+    # patch line number, correct line number, patch changed lines, correct changed lines
+    counter = [0, 0, [], []]
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            counter[0] += i2 - i1
+            counter[1] += i2 - i1
+        elif tag == 'delete':
+            count_diff_lines(['- ' + l for l in patch_lines[i1:i2]], counter)
+        elif tag == 'insert':
+            count_diff_lines(['+ ' + l for l in correct_lines[j1:j2]], counter)
+        else:
+            # Same generator Differ.compare uses for replaced regions
+            count_diff_lines(d._fancy_replace(patch_lines, i1, i2, correct_lines, j1, j2), counter)
+        if len(counter[2]) > max_lines or len(counter[3]) > max_lines:
+            return None
+    return counter[2], counter[3]
+
+
+def locate_function(root, lines):
+    # Same node as FunctionLocator().run(root, lines), only statements containing one of the lines are visited
+    curnode = root
+    stack = [root]
+    while len(stack) > 0:
+        node = stack.pop()
+        if hasattr(node, 'lineno') and hasattr(node, 'end_lineno'):
+            contained = False
+            for l in lines:
+                if l in range(node.lineno, node.end_lineno + 1):
+                    contained = True
+                    break
+            if not contained:
+                continue
+            if type(node) in [ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef]:
+                curnode = node
+        children = []
+        for name, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                children += [n for n in value if isinstance(n, (ast.stmt, ast.excepthandler, ast.match_case))]
+            elif isinstance(value, (ast.stmt, ast.excepthandler, ast.match_case)):
+                children.append(value)
+        stack += children[::-1]
+    return curnode
+
+
+def compare_file(patch, correct, stmt_sensitive = False):
     try:
         patch_root = ast.parse(patch)
-        correct_root = ast.parse(correct)
+        if correct_cache["source"] != correct:
+            correct_cache["root"] = ast.parse(correct)
+            correct_cache["lines"] = correct.splitlines()
+            correct_cache["source"] = correct
+        correct_root = correct_cache["root"]
     except Exception as e:
         raise ValueError('Cannot parse files.')
-    patch_lines = patch.splitlines()
-    correct_lines = correct.splitlines()
-    res = '\n'.join(d.compare(patch_lines, correct_lines))
-    patch_changed_lines = []
-    correct_changed_lines = []
-    patch_lineno = 0
-    correct_lineno = 0
-    for i, l in enumerate(res.splitlines()):
-        if l.startswith('-'):
-            patch_lineno += 1
-            patch_changed_lines.append(patch_lineno)
-        elif l.startswith('+'):
-            correct_lineno += 1
-            correct_changed_lines.append(correct_lineno)
-        elif not l.startswith('?'):
-            patch_lineno += 1
-            correct_lineno += 1
-        elif l.startswith('?'):
-            patch_lineno -= 1
-            correct_lineno -= 1
-    if len(patch_changed_lines) > 20 or len(correct_changed_lines) > 20:
+    changed_lines = get_changed_lines(patch.splitlines(), correct_cache["lines"])
+    if changed_lines == None:
         logger.error('Too many changed lines, skipped.')
         return False
-    patch_linenos = patch_changed_lines
-    correct_linenos = correct_changed_lines
-    locator = FunctionLocator()
-    patch_node = locator.run(patch_root, patch_linenos)
-    correct_node = locator.run(correct_root, correct_linenos)
+    patch_linenos, correct_linenos = changed_lines
+    patch_node = locate_function(patch_root, patch_linenos)
+    correct_node = locate_function(correct_root, correct_linenos)
     differ = ASTDiffer()
     logger.debug('Patch linenos: {},correct linenos: {}'.format(patch_linenos, correct_linenos))
     '''
@@ -84,186 +155,366 @@ def compare_file(patch, correct, stmt_sensitive = False):
         return False
 
 
-def evaluate_template_coverage(metafile, benchmark_path, template_file, benchmark = 'bugsinpy', patch_path = None, remove_comment = False):
+class ExactMatcher(object):
+    # Exact match of patches with a correct file. The correct file is hashed once with ASTHasher, a candidate of masked lines is parsed and hashed
+    # within its enclosing function only, and ASTDiffer.compare on the whole patched file is only run when the hashes are equal.
+    # Finding the function costs about as much as checking a few candidates on the whole file, so it is only done for more than two candidates.
+    def __init__(self, correct_root):
+        self.correct_root = correct_root
+        self.correct_hash = ASTHasher.hash(correct_root)
+
+    @staticmethod
+    def get_path(root, start, end):
+        # Nodes from root to the innermost function whose body contains the rows [start, end], None if there is no such function
+        path = [root]
+        found = None
+        while True:
+            child = None
+            for n in ast.iter_child_nodes(path[-1]):
+                if isinstance(n, (ast.stmt, ast.excepthandler, ast.match_case)) and n.lineno - 1 <= start and end <= n.end_lineno - 1:
+                    child = n
+                    break
+            if child == None:
+                return found
+            path.append(child)
+            if type(child) in [ast.FunctionDef, ast.AsyncFunctionDef] and child.body[0].lineno - 1 <= start:
+                found = list(path)
+
+    def get_scope(self, buggy_source, masked_line):
+        # Enclosing function of the masked lines in a template generated patch, None if candidates have to be checked on the whole file
+        if buggy_source.count(masked_line) != 1:
+            return None
+        index = buggy_source.find(masked_line)
+        if (index > 0 and buggy_source[index - 1] != "\n") or (index + len(masked_line) < len(buggy_source) and buggy_source[index + len(masked_line)] != "\n"):
+            return None
+        try:
+            buggy_root = ast.parse(buggy_source)
+        except Exception as e:
+            return None
+        start = buggy_source.count("\n", 0, index)
+        path = ExactMatcher.get_path(buggy_root, start, start + masked_line.count("\n"))
+        if path == None:
+            return None
+        lines = buggy_source.split("\n")
+        func = path[-1]
+        # Open the outer blocks of the function so that it can be parsed without changing its indentation
+        prefix = []
+        column = -1
+        for n in path[1:-1]:
+            indent = get_indent(lines[n.lineno - 1])
+            if get_column(indent) > column:
+                prefix.append(indent + "if True:")
+                column = get_column(indent)
+        digests = {}
+        ASTHasher.hash(buggy_root, digests)
+        return {
+            "pre_code": prefix + lines[func.lineno - 1: start],
+            "post_code": lines[start + masked_line.count("\n") + 1: func.end_lineno],
+            "column": get_column(get_indent(lines[func.lineno - 1])),
+            "levels": len(prefix),
+            "path": path,
+            "digests": digests,
+            # Decorators are not part of the function source, they are taken from the patch
+            "decorators": ASTHasher.encode_field(func, "decorator_list", digests)
+        }
+
+    def hash_candidate(self, scope, candidate):
+        # Hash of the patched file, None if the candidate cannot be checked within the enclosing function
+        for line in candidate.split("\n"):
+            if len(line.strip()) > 0 and get_column(get_indent(line)) <= scope["column"]:
+                return None
+        try:
+            node = ast.parse("\n".join(scope["pre_code"] + [candidate] + scope["post_code"]))
+        except Exception as e:
+            return None
+        for i in range(0, scope["levels"]):
+            if len(node.body) != 1 or type(node.body[0]) != ast.If:
+                return None
+            node = node.body[0]
+        if len(node.body) != 1 or type(node.body[0]) != type(scope["path"][-1]):
+            return None
+        return ASTHasher.rehash(scope["path"], ASTHasher.hash(node.body[0], overrides = {"decorator_list": scope["decorators"]}), scope["digests"])
+
+    def match(self, buggy_source, masked_line, candidate, scope = None):
+        if scope != None:
+            digest = self.hash_candidate(scope, candidate)
+            if digest != None and digest != self.correct_hash:
+                return False
+        patched_source = buggy_source.replace(masked_line, candidate)
+        try:
+            patched_root = ast.parse(patched_source)
+        except Exception as e:
+            logger.debug(f'Cannot parse patched source, reason: {e}')
+            return False
+        return ASTDiffer.compare(patched_root, self.correct_root)
+
+
+def collect_instances(metadata, benchmark_path, benchmark = 'bugsinpy'):
+    # Instances evaluated independently, names are the directories of their results, e.g., [repo, bug id] for bugsinpy
+    instances = []
+    if benchmark == 'bugsinpy':
+        for r in metadata:
+            for i in metadata[r]:
+                instances.append({
+                    "key": f'{r}-{i}',
+                    "r": r,
+                    "names": [r, i],
+                    "entry": metadata[r][i],
+                    "path": os.path.join(benchmark_path, r, f'{r}-{i}'),
+                    "result_dir": [r, f'{r}-{i}'],
+                    "ori_dir": [r, str(i)],
+                    "ori_prefix": 'TypeErrorFix/benchmarks/bugsinpy/' + r + '/' + f'{r}-{i}' + '/'
+                })
+    elif benchmark == 'typebugs':
+        for r in metadata:
+            if r in ["core/core-8065", "salt/salt-56381"]:
+                continue
+            instances.append({
+                "key": r,
+                "r": r,
+                "names": [r],
+                "entry": metadata[r],
+                "path": os.path.join(benchmark_path, r),
+                "result_dir": [r],
+                "ori_dir": [r],
+                "ori_prefix": 'TypeErrorFix/benchmarks/typebugs/' + r + '/'
+            })
+    return instances
+
+
+def get_buggy_files(entry, f):
+    prefix = f.replace(".py", "-")
+    buggy_files = []
+    for bf in entry["buglines"]:
+        if bf.startswith(prefix):
+            buggy_files.append(bf)
+    if len(buggy_files) == 0:
+        buggy_files.append(f)
+    return buggy_files
+
+
+def hash_inputs(paths, settings = None):
+    # Content hash of the files and directories an instance is evaluated on, together with the settings of the evaluation
+    sha = hashlib.sha1(json.dumps(settings, sort_keys = True).encode('utf-8'))
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = []
+            for root, dirs, filenames in os.walk(path):
+                dirs.sort()
+                for filename in sorted(filenames):
+                    files.append(os.path.join(root, filename))
+        for filename in files:
+            sha.update(filename.encode('utf-8'))
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        sha.update(chunk)
+            else:
+                sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def load_results(results_file):
+    # Latest logged result of each instance
+    results = {}
+    if results_file == None or not os.path.exists(results_file):
+        return results
+    for line in open(results_file, 'r', encoding = 'utf-8'):
+        try:
+            entry = json.loads(line)
+            results[entry["key"]] = entry
+        except Exception as e:
+            # A run killed while writing leaves a partial last line
+            logger.debug(f'Cannot load logged result, reason: {e}, skipped.')
+    return results
+
+
+# Evaluation function and its arguments in worker processes, set before they are forked
+_worker_evaluation = None
+
+def _evaluate_instance(instance):
+    func, kwargs = _worker_evaluation
+    try:
+        return instance["key"], func(instance, **kwargs), None
+    except Exception as e:
+        traceback.print_exc()
+        return instance["key"], None, f"{e}"
+
+
+def run_instances(func, instances, hashes, results_file = None, workers = 1, **kwargs):
+    # Evaluate the instances whose inputs changed since their results were logged, on a pool of workers if workers > 1
+    # Each result is appended to results_file as soon as it is available, return the results of all instances by key
+    logged = load_results(results_file)
+    todo = [ins for ins in instances if ins["key"] not in logged or logged[ins["key"]]["hash"] != hashes[ins["key"]]]
+    logger.info('Evaluating {} of {} instances, the others are unchanged since the last run.'.format(len(todo), len(instances)))
+    log = None
+    if results_file != None:
+        if not os.path.exists(os.path.dirname(os.path.abspath(results_file))):
+            os.system('mkdir -p {}'.format(os.path.dirname(os.path.abspath(results_file))))
+        log = open(results_file, 'a', encoding = 'utf-8')
+    global _worker_evaluation
+    _worker_evaluation = (func, kwargs)
+    pool = None
+    if workers > 1 and len(todo) > 1:
+        # Workers are forked so that they share the loaded templates
+        pool = multiprocessing.get_context('fork').Pool(processes = workers)
+        iterator = pool.imap_unordered(_evaluate_instance, todo, chunksize = 1)
+    else:
+        iterator = map(_evaluate_instance, todo)
+    try:
+        for key, result, error in tqdm(iterator, total = len(todo), desc = 'Evaluating Instances'):
+            if error != None:
+                logger.error('Error occurred when evaluating instance {}, reason: {}, skipped.'.format(key, error))
+                continue
+            logged[key] = {"key": key, "hash": hashes[key], "result": result}
+            if log != None:
+                log.write(json.dumps(logged[key]) + '\n')
+                log.flush()
+    finally:
+        if pool != None:
+            pool.terminate()
+            pool.join()
+        if log != None:
+            log.close()
+        _worker_evaluation = None
+    return {ins["key"]: logged[ins["key"]]["result"] for ins in instances if ins["key"] in logged}
+
+
+def evaluate_instance_coverage(instance, generator = None, remove_comment = False, patch_path = None, first_match = False, store = None, benchmark = None):
+    # Template coverage of one instance, patches are dumped to patch_path if it is given and written to store if it is given
+    # first_match - compare each patch right after it is generated and stop at the first matched one, matched_indexes then only has that one
+    entry = instance["entry"]
+    result = {"total": 0, "matched": 0, "nopatch": 0, "failed_cases": [], "succeed_cases": [], "success_indexes": []}
+    patches = {}
+    #if instance["key"] != 'scrapy-8':
+    #    return result
+    logger.debug(f'+++++++++++++++++++++++++++++++++++++++++Evaluating Case #{instance["key"]}+++++++++++++++++++++++++++++++++++++++++')
+    for f in entry['code_files']:
+        if not f.endswith('.py'):
+            continue
+        correct = ast.unparse(ast.parse(open(os.path.join(instance["path"], f'correct/{f}')).read()))
+        if remove_comment:
+            remover = CommentRemover()
+            correct = ast.unparse(remover.run(ast.parse(correct)))
+        try:
+            correct_root = ast.parse(correct)
+        except Exception as e:
+            logger.error(f'Cannot parse the correct file, reason: {e}, skipped.')
+            continue
+        for bf in get_buggy_files(entry, f):
+            result["total"] += 1
+            buglines = entry["buglines"][bf]
+            added = entry["added"][bf]
+            buggy_file = os.path.join(instance["path"], bf)
+            logger.debug(f'------------------------------Evaluating buggy file #{buggy_file}------------------------------')
+            until = None
+            if first_match:
+                until = lambda patch: compare_file(ast.unparse(patch[0]), correct, stmt_sensitive = True if patch[2] == 'Replace' else False)
+            try:
+                patches[buggy_file] = generator.run_one(buggy_file, buglines = buglines, added = added, dump = False, until = until)
+            except Exception as e:
+                traceback.print_exc()
+                logger.debug('Error occurred when generating patches, reason: {}.'.format(e))
+                result["nopatch"] += 1
+                continue
+            if store != None and patches[buggy_file] != None:
+                store.add_patches(benchmark, "/".join(instance["result_dir"]), f, bf, patches[buggy_file], buglines = buglines, added = added)
+            first_matched_index = None
+            matched_indexes = []
+            if patches[buggy_file] == None or len(patches[buggy_file]) == 0:
+                result["nopatch"] += 1
+                logger.debug('No patch generated.')
+                continue
+            if first_match:
+                # Patches are numbered in the order they are generated, so this is the index the full comparison would find first
+                if generator.found_index != None:
+                    first_matched_index = generator.found_index
+                    matched_indexes.append(first_matched_index)
+            else:
+                for k, p in enumerate(patches[buggy_file]):
+                    logger.debug('Testing Patch #{}'.format(patches[buggy_file][p][1]))
+                    if compare_file(ast.unparse(patches[buggy_file][p][0]), correct, stmt_sensitive = True if patches[buggy_file][p][2] == 'Replace' else False):
+                        if first_matched_index == None:
+                            first_matched_index = k
+                        matched_indexes.append(k)
+            if first_matched_index == None:
+                result["failed_cases"].append(instance["names"] + [f, entry['buglines'][f]])
+                logger.info('Failed to find the matched patch.')
+            else:
+                result["success_indexes"].append(first_matched_index + 1)
+                result["succeed_cases"].append(instance["names"] + [f, entry['buglines'][f], matched_indexes])
+                result["matched"] += 1
+                logger.info(f'Found matched patch index #{first_matched_index + 1}.')
+    if patch_path != None:
+        for f in patches:
+            if patches[f] == None:
+                continue
+            path = os.path.join(patch_path, *instance["names"], f.replace('/', '_'))
+            if not os.path.exists(path):
+                os.system(f'mkdir -p {path}')
+            else:
+                os.system(f'rm -f {path}/*')
+            duplicated = {}
+            for k in patches[f]:
+                if patches[f][k][-1] in duplicated:
+                    continue
+                with open(os.path.join(path, '{}_from_{}.py'.format(k, patches[f][k][1])), 'w', encoding = 'utf-8') as pf:
+                    pf.write(patches[f][k][-1])
+                    duplicated[patches[f][k][-1]] = 1
+    return result
+
+
+def evaluate_template_coverage(metafile, benchmark_path, template_file, benchmark = 'bugsinpy', patch_path = None, remove_comment = False, workers = 1, results_file = None, first_match = False, store = None):
+    # first_match - coverage-only mode, patches of a buggy file are compared as they are generated and the generation stops at the first match,
+    # the match rate and the first matched indexes are the same as the full run
+    # workers - number of processes evaluating instances in parallel
+    # results_file - jsonl log of per-instance results, instances whose inputs are unchanged since they were logged are not evaluated again,
+    # defaults to coverage_results.jsonl in patch_path if patch_path is given
+    # store - ResultsStore the generated patches and the coverage outcomes are also written to
     metadata = json.loads(open(metafile, 'r', encoding = 'utf-8').read())
     generator = PatchGenerator(template_file, remove_comment = remove_comment)
+    if results_file == None and patch_path != None:
+        results_file = os.path.join(patch_path, 'coverage_results.jsonl')
+    instances = collect_instances(metadata, benchmark_path, benchmark = benchmark)
+    settings = {"template_file": MatchCache.file_signature(template_file), "remove_comment": remove_comment, "patch_path": patch_path, "first_match": first_match, "store": store.path if store != None else None}
+    hashes = {}
+    for ins in instances:
+        paths = []
+        for f in ins["entry"]["code_files"]:
+            if f.endswith('.py'):
+                paths.append(os.path.join(ins["path"], f'correct/{f}'))
+                paths += [os.path.join(ins["path"], bf) for bf in get_buggy_files(ins["entry"], f)]
+        hashes[ins["key"]] = hash_inputs(paths, settings = dict(settings, entry = ins["entry"]))
+    results = run_instances(evaluate_instance_coverage, instances, hashes, results_file = results_file, workers = workers,
+                            generator = generator, remove_comment = remove_comment, patch_path = patch_path, first_match = first_match, store = store, benchmark = benchmark)
     total_count = 0
     matched_count = 0
     nopatch_count = 0
     failed_cases = []
     succeed_cases = []
     success_indexes = []
-    if benchmark == 'bugsinpy':
-        patches = {}
-        for r in tqdm(metadata, desc = 'Evaluating Instances'):
-            patches[r] = {}
-            for i in metadata[r]:
-                #if f'{r}-{i}' != 'scrapy-8':
-                #    continue
-                logger.debug(f'+++++++++++++++++++++++++++++++++++++++++Evaluating Case #{r}+++++++++++++++++++++++++++++++++++++++++')
-                patches[r][i] = {}
-                path = os.path.join(benchmark_path, r, f'{r}-{i}')
-                for f in metadata[r][i]['code_files']:
-                    if not f.endswith('.py'):
-                        continue
-                    buglines = metadata[r][i]['buglines'][f]
-                    added = metadata[r][i]['added'][f]
-                    correct = ast.unparse(ast.parse(open(os.path.join(path, f'correct/{f}')).read()))
-                    if remove_comment:
-                        remover = CommentRemover()
-                        correct = ast.unparse(remover.run(ast.parse(correct)))
-                    try:
-                        correct_root = ast.parse(correct)
-                    except Exception as e:
-                        logger.error(f'Cannot parse the correct file, reason: {e}, skipped.')
-                        continue
-                    buggy_files = []
-                    prefix = f.replace(".py", "-")
-                    for bf in metadata[r][i]["buglines"]:
-                        if bf.startswith(prefix):
-                            buggy_files.append(bf)
-                    if len(buggy_files) == 0:
-                        buggy_files.append(f)
-                    for bf in buggy_files:
-                        total_count += 1
-                        buglines = metadata[r][i]["buglines"][bf]
-                        added = metadata[r][i]["added"][bf]
-                        buggy_file = os.path.join(path, bf)
-                        logger.debug(f'------------------------------Evaluating buggy file #{buggy_file}------------------------------')
-                        try:
-                            patches[r][i][buggy_file] = generator.run_one(buggy_file, buglines = buglines, added = added)
-                        except Exception as e:
-                            traceback.print_exc()
-                            logger.debug('Error occurred when generating patches, reason: {}.'.format(e))
-                            nopatch_count += 1
-                            continue
-                        first_matched_index = None
-                        matched_indexes = []
-                        if len(patches[r][i][buggy_file]) == 0:
-                            nopatch_count += 1
-                            logger.debug('No patch generated.')
-                            continue
-                        for k, p in enumerate(patches[r][i][buggy_file]):
-                            logger.debug('Testing Patch #{}'.format(patches[r][i][buggy_file][p][1]))
-                            if compare_file(ast.unparse(patches[r][i][buggy_file][p][0]), correct, stmt_sensitive = True if patches[r][i][buggy_file][p][2] == 'Replace' else False):
-                                if first_matched_index == None:
-                                    first_matched_index = k
-                                matched_indexes.append(k)
-                        if first_matched_index == None:
-                            failed_cases.append([r, i, f, metadata[r][i]['buglines'][f]])
-                            logger.info('Failed to find the matched patch.')
-                        else:
-                            success_indexes.append(first_matched_index + 1)
-                            succeed_cases.append([r, i, f, metadata[r][i]['buglines'][f], matched_indexes])
-                            matched_count += 1
-                            logger.info(f'Found matched patch index #{first_matched_index + 1}.')
-        if patch_path != None:
-            for r in patches:
-                for i in patches[r]:
-                    for f in patches[r][i]:
-                        path = os.path.join(patch_path, r, i, f.replace('/', '_'))
-                        if not os.path.exists(path):
-                            os.system(f'mkdir -p {path}')
-                        else:
-                            os.system(f'rm -f {path}/*')
-                        duplicated = {}
-                        for k in patches[r][i][f]:
-                            if patches[r][i][f][k][-1] in duplicated:
-                                continue
-                            with open(os.path.join(path, '{}_from_{}.py'.format(k, patches[r][i][f][k][1])), 'w', encoding = 'utf-8') as pf:
-                                pf.write(patches[r][i][f][k][-1])
-                                duplicated[patches[r][i][f][k][-1]] = 1
-            with open(os.path.join(patch_path, 'failed_match_cases.json'), 'w', encoding = 'utf-8') as ff:
-                ff.write(json.dumps(failed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
-            with open(os.path.join(patch_path, 'succeed_match_cases.json'), 'w', encoding = 'utf-8') as ff:
-                ff.write(json.dumps(succeed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
-        logger.info(f'Match Rate: {matched_count/(total_count - nopatch_count)} ({matched_count}/{total_count - nopatch_count}), {nopatch_count} do not have any patch.')
-        logger.info('Average Index: {}'.format(sum(success_indexes)/len(success_indexes)))
-    elif benchmark == 'typebugs':
-        patches = {}
-        for r in tqdm(metadata, desc = 'Evaluating Instances'):
-            if r in ["core/core-8065", "salt/salt-56381"]:
-                continue
-            #if r != 'pandas/pandas-28251':
-            #    continue
-            logger.debug(f'+++++++++++++++++++++++++++++++++++++++++Evaluating Case #{r}+++++++++++++++++++++++++++++++++++++++++')
-            patches[r] = {}
-            path = os.path.join(benchmark_path, r)
-            for f in metadata[r]['code_files']:
-                if not f.endswith('.py'):
-                    continue
-                correct = ast.unparse(ast.parse(open(os.path.join(path, f'correct/{f}')).read()))
-                if remove_comment:
-                    remover = CommentRemover()
-                    correct = ast.unparse(remover.run(ast.parse(correct)))
-                try:
-                    correct_root = ast.parse(correct)
-                except Exception as e:
-                    #print(correct)
-                    logger.error(f'Cannot parse the correct file, reason: {e}, skipped.')
-                    continue
-                buggy_files = []
-                prefix = f.replace(".py", "-")
-                for bf in metadata[r]["buglines"]:
-                    if bf.startswith(prefix):
-                        buggy_files.append(bf)
-                if len(buggy_files) == 0:
-                    buggy_files.append(f)
-                for bf in buggy_files:
-                    buglines = metadata[r]["buglines"][bf]
-                    added = metadata[r]["added"][bf]
-                    total_count += 1
-                    buggy_file = os.path.join(path, bf)
-                    logger.debug(f'------------------------------Evaluating buggy file #{buggy_file}------------------------------')
-                    try:
-                        patches[r][buggy_file] = generator.run_one(buggy_file, buglines = buglines, added = added)
-                    except Exception as e:
-                        traceback.print_exc()
-                        logger.debug('Error occurred when generating patches, reason: {}.'.format(e))
-                        nopatch_count += 1
-                        continue
-                    first_matched_index = None
-                    matched_indexes = []
-                    if len(patches[r][buggy_file]) == 0:
-                        nopatch_count += 1
-                        logger.debug('No patch generated.')
-                        continue
-                    for i, p in enumerate(patches[r][buggy_file]):
-                        logger.debug('Testing Patch #{}'.format(patches[r][buggy_file][p][1]))
-                        if compare_file(ast.unparse(patches[r][buggy_file][p][0]), correct, stmt_sensitive = True if patches[r][buggy_file][p][2] == 'Replace' else False):
-                            if first_matched_index == None:
-                                first_matched_index = i
-                            matched_indexes.append(i)
-                    if first_matched_index == None:
-                        failed_cases.append([r, f, metadata[r]['buglines'][f]])
-                        logger.info('Failed to find the matched patch.')
-                    else:
-                        success_indexes.append(first_matched_index + 1)
-                        succeed_cases.append([r, f, metadata[r]['buglines'][f], matched_indexes])
-                        matched_count += 1
-                        logger.info(f'Found matched patch index #{first_matched_index + 1}.')
-                    #exit()
-        if patch_path != None:
-            for r in patches:
-                for f in patches[r]:
-                    path = os.path.join(patch_path, r, f.replace('/', '_'))
-                    if not os.path.exists(path):
-                        os.system(f'mkdir -p {path}')
-                    else:
-                        os.system(f'rm -f {path}/*')
-                    duplicated = {}
-                    for k in patches[r][f]:
-                        if patches[r][f][k][-1] in duplicated:
-                            continue
-                        with open(os.path.join(path, '{}_from_{}.py'.format(k, patches[r][f][k][1])), 'w', encoding = 'utf-8') as pf:
-                            pf.write(patches[r][f][k][-1])
-                            duplicated[patches[r][f][k][-1]] = 1
-            with open(os.path.join(patch_path, 'failed_match_cases.json'), 'w', encoding = 'utf-8') as ff:
-                ff.write(json.dumps(failed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
-            with open(os.path.join(patch_path, 'succeed_match_cases.json'), 'w', encoding = 'utf-8') as ff:
-                ff.write(json.dumps(succeed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
-        logger.info(f'Match Rate: {matched_count/(total_count - nopatch_count)} ({matched_count}/{total_count - nopatch_count}), {nopatch_count} do not have any patch.')
-        logger.info('Average Index: {}'.format(sum(success_indexes)/len(success_indexes)))
+    evaluations = []
+    for ins in instances:
+        if ins["key"] not in results:
+            continue
+        result = results[ins["key"]]
+        total_count += result["total"]
+        matched_count += result["matched"]
+        nopatch_count += result["nopatch"]
+        failed_cases += result["failed_cases"]
+        succeed_cases += result["succeed_cases"]
+        success_indexes += result["success_indexes"]
+        evaluations += [["/".join(ins["result_dir"]), "succeed", c] for c in result["succeed_cases"]] + [["/".join(ins["result_dir"]), "failed", c] for c in result["failed_cases"]]
+    if store != None:
+        store.set_evaluations(benchmark, "coverage", evaluations)
+    if patch_path != None:
+        with open(os.path.join(patch_path, 'failed_match_cases.json'), 'w', encoding = 'utf-8') as ff:
+            ff.write(json.dumps(failed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
+        with open(os.path.join(patch_path, 'succeed_match_cases.json'), 'w', encoding = 'utf-8') as ff:
+            ff.write(json.dumps(succeed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
+    logger.info(f'Match Rate: {matched_count/(total_count - nopatch_count)} ({matched_count}/{total_count - nopatch_count}), {nopatch_count} do not have any patch.')
+    logger.info('Average Index: {}'.format(sum(success_indexes)/len(success_indexes)))
 
 
 def evaluate_plausible(repo, benchmark_file, benchmark = "bugsinpy"):
@@ -437,196 +688,106 @@ def get_bug_num(benchmark_file, benchmark = "bugsinpy"):
     with open(f"{benchmark}.csv", "w", encoding = "utf-8") as bf:
         bf.write(text)
 
-def evaluate_exactmatch(final_patch_path, ori_patch_path, benchmark_path, metafile, benchmark = "bugsinpy"):
-    metadata = json.loads(open(metafile, "r", encoding = "utf-8").read())
-    if benchmark == "bugsinpy":
-        num = 0
-        correct_num = 0
-        succeed_cases = []
-        failed_cases = []
-        for r in tqdm(metadata, desc = 'Evaluating Instances'):
-            for i in metadata[r]:
-                path = os.path.join(benchmark_path, r, f'{r}-{i}')
-                for f in metadata[r][i]['code_files']:
-                    if not f.endswith('.py'):
-                        continue
-                    correct = ast.unparse(ast.parse(open(os.path.join(path, f'correct/{f}')).read()))
-                    remover = CommentRemover()
-                    correct_root = remover.run(ast.parse(correct))
-                    prefix = f.replace(".py", "-")
-                    buggy_files = []
-                    for bf in metadata[r][i]["buglines"]:
-                        if bf.startswith(prefix):
-                            buggy_files.append(bf)
-                    if len(buggy_files) == 0:
-                        buggy_files.append(f)
-                    for bf in buggy_files:
-                        patch_file_path = os.path.join(final_patch_path, r, f'{r}-{i}', bf.replace('/', '_').replace('.py', '.json'))
-                        if not os.path.exists(patch_file_path):
-                            continue
-                        num += 1
-                        patch = json.loads(open(patch_file_path, "r").read())
-                        success = False
-                        for p in patch:
-                            if p == "buggy_code":
-                                continue
-                            ori_patch_file_path = os.path.join(ori_patch_path, r, str(i), ('TypeErrorFix/benchmarks/bugsinpy/' + r + '/' + f'{r}-{i}' + '/' + bf).replace('/', '_'), p)
-                            buggy_source = open(ori_patch_file_path, "r").read()
-                            if "code" not in patch[p]:
-                                if "patches" in patch[p]:
-                                    for index, c in enumerate(patch[p]["patches"]):
-                                        try:
-                                            patched_root = ast.parse(c)
-                                        except Exception as e:
-                                            logger.debug(f'Cannot parse patched source, reason: {e}')
-                                            continue
-                                        if ASTDiffer.compare(patched_root, correct_root):
-                                            correct_num += 1
-                                            success = True
-                                            succeed_cases.append([r, bf, p, index])
-                                            break
-                                else:
-                                    continue
-                            else:
-                                masked_line = "\n".join(patch[p]["code"]["masked_code"])
-                                if masked_line not in buggy_source:
-                                    logger.error("Cannot find the masked lines in pre-patch.")
-                                    continue
-                                for index, c in enumerate(patch[p]["patches"]):
-                                    patched_source = buggy_source.replace(masked_line, c)
-                                    try:
-                                        patched_root = ast.parse(patched_source)
-                                    except Exception as e:
-                                        logger.debug(f'Cannot parse patched source, reason: {e}')
-                                        continue
-                                    if ASTDiffer.compare(patched_root, correct_root):
-                                        correct_num += 1
-                                        success = True
-                                        succeed_cases.append([f'{r}-{i}', bf, p, index])
-                                        break
-                            if success:
-                                break
-                        if not success:
-                            failed_cases.append([f'{r}-{i}', bf])
-        with open(os.path.join(final_patch_path, "exactmatch_succeed_cases.json"), "w", encoding = "utf-8") as cf:
-            cf.write(json.dumps(succeed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
-        with open(os.path.join(final_patch_path, "exactmatch_failed_cases.json"), "w", encoding = "utf-8") as cf:
-            cf.write(json.dumps(failed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
-        logger.info("Totally {} instances, correctly generate patches for {} instances, correct fix rate: {}.".format(num, correct_num, correct_num/num))
-    elif benchmark == "typebugs":
-        num = 0
-        correct_num = 0
-        succeed_cases = []
-        failed_cases = []
-        for r in tqdm(metadata, desc = 'Evaluating Instances'):
-            if r in ["core/core-8065", "salt/salt-56381"]:
-                continue
-            #if r != "Zappa/Zappa-1434":
+def evaluate_instance_exactmatch(instance, final_patch_path = None, ori_patch_path = None):
+    # Exact match of the validated patches of one instance
+    entry = instance["entry"]
+    result = {"num": 0, "correct_num": 0, "succeed_cases": [], "failed_cases": []}
+    for f in entry['code_files']:
+        if not f.endswith('.py'):
+            continue
+        correct = ast.unparse(ast.parse(open(os.path.join(instance["path"], f'correct/{f}')).read()))
+        remover = CommentRemover()
+        correct_root = remover.run(ast.parse(correct))
+        matcher = ExactMatcher(correct_root)
+        for bf in get_buggy_files(entry, f):
+            #if bf != "zappa/cli-1838.py":
             #    continue
-            path = os.path.join(benchmark_path, r)
-            for f in metadata[r]['code_files']:
-                if not f.endswith('.py'):
+            patch_file_path = os.path.join(final_patch_path, *instance["result_dir"], bf.replace('/', '_').replace('.py', '.json'))
+            if not os.path.exists(patch_file_path):
+                continue
+            result["num"] += 1
+            patch = json.loads(open(patch_file_path, "r").read())
+            success = False
+            for p in patch:
+                if p == "buggy_code":
                     continue
-                correct = ast.unparse(ast.parse(open(os.path.join(path, f'correct/{f}')).read()))
-                remover = CommentRemover()
-                correct_root = remover.run(ast.parse(correct))
-                prefix = f.replace(".py", "-")
-                buggy_files = []
-                for bf in metadata[r]["buglines"]:
-                    if bf.startswith(prefix):
-                        buggy_files.append(bf)
-                if len(buggy_files) == 0:
-                    buggy_files.append(f)
-                for bf in buggy_files:
-                    #if bf != "zappa/cli-1838.py":
-                    #    continue
-                    patch_file_path = os.path.join(final_patch_path, r, bf.replace('/', '_').replace('.py', '.json'))
-                    if not os.path.exists(patch_file_path):
-                        continue
-                    num += 1
-                    patch = json.loads(open(patch_file_path, "r").read())
-                    success = False
-                    for p in patch:
-                        #if p != "44_from_18436.py":
-                        #    continue
-                        if p == "buggy_code":
-                            continue
-                        ori_patch_file_path = os.path.join(ori_patch_path, r, ('TypeErrorFix/benchmarks/typebugs/' + r + '/' + bf).replace('/', '_'), p)
-                        buggy_source = open(ori_patch_file_path, "r").read()
-                        if "code" not in patch[p]:
-                            if "patches" in patch[p]:
-                                for i, c in enumerate(patch[p]["patches"]):
-                                    try:
-                                        patched_root = ast.parse(c)
-                                    except Exception as e:
-                                        logger.debug(f'Cannot parse patched source, reason: {e}')
-                                        continue
-                                    if ASTDiffer.compare(patched_root, correct_root):
-                                        correct_num += 1
-                                        success = True
-                                        succeed_cases.append([r, bf, p, i])
-                                        break
-                            else:
+                ori_patch_file_path = os.path.join(ori_patch_path, *instance["ori_dir"], (instance["ori_prefix"] + bf).replace('/', '_'), p)
+                buggy_source = open(ori_patch_file_path, "r").read()
+                if "code" not in patch[p]:
+                    if "patches" in patch[p]:
+                        for index, c in enumerate(patch[p]["patches"]):
+                            try:
+                                patched_root = ast.parse(c)
+                            except Exception as e:
+                                logger.debug(f'Cannot parse patched source, reason: {e}')
                                 continue
-                        else:
-                            masked_line = "\n".join(patch[p]["code"]["masked_code"])
-                            if masked_line not in buggy_source:
-                                logger.error("Cannot find the masked lines in pre-patch.")
-                                continue
-                            for i, c in enumerate(patch[p]["patches"]):
-                                patched_source = buggy_source.replace(masked_line, c)
-                                try:
-                                    patched_root = ast.parse(patched_source)
-                                except Exception as e:
-                                    logger.debug(f'Cannot parse patched source, reason: {e}')
-                                    continue
-                                if ASTDiffer.compare(patched_root, correct_root):
-                                    correct_num += 1
-                                    success = True
-                                    succeed_cases.append([r, bf, p, i])
-                                    break
-                        if success:
-                            break
-                    if not success:
-                        failed_cases.append([r, bf])
-        with open(os.path.join(final_patch_path, "exactmatch_succeed_cases.json"), "w", encoding = "utf-8") as cf:
-            cf.write(json.dumps(succeed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
-        with open(os.path.join(final_patch_path, "exactmatch_failed_cases.json"), "w", encoding = "utf-8") as cf:
-            cf.write(json.dumps(failed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
-        logger.info("Totally {} instances, correctly generate patches for {} instances, correct fix rate: {}.".format(num, correct_num, correct_num/num))
-
-                
-
-def gen_test_script(failed_file, split = 1, benchmark = "bugsinpy"):
-    failed_cases = json.loads(open(failed_file, "r", encoding = "utf-8").read())
-    if split > 1:
-        n = int(math.ceil(len(failed_cases) / float(split)))
-        cases = [failed_cases[i: i + n] for i in range(0, len(failed_cases), n)]
-    else:
-        cases = [failed_cases]
-    for i, case in enumerate(cases):
-        text = ""
-        for c in case:
-            text += "pyenv global {}\n".format(c[0].split("/")[-1].replace("scikit-learn", "scikitlearn").replace("youtube-dl", "youtubedl"))
-            if benchmark == "typebugs":
-                text += "python test.py  {} {}\n".format(c[0], c[1])
-            elif benchmark == "bugsinpy":
-                if not c[0].startswith("youtube-dl"):
-                    text += "python test.py  {} {}\n".format(c[0].split("-")[0] +"/" + c[0], c[1])
+                            if ASTDiffer.compare(patched_root, correct_root):
+                                result["correct_num"] += 1
+                                success = True
+                                result["succeed_cases"].append([instance["r"], bf, p, index])
+                                break
+                    else:
+                        continue
                 else:
-                    text += "python test.py  {} {}\n".format("youtube-dl/" + c[0], c[1])
-        repo = "/".join(failed_file.split("/")[:-1])
-        os.system("mkdir -p {}/test_scripts".format(repo))
-        with open(f"{repo}/test_scripts/test_{benchmark}_{i}.sh", "w", encoding = "utf-8") as tf:
-            tf.write(text)
-
-
-
-
-        
-
-
-
+                    masked_line = "\n".join(patch[p]["code"]["masked_code"])
+                    if masked_line not in buggy_source:
+                        logger.error("Cannot find the masked lines in pre-patch.")
+                        continue
+                    scope = matcher.get_scope(buggy_source, masked_line) if len(patch[p]["patches"]) > 2 else None
+                    for index, c in enumerate(patch[p]["patches"]):
+                        if matcher.match(buggy_source, masked_line, c, scope = scope):
+                            result["correct_num"] += 1
+                            success = True
+                            result["succeed_cases"].append([instance["key"], bf, p, index])
+                            break
+                if success:
+                    break
+            if not success:
+                result["failed_cases"].append([instance["key"], bf])
+    return result
+
+
+def evaluate_exactmatch(final_patch_path, ori_patch_path, benchmark_path, metafile, benchmark = "bugsinpy", workers = 1, results_file = None, store = None):
+    # workers - number of processes evaluating instances in parallel
+    # results_file - jsonl log of per-instance results, instances whose inputs are unchanged since they were logged are not evaluated again,
+    # defaults to exactmatch_results.jsonl in final_patch_path
+    # store - ResultsStore the exact match outcomes are also written to
+    metadata = json.loads(open(metafile, "r", encoding = "utf-8").read())
+    if results_file == None:
+        results_file = os.path.join(final_patch_path, "exactmatch_results.jsonl")
+    instances = collect_instances(metadata, benchmark_path, benchmark = benchmark)
+    hashes = {}
+    for ins in instances:
+        paths = []
+        for f in ins["entry"]["code_files"]:
+            if f.endswith('.py'):
+                paths.append(os.path.join(ins["path"], f'correct/{f}'))
+                for bf in get_buggy_files(ins["entry"], f):
+                    paths.append(os.path.join(final_patch_path, *ins["result_dir"], bf.replace('/', '_').replace('.py', '.json')))
+                    paths.append(os.path.join(ori_patch_path, *ins["ori_dir"], (ins["ori_prefix"] + bf).replace('/', '_')))
+        hashes[ins["key"]] = hash_inputs(paths, settings = {"entry": ins["entry"]})
+    results = run_instances(evaluate_instance_exactmatch, instances, hashes, results_file = results_file, workers = workers,
+                            final_patch_path = final_patch_path, ori_patch_path = ori_patch_path)
+    num = 0
+    correct_num = 0
+    succeed_cases = []
+    failed_cases = []
+    evaluations = []
+    for ins in instances:
+        if ins["key"] not in results:
+            continue
+        num += results[ins["key"]]["num"]
+        correct_num += results[ins["key"]]["correct_num"]
+        succeed_cases += results[ins["key"]]["succeed_cases"]
+        failed_cases += results[ins["key"]]["failed_cases"]
+        evaluations += [["/".join(ins["result_dir"]), "succeed", c] for c in results[ins["key"]]["succeed_cases"]] + [["/".join(ins["result_dir"]), "failed", c] for c in results[ins["key"]]["failed_cases"]]
+    if store != None:
+        store.set_evaluations(benchmark, "exactmatch", evaluations)
+    with open(os.path.join(final_patch_path, "exactmatch_succeed_cases.json"), "w", encoding = "utf-8") as cf:
+        cf.write(json.dumps(succeed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
+    with open(os.path.join(final_patch_path, "exactmatch_failed_cases.json"), "w", encoding = "utf-8") as cf:
+        cf.write(json.dumps(failed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
+    logger.info("Totally {} instances, correctly generate patches for {} instances, correct fix rate: {}.".format(num, correct_num, correct_num/num))
 
 
 if __name__ == "__main__":
@@ -634,8 +795,6 @@ if __name__ == "__main__":
     evaluate_template_coverage('benchmarks/all_bug_info_bugsinpy.json', 'benchmarks/bugsinpy', 'large_min5_templates.json', benchmark = 'bugsinpy', remove_comment = True)#, patch_path = '/Users/py/workspace/typefix/patches_v2/bugsinpy')
     evaluate_exactmatch('prompt_patches/typebugs', 'patches/typebugs', 'benchmarks/typebugs', 'benchmarks/all_bug_info_typebugs.json', mask_all = False, benchmark = 'typebugs')
     evaluate_exactmatch('prompt_patches/bugsinpy', 'patches/bugsinpy', 'benchmarks/bugsinpy', 'benchmarks/all_bug_info_bugsinpy.json', mask_all = False, benchmark = 'bugsinpy')
-    gen_test_script('prompt_patches/typebugs/exactmatch_failed_cases.json', split = 5, benchmark = "typebugs")
-    gen_test_script('prompt_patches/bugsinpy/exactmatch_failed_cases.json', split = 5, benchmark = "bugsinpy")
 
 
 
@@ -8,6 +8,7 @@ from tqdm import tqdm
 from __init__ import logger, stmt_types, expr_types, elem_types, op2cat, stdtypes, builtins, errors, warnings
 from change_tree import ChangeNode, ChangeTree, ChangePair
 from fix_template import TemplateNode, TemplateTree, Context, FixTemplate
+from blob_store import parse_source
 import traceback
 import time
 
@@ -203,11 +204,11 @@ class ASTCompare(object):
             beforefile, afterfile = commitinfo[f]['files']
             try:
                 if beforefile:
-                    self.beforeroot = ast.parse(open(beforefile, 'r').read())
+                    self.beforeroot = parse_source(beforefile)
                 else:
                     self.beforeroot = None
                 if afterfile:
-                    self.afterroot = ast.parse(open(afterfile, 'r').read())
+                    self.afterroot = parse_source(afterfile)
                 else:
                     self.afterroot = None
             except Exception as e:
@@ -7,6 +7,7 @@ from graphviz import Digraph
 from tqdm import tqdm
 from __init__ import logger, stmt_types, expr_types, elem_types, op2cat, stdtypes, builtins, errors, warnings, cat2op
 from change_tree import ChangeNode, ChangeTree, ChangePair
+import work_budget
 
 
 
@@ -622,6 +623,8 @@ class TemplateNode(object):
     @staticmethod
     def match(a, b, record_map = False, thres = None):
         # Indicate whether a matches to b
+        if work_budget.active_budget != None:
+            work_budget.active_budget.charge('node_visits')
         if (a == None and b != None) or (a != None and b == None):
             if not record_map:
                 return False
@@ -877,6 +880,8 @@ class TemplateNode(object):
                 sub_n, nodemap = TemplateNode.subtrees_match_all_single_match(an, bn, thres = cur_thres)
                 if sub_n != None:
                     found = True
+                    if work_budget.active_budget != None:
+                        work_budget.active_budget.charge('match_states')
                     subtree = {'nodemap': nodemap}
                     if sub_n in trees:
                         trees[sub_n].append(subtree)
@@ -2045,6 +2050,9 @@ class Context(object):
         # Within - contexts in the changed location, i.e., the part in the statement that does not change
         self.type = context_type
 
+        # Cached leaf paths and their candidate buckets, see index_leaf_paths
+        self.leaf_index = None
+
         if self.type != 'Within':
             self.prune_stmt_nodes()
             self.prune_same_stmts()
@@ -2139,20 +2147,74 @@ class Context(object):
         else:
             return False
 
+    def index_leaf_paths(self):
+        # Build the leaf path map once and reuse it in all following matches, the context tree must not change afterwards
+        self.leaf_index = Context.build_leaf_index(self)
+        return self.leaf_index
+
+    @staticmethod
+    def build_leaf_index(context):
+        leaf_paths = context.context_tree.get_leaf_paths()
+        index = {'paths': leaf_paths, 'order': {}, 'type': {}, 'base_type': {}, 'type_value': {}}
+        for i, leaf in enumerate(leaf_paths):
+            index['order'][leaf] = i
+            if leaf.type not in index['type']:
+                index['type'][leaf.type] = []
+            index['type'][leaf.type].append(leaf)
+            if leaf.base_type not in index['base_type']:
+                index['base_type'][leaf.base_type] = []
+            index['base_type'][leaf.base_type].append(leaf)
+            try:
+                key = (leaf.type, leaf.value)
+                if key not in index['type_value']:
+                    index['type_value'][key] = []
+                index['type_value'][key].append(leaf)
+            except TypeError:
+                pass
+        return index
+
+    @staticmethod
+    def get_leaf_candidates(index, b_leaf):
+        # Leaf nodes in index that can possibly self match b_leaf, in their original order
+        if b_leaf.type in ['Stmt', 'Expr', 'End_Expr', 'Identifier']:
+            if b_leaf.type == 'Stmt':
+                base_types = ['Stmt']
+            elif b_leaf.type == 'Expr':
+                base_types = ['Variable', 'Literal', 'Attribute', 'Op', 'Builtin', 'Type', 'Module', 'Keyword', 'Expr', 'End_Expr', 'Identifier']
+            elif b_leaf.type == 'End_Expr':
+                base_types = ['Variable', 'Literal', 'Attribute', 'Op', 'Builtin', 'Type', 'Module', 'Keyword', 'Identifier']
+            else:
+                base_types = ['Variable', 'Attribute', 'Type', 'Builtin']
+            candidates = {}
+            for n in index['type'].get(b_leaf.type, []):
+                candidates[n] = 1
+            for t in base_types:
+                for n in index['base_type'].get(t, []):
+                    candidates[n] = 1
+            return sorted(candidates, key = lambda n: index['order'][n])
+        if b_leaf.value in ['ABSTRACTED', 'REFERRED'] or b_leaf.value_abstracted or b_leaf.type == 'Op':
+            return index['type'].get(b_leaf.type, [])
+        try:
+            return index['type_value'].get((b_leaf.type, b_leaf.value), [])
+        except TypeError:
+            return index['type'].get(b_leaf.type, [])
+
     @staticmethod
     def match(a, b):
         # Indicate whether a matches to b
         if (a == None and b != None) or (a != None and b == None):
             return False
-        a_leaf_paths = a.context_tree.get_leaf_paths()
-        b_leaf_paths = b.context_tree.get_leaf_paths()
+        a_index = a.leaf_index if a.leaf_index != None else Context.build_leaf_index(a)
+        b_index = b.leaf_index if b.leaf_index != None else Context.build_leaf_index(b)
+        a_leaf_paths = a_index['paths']
+        b_leaf_paths = b_index['paths']
         if len(a_leaf_paths) < len(b_leaf_paths):
             return False
         selected = {}
         for b_leaf in b_leaf_paths:
             ori = len(selected)
             candidates = []
-            for a_leaf in a_leaf_paths:
+            for a_leaf in Context.get_leaf_candidates(a_index, b_leaf):
                 if a_leaf in selected:
                     continue
                 if TemplateNode.self_match(a_leaf, b_leaf):
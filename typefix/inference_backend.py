@@ -0,0 +1,209 @@
+import re
+import time
+import random
+import hashlib
+from __init__ import logger
+
+
+
+# torch and transformers are only imported by the backends running a model, so that StubBackend works without them
+def default_device():
+    import torch
+    return "cuda:1" if torch.cuda.is_available() else "cpu"
+
+
+class InferenceBackend(object):
+    # Interface used by Prompt to count tokens and to decode codet5 prompts into raw predictions.
+    # model_id identifies the model and its precision, it is part of the prediction cache keys.
+    def __init__(self, model_id, num_beams = 50):
+        self.model_id = model_id
+        self.num_beams = num_beams
+        self.model = None
+        self.tokenizer = None
+
+    def count_tokens(self, text):
+        # Token number of a prompt, including special tokens
+        raise NotImplementedError()
+
+    def count_line_tokens(self, text):
+        # Token number of a context line, without special tokens
+        raise NotImplementedError()
+
+    def iter_decode(self, prompts):
+        # Yield (i, raw predictions of prompts[i]) for all prompts, in any order
+        raise NotImplementedError()
+
+    def decode_length(self, prompt, max_length, num_beams):
+        # Raw predictions of one model.generate(max_length = max_length, num_beams = num_beams, num_return_sequences = num_beams) call
+        raise NotImplementedError()
+
+    def share_memory(self):
+        # Called before the backend is sent to worker processes
+        pass
+
+
+class TorchBackend(InferenceBackend):
+    # fp32 codet5 on GPU if available, decoded with MultiLengthBeamSearch or one model.generate call per length
+    def __init__(self, model_name = "Salesforce/codet5-base", device = None, single_pass = True, batch_size = 8, max_batch_tokens = None, num_beams = 50, cache_dir = './transformers'):
+        super().__init__(model_name, num_beams = num_beams)
+        from transformers import RobertaTokenizer, RobertaTokenizerFast
+        from length_beam_search import MultiLengthBeamSearch
+        self.device = device if device != None else default_device()
+        self.model = self.load_model(model_name, cache_dir)
+        #self.model = torch.load("/data/pengyun/typefix/models/typefix_3.bin", map_location = "cuda:1")
+        self.tokenizer = RobertaTokenizer.from_pretrained(model_name, cache_dir = cache_dir)
+        # Only used to estimate the token numbers of context lines, token numbers of prompts are still checked with self.tokenizer
+        try:
+            self.fast_tokenizer = RobertaTokenizerFast.from_pretrained(model_name, cache_dir = cache_dir)
+        except Exception as e:
+            logger.debug(f'Cannot load fast tokenizer, reason: {e}, use the slow one instead.')
+            self.fast_tokenizer = self.tokenizer
+        # Decode all mask lengths in one beam search instead of calling model.generate for each length
+        self.single_pass = single_pass and MultiLengthBeamSearch.supported(self.model)
+        # batch_size - number of prompts decoded together in the single pass mode
+        # max_batch_tokens - cap on padded input tokens times beams of a batch, bounds the memory used by the decoder cache
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+
+    def load_model(self, model_name, cache_dir):
+        from transformers import T5ForConditionalGeneration
+        return T5ForConditionalGeneration.from_pretrained(model_name, cache_dir = cache_dir).to(self.device)
+
+    def count_tokens(self, text):
+        return self.tokenizer(text, return_tensors='pt')['input_ids'].size()[1]
+
+    def count_line_tokens(self, text):
+        return len(self.fast_tokenizer(text, add_special_tokens = False)["input_ids"])
+
+    def split_batches(self, lengths):
+        # Group prompts of similar token lengths, each batch is bounded by batch_size and max_batch_tokens
+        batches = []
+        batch = []
+        for i in sorted(range(0, len(lengths)), key = lambda x: lengths[x]):
+            if len(batch) > 0:
+                if len(batch) >= self.batch_size or (self.max_batch_tokens != None and (len(batch) + 1) * lengths[i] * self.num_beams > self.max_batch_tokens):
+                    batches.append(batch)
+                    batch = []
+            batch.append(i)
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def decode_prompt(self, prompt):
+        # Raw predictions of all lengths in the order they are first generated, one model.generate call per length
+        inputs = self.tokenizer(prompt["input"], return_tensors = "pt").to(self.device)
+        predictions = {}
+        for i in range(prompt["min_len"], prompt["max_len"]):
+            outputs = self.model.generate(inputs["input_ids"], max_length = i, num_beams = self.num_beams, num_return_sequences = self.num_beams)
+            for p in self.tokenizer.batch_decode(outputs):
+                predictions[p] = True
+        return list(predictions.keys())
+
+    def decode_length(self, prompt, max_length, num_beams):
+        inputs = self.tokenizer(prompt["input"], return_tensors = "pt").to(self.device)
+        outputs = self.model.generate(inputs["input_ids"], max_length = max_length, num_beams = num_beams, num_return_sequences = num_beams)
+        return self.tokenizer.batch_decode(outputs)
+
+    def decode_batch(self, prompts):
+        # Raw predictions of a batch of prompts, decoded in one single pass search
+        import torch
+        from length_beam_search import MultiLengthBeamSearch
+        encoded = [self.tokenizer(prompt["input"])["input_ids"] for prompt in prompts]
+        width = max([len(e) for e in encoded])
+        input_ids = torch.full((len(prompts), width), self.tokenizer.pad_token_id, dtype = torch.long)
+        attention_mask = torch.zeros((len(prompts), width), dtype = torch.long)
+        for b, e in enumerate(encoded):
+            input_ids[b, :len(e)] = torch.tensor(e, dtype = torch.long)
+            attention_mask[b, :len(e)] = 1
+        beam_engine = MultiLengthBeamSearch(self.model, self.tokenizer, self.device, num_beams = self.num_beams)
+        predictions = [{} for prompt in prompts]
+        for b, length, sub_predictions in beam_engine.generate_batch(input_ids.to(self.device), attention_mask.to(self.device), [prompt["min_len"] for prompt in prompts], [prompt["max_len"] for prompt in prompts]):
+            for p in sub_predictions:
+                predictions[b][p] = True
+        return [list(p.keys()) for p in predictions]
+
+    def iter_decode(self, prompts):
+        if self.single_pass:
+            for batch in self.split_batches([len(self.tokenizer(prompt["input"])["input_ids"]) for prompt in prompts]):
+                for i, p in zip(batch, self.decode_batch([prompts[i] for i in batch])):
+                    yield i, p
+        else:
+            for i, prompt in enumerate(prompts):
+                yield i, self.decode_prompt(prompt)
+
+    def share_memory(self):
+        self.model.share_memory()
+
+
+class QuantizedCPUBackend(TorchBackend):
+    # codet5 with its linear layers dynamically quantized to int8, runs on CPU only
+    # Predictions may differ from the fp32 model, so they are cached under a different model_id
+    def __init__(self, model_name = "Salesforce/codet5-base", single_pass = True, batch_size = 8, max_batch_tokens = None, num_beams = 50, cache_dir = './transformers'):
+        super().__init__(model_name = model_name, device = "cpu", single_pass = single_pass, batch_size = batch_size, max_batch_tokens = max_batch_tokens, num_beams = num_beams, cache_dir = cache_dir)
+        self.model_id = model_name + ":int8"
+
+    def load_model(self, model_name, cache_dir):
+        import torch
+        model = super().load_model(model_name, cache_dir)
+        model.eval()
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype = torch.qint8)
+
+
+class StubBackend(InferenceBackend):
+    # Deterministic canned infills without loading any model, used to benchmark the rest of the repair pipeline offline.
+    # Tokens are approximated by words and punctuations, predictions of a prompt only depend on its input.
+    TOKEN_PATTERN = re.compile(r"<extra_id_\d+>|\w+|[^\w\s]")
+    INFILLS = ["None", "0", "1", "''", "[]", "{}", "str(x)", "int(x)", "x is None", "isinstance(x, str)", "len(x)", "x.strip()", "self", "return None", "pass"]
+
+    def __init__(self, num_beams = 50, infills = None, delay = 0.0):
+        # infills - canned infills of masks, INFILLS if None
+        # delay - seconds spent on each prompt, to emulate a model of given throughput
+        super().__init__("stub", num_beams = num_beams)
+        self.infills = infills if infills != None else StubBackend.INFILLS
+        self.delay = delay
+
+    def count_tokens(self, text):
+        return len(StubBackend.TOKEN_PATTERN.findall(text)) + 2
+
+    def count_line_tokens(self, text):
+        return len(StubBackend.TOKEN_PATTERN.findall(text))
+
+    def generate(self, prompt, seed, num_beams):
+        # One prediction per beam in the layout of codet5 outputs, a wider beam returns more of the same sequence
+        num_masks = len(re.findall(r"<extra_id_\d+>", prompt["input"]))
+        rand = random.Random(hashlib.sha1((prompt["input"] + seed).encode('utf-8')).hexdigest())
+        predictions = []
+        for i in range(0, num_beams):
+            fills = [rand.choice(self.infills) for m in range(0, num_masks)]
+            predictions.append("<pad>" + "".join([f"<extra_id_{m}>" + f for m, f in enumerate(fills)]) + f"<extra_id_{num_masks}></s>")
+        return predictions
+
+    def decode_prompt(self, prompt):
+        predictions = {}
+        for p in self.generate(prompt, "", self.num_beams):
+            predictions[p] = True
+        if self.delay > 0:
+            time.sleep(self.delay)
+        return list(predictions.keys())
+
+    def decode_length(self, prompt, max_length, num_beams):
+        if self.delay > 0:
+            time.sleep(self.delay * num_beams / self.num_beams / max(prompt["max_len"] - prompt["min_len"], 1))
+        return self.generate(prompt, str(max_length), num_beams)
+
+    def iter_decode(self, prompts):
+        for i, prompt in enumerate(prompts):
+            yield i, self.decode_prompt(prompt)
+
+
+BACKENDS = {
+    "torch": TorchBackend,
+    "int8": QuantizedCPUBackend,
+    "stub": StubBackend
+}
+
+
+def get_backend(name, **kwargs):
+    if name not in BACKENDS:
+        raise ValueError('Unsupported inference backend: {}, choose from {}'.format(name, list(BACKENDS.keys())))
+    return BACKENDS[name](**kwargs)
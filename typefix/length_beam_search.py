@@ -0,0 +1,192 @@
+import torch
+from __init__ import logger
+
+
+
+class BeamHypotheses(object):
+    # Finished hypotheses of one beam search, follows the BeamHypotheses of transformers
+    def __init__(self, num_beams, length_penalty, early_stopping):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.beams = []
+        self.worst_score = 1e9
+
+    def __len__(self):
+        return len(self.beams)
+
+    def add(self, hyp, sum_logprobs):
+        score = sum_logprobs / (len(hyp) ** self.length_penalty)
+        if len(self) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, hyp))
+            if len(self) > self.num_beams:
+                sorted_scores = sorted([(s, idx) for idx, (s, _) in enumerate(self.beams)])
+                del self.beams[sorted_scores[0][1]]
+                self.worst_score = sorted_scores[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self, best_sum_logprobs, cur_len):
+        if len(self) < self.num_beams:
+            return False
+        elif self.early_stopping:
+            return True
+        else:
+            return self.worst_score >= best_sum_logprobs / cur_len ** self.length_penalty
+
+    def copy(self):
+        hyps = BeamHypotheses(self.num_beams, self.length_penalty, self.early_stopping)
+        hyps.beams = list(self.beams)
+        hyps.worst_score = self.worst_score
+        return hyps
+
+
+class MultiLengthBeamSearch(object):
+    # Runs a single beam search up to the largest max_length and reports the output that model.generate(max_length = i, num_beams = n, num_return_sequences = n)
+    # would give for every smaller max_length i, since the beam states of the first i - 1 steps do not depend on max_length.
+    # The encoder is run once and the decoder reuses its key/value cache across steps.
+    def __init__(self, model, tokenizer, device, num_beams = 50):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.num_beams = num_beams
+        config = model.config
+        generation_config = getattr(model, 'generation_config', None) or config
+        self.decoder_start_token_id = config.decoder_start_token_id
+        self.pad_token_id = config.pad_token_id
+        self.eos_token_id = config.eos_token_id
+        self.length_penalty = getattr(generation_config, 'length_penalty', 1.0)
+        self.early_stopping = getattr(generation_config, 'early_stopping', False)
+        self.min_length = getattr(generation_config, 'min_length', 0) or 0
+
+    @staticmethod
+    def supported(model):
+        # Logits processors other than min_length change the search, use model.generate for such models
+        config = getattr(model, 'generation_config', None) or model.config
+        if not model.config.is_encoder_decoder:
+            return False
+        for k, default in [('no_repeat_ngram_size', 0), ('encoder_no_repeat_ngram_size', 0), ('repetition_penalty', 1.0), ('bad_words_ids', None),
+                           ('forced_bos_token_id', None), ('forced_eos_token_id', None), ('diversity_penalty', 0.0), ('do_sample', False)]:
+            if getattr(config, k, default) not in [default, None]:
+                return False
+        if getattr(config, 'early_stopping', False) not in [True, False]:
+            return False
+        return True
+
+    def reorder_cache(self, past, beam_idx):
+        if hasattr(past, 'reorder_cache'):
+            past.reorder_cache(beam_idx)
+            return past
+        return self.model._reorder_cache(past, beam_idx)
+
+    def decode(self, hyps, max_length):
+        # Same layout as the sequences returned by model.generate: best hypothesis first, eos after shorter ones and padding
+        beams = sorted(hyps.beams, key = lambda x: x[0])
+        best = [beams[i][1] for i in range(len(beams) - 1, -1, -1)]
+        sent_max_len = min(max([len(h) for h in best]) + 1, max_length)
+        sequences = []
+        for h in best:
+            seq = list(h)
+            if len(seq) < sent_max_len:
+                seq.append(self.eos_token_id)
+            seq += [self.pad_token_id] * (sent_max_len - len(seq))
+            sequences.append(seq)
+        return self.tokenizer.batch_decode(sequences)
+
+    def generate(self, input_ids, attention_mask, min_len, max_len):
+        # Yield (i, predictions) for every max_length i in [min_len, max_len)
+        for b, i, predictions in self.generate_batch(input_ids, attention_mask, [min_len], [max_len]):
+            yield i, predictions
+
+    @torch.no_grad()
+    def generate_batch(self, input_ids, attention_mask, min_lens, max_lens):
+        # Yield (b, i, predictions) for every prompt b of a padded batch and every max_length i in [min_lens[b], max_lens[b])
+        # Prompts of a batch are searched independently, as model.generate does with batched inputs
+        num_beams = self.num_beams
+        batch_size = input_ids.shape[0]
+        encoder_outputs = self.model.get_encoder()(input_ids = input_ids, attention_mask = attention_mask, return_dict = True)
+        encoder_outputs["last_hidden_state"] = encoder_outputs.last_hidden_state.repeat_interleave(num_beams, dim = 0)
+        attention_mask = attention_mask.repeat_interleave(num_beams, dim = 0)
+        decoder_input_ids = torch.full((batch_size * num_beams, 1), self.decoder_start_token_id, dtype = torch.long, device = self.device)
+        beam_scores = torch.zeros((batch_size, num_beams), dtype = torch.float, device = self.device)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.view(-1)
+        hyps = [BeamHypotheses(num_beams, self.length_penalty, self.early_stopping) for b in range(0, batch_size)]
+        done = [False for b in range(0, batch_size)]
+        # finished - all lengths of the prompt have been yielded
+        finished = [False for b in range(0, batch_size)]
+        for b in range(0, batch_size):
+            if max_lens[b] - 1 <= 1 or max_lens[b] <= min_lens[b]:
+                logger.debug('Maximum length {} is not larger than minimum length {}, nothing generated.'.format(max_lens[b], min_lens[b]))
+                finished[b] = True
+        past = None
+        cur_len = 1
+        while not all(finished):
+            outputs = self.model(encoder_outputs = encoder_outputs, attention_mask = attention_mask, decoder_input_ids = decoder_input_ids[:, -1:] if past != None else decoder_input_ids,
+                                 past_key_values = past, use_cache = True, return_dict = True)
+            past = outputs.past_key_values
+            scores = torch.nn.functional.log_softmax(outputs.logits[:, -1, :], dim = -1)
+            if cur_len < self.min_length:
+                scores[:, self.eos_token_id] = -float("inf")
+            vocab_size = scores.shape[-1]
+            scores = (scores + beam_scores[:, None]).view(batch_size, num_beams * vocab_size)
+            next_scores, next_tokens = torch.topk(scores, 2 * num_beams, dim = 1, largest = True, sorted = True)
+            next_indices = torch.div(next_tokens, vocab_size, rounding_mode = 'floor')
+            next_tokens = next_tokens % vocab_size
+
+            next_beam_scores = []
+            next_beam_tokens = []
+            next_beam_indices = []
+            for b in range(0, batch_size):
+                if done[b] or finished[b]:
+                    # Keep the beams of finished prompts as padding
+                    next_beam_scores += [0.0] * num_beams
+                    next_beam_tokens += [self.pad_token_id] * num_beams
+                    next_beam_indices += [b * num_beams + j for j in range(0, num_beams)]
+                    continue
+                num = 0
+                for rank, (token, score, index) in enumerate(zip(next_tokens[b].tolist(), next_scores[b].tolist(), next_indices[b].tolist())):
+                    index = b * num_beams + index
+                    if token == self.eos_token_id:
+                        if rank >= num_beams:
+                            continue
+                        hyps[b].add(decoder_input_ids[index].tolist(), score)
+                    else:
+                        next_beam_scores.append(score)
+                        next_beam_tokens.append(token)
+                        next_beam_indices.append(index)
+                        num += 1
+                    if num == num_beams:
+                        break
+                done[b] = hyps[b].is_done(next_scores[b].max().item(), cur_len)
+
+            beam_scores = torch.tensor(next_beam_scores, dtype = torch.float, device = self.device)
+            beam_idx = torch.tensor(next_beam_indices, dtype = torch.long, device = self.device)
+            decoder_input_ids = torch.cat([decoder_input_ids[beam_idx, :], torch.tensor(next_beam_tokens, dtype = torch.long, device = self.device).unsqueeze(-1)], dim = -1)
+            past = self.reorder_cache(past, beam_idx)
+            cur_len += 1
+
+            for b in range(0, batch_size):
+                if finished[b]:
+                    continue
+                # The search with max_length = cur_len stops here, finalize a copy of it
+                if cur_len >= min_lens[b]:
+                    yield b, cur_len, self.decode(self.finalize(hyps[b], decoder_input_ids[b * num_beams: (b + 1) * num_beams], beam_scores[b * num_beams: (b + 1) * num_beams], done[b]), cur_len)
+                if done[b]:
+                    # Searches with larger max_length stop at the same step and return the same hypotheses
+                    predictions = self.decode(hyps[b], max_lens[b])
+                    for i in range(max(cur_len + 1, min_lens[b]), max_lens[b]):
+                        yield b, i, predictions
+                    finished[b] = True
+                elif cur_len >= max_lens[b] - 1:
+                    finished[b] = True
+
+    def finalize(self, hyps, decoder_input_ids, beam_scores, done):
+        if done:
+            return hyps
+        final_hyps = hyps.copy()
+        sequences = decoder_input_ids.tolist()
+        scores = beam_scores.tolist()
+        for i in range(0, self.num_beams):
+            final_hyps.add(sequences[i], scores[i])
+        return final_hyps
@@ -0,0 +1,126 @@
+import json
+import os
+import hashlib
+from __init__ import logger
+
+
+
+class MatchCache(object):
+    def __init__(self, cache_file = None, signature = None):
+        # cache_file - json file used to persist match results across runs
+        # signature - identifies the template set, cached results are dropped if it changes
+        self.cache_file = cache_file
+        self.signature = signature
+        self.results = {}
+        self.new_results = {}
+        self.hits = 0
+        self.misses = 0
+        if self.cache_file != None and os.path.exists(self.cache_file):
+            try:
+                data = json.loads(open(self.cache_file, 'r', encoding = 'utf-8').read())
+                if data["signature"] == self.signature:
+                    self.results = data["results"]
+                else:
+                    logger.info('Template set changed, discard cached match results in {}.'.format(self.cache_file))
+            except Exception as e:
+                logger.error('Cannot load match cache {}, reason: {}, ignored.'.format(self.cache_file, e))
+
+    @staticmethod
+    def file_signature(filename):
+        sha = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @staticmethod
+    def index_nodes(source):
+        # Assign each node of the before tree and the external contexts a position in a fixed traversal order
+        index = {}
+        trees = [source.before, source.before_contexts.context_tree if source.before_contexts else None, source.after_contexts.context_tree if source.after_contexts else None]
+        for t in trees:
+            if t == None:
+                continue
+            for n in t.iter_nodes():
+                if n not in index:
+                    index[n] = len(index)
+        return index
+
+    @staticmethod
+    def encode_refers(nodes, index):
+        refers = []
+        for n in nodes:
+            if n in index:
+                refers.append(index[n])
+            else:
+                refers.append((n.parent_relation, n.parent.type if n.parent else None, n.value.__class__.__name__, repr(n.value)))
+        return refers
+
+    @staticmethod
+    def encode_node(node, index):
+        children = []
+        for c in node.children:
+            children.append((c, [MatchCache.encode_node(n, index) for n in node.children[c]]))
+        return (
+            node.base_type, node.type, node.value.__class__.__name__, repr(node.value),
+            node.ast_type.__name__ if isinstance(node.ast_type, type) else str(node.ast_type),
+            node.partial, node.value_abstracted, node.type_abstracted, node.dfsid, node.parent_relation,
+            MatchCache.encode_refers(node.self_refer, index), MatchCache.encode_refers(node.refer_to, index),
+            children
+        )
+
+    @staticmethod
+    def hash_source(source):
+        # Canonical hash of a parsed location, i.e., its before tree and external contexts
+        index = MatchCache.index_nodes(source)
+        info = [
+            MatchCache.encode_node(source.before.root, index) if source.before else None,
+            MatchCache.encode_node(source.before_contexts.context_tree.root, index) if source.before_contexts else None,
+            MatchCache.encode_node(source.after_contexts.context_tree.root, index) if source.after_contexts else None
+        ]
+        return hashlib.sha1(repr(info).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_key(source_hash, template_id, added):
+        return '{}:{}:{}'.format(source_hash, template_id, int(added))
+
+    def get(self, source, source_hash, template_id, added = False):
+        key = MatchCache.get_key(source_hash, template_id, added)
+        if key not in self.results:
+            self.misses += 1
+            return None
+        self.hits += 1
+        success, subtrees = self.results[key]
+        if subtrees != None:
+            nodes = list(source.before.iter_nodes())
+            subtrees = {c: [nodes[i] for i in subtrees[c]] for c in subtrees}
+        return success, subtrees
+
+    def put(self, source, source_hash, template_id, success, subtrees, added = False):
+        key = MatchCache.get_key(source_hash, template_id, added)
+        if isinstance(subtrees, dict):
+            positions = {}
+            for i, n in enumerate(source.before.iter_nodes()):
+                positions[n] = i
+            subtrees = {c: [positions[n] for n in subtrees[c]] for c in subtrees}
+        else:
+            subtrees = None
+        self.results[key] = [success, subtrees]
+        self.new_results[key] = self.results[key]
+
+    def merge(self, results):
+        for k in results:
+            self.results[k] = results[k]
+            self.new_results[k] = results[k]
+
+    def pop_new_results(self):
+        results = self.new_results
+        self.new_results = {}
+        return results
+
+    def save(self):
+        if self.cache_file == None:
+            return
+        with open(self.cache_file, 'w', encoding = 'utf-8') as cf:
+            cf.write(json.dumps({"signature": self.signature, "results": self.results}))
+        logger.info('Saved {} match results to {}, {} hits and {} misses in this run.'.format(len(self.results), self.cache_file, self.hits, self.misses))
@@ -6,20 +6,47 @@ from ast_operation import ASTNodeGenerator, ASTVisitor, ASTTransformer
 from change_tree import ChangeTree, ChangePair
 from fix_miner import ASTCompare, FixMiner
 from bug_locator import FunctionLocator
+from match_cache import MatchCache
+from blob_store import read_source
+from work_budget import Budget, BudgetExhausted
+import work_budget
 from __init__ import logger
 import traceback
 import random
 from tqdm import tqdm
 from copy import deepcopy
+import multiprocessing
+import time
+
+
+class PatchFound(Exception):
+    # Raised when a generated patch satisfies the condition given to run_one, stops applying the remaining templates
+    def __init__(self, index):
+        super().__init__('Patch #{} found'.format(index))
+        self.index = index
 
 
 class PatchGenerator(object):
-    def __init__(self, template_file, remove_comment = False):
+    def __init__(self, template_file, remove_comment = False, match_cache_file = None, template_budget = None, file_budget = None, max_patches = None, store = None):
         self.id2template = {}
         self.load_templates(template_file, min_instance_num = 5)
         self.format_templates()
+        self.index_contexts()
         self.remove_comment = remove_comment
         self.benchmark = 'bugsinpy'
+        self.match_cache = MatchCache(cache_file = match_cache_file, signature = MatchCache.file_signature(template_file))
+        # Budgets for applying a single template and all templates of a file, e.g., {"time": 60, "node_visits": 1000000, "match_states": 100000}
+        self.template_budget = template_budget
+        self.file_budget = file_budget
+        self.budget_report = {"templates": {}, "file": None}
+        # Stop generating patches for a location once this number of distinct patches are found, None means applying all selected templates
+        self.max_patches = max_patches
+        # Index of the patch that stopped the generation of the last file, see run_one
+        self.found_index = None
+        # Names and sources of the patch files of the last job run without dumping them, see run_job
+        self.patch_sources = []
+        # ResultsStore the patches of run_job are also written to, None only dumps them to files
+        self.store = store
 
 
     
@@ -119,6 +146,14 @@ class PatchGenerator(object):
                 self.id2template[i].after.replace('End_Expr', 'Expr', change_base_type = True, change_value = True)
                 self.id2template[i].after.replace('Identifier', 'Expr', change_base_type = True, change_value = True)
 
+    def index_contexts(self):
+        # Templates do not change during patch generation, so their context leaf paths are built only once
+        for i in self.id2template:
+            if self.id2template[i].before_contexts:
+                self.id2template[i].before_contexts.index_leaf_paths()
+            if self.id2template[i].after_contexts:
+                self.id2template[i].after_contexts.index_leaf_paths()
+
 
     def save_templates(self, filename):
         mined_info = {"templates": {}, "mined": {}}
@@ -267,6 +302,11 @@ class PatchGenerator(object):
                 source.id = 0
                 source.set_node_ids()
                 source.cal_self_reference()
+                # Leaf paths of the location are reused when matching all templates
+                if before_contexts:
+                    before_contexts.index_leaf_paths()
+                if after_contexts:
+                    after_contexts.index_leaf_paths()
                 parsed_info.append({
                     "change_stmts": [],
                     "source": source,
@@ -313,6 +353,11 @@ class PatchGenerator(object):
                 source.id = 0
                 source.set_node_ids()
                 source.cal_self_reference()
+                # Leaf paths of the location are reused when matching all templates
+                if before_contexts:
+                    before_contexts.index_leaf_paths()
+                if after_contexts:
+                    after_contexts.index_leaf_paths()
                 parsed_info.append({
                     "change_stmts": changed_stmts,
                     "source": source,
@@ -362,6 +407,16 @@ class PatchGenerator(object):
         else:
             return True, None
 
+    def match_template_cached(self, source, target, source_hash, added = False):
+        if source_hash == None:
+            return self.match_template(source, target, added = added)
+        cached = self.match_cache.get(source, source_hash, target.id, added = added)
+        if cached != None:
+            return cached
+        success, subtrees = self.match_template(source, target, added = added)
+        self.match_cache.put(source, source_hash, target.id, success, subtrees, added = added)
+        return success, subtrees
+
     def validate_template(self, subtrees, target):
         if target.before != None and target.after != None and target.within_context == None:
             if len(target.after.root.children['body']) != len(target.before.root.children['body']) and target.action != 'Insert':
@@ -393,29 +448,29 @@ class PatchGenerator(object):
         
         return True
 
-    def select_template(self, source, target, added = False):
+    def select_template(self, source, target, added = False, source_hash = None):
         templates = []
         if len(target.instances) == 1:
             return templates
         if not added:
-            success, subtrees = self.match_template(source, target)
+            success, subtrees = self.match_template_cached(source, target, source_hash)
             if success:
                 for i in target.child_templates:
                     if TemplateTree.compare(self.id2template[i].before_within, target.before_within) and target.after and self.id2template[i].after and TemplateNode.value_abstract_compare(self.id2template[i].after.root, target.after.root):
                         if target not in templates:
                             templates.append(target)
                         continue
-                    templates += self.select_template(source, self.id2template[i], added = added)
+                    templates += self.select_template(source, self.id2template[i], added = added, source_hash = source_hash)
                 if len(templates) == 0 and self.validate_template(subtrees, target):
                     templates.append(target)
         else:
             if target.before_within != None:
                 return templates
-            success, subtrees = self.match_template(source, target, added = True)
+            success, subtrees = self.match_template_cached(source, target, source_hash, added = True)
             if success:
                 if len(target.child_templates) > 0:
                     for i in target.child_templates:
-                        templates += self.select_template(source, self.id2template[i], added = added)
+                        templates += self.select_template(source, self.id2template[i], added = added, source_hash = source_hash)
                 else:
                     templates.append(target)
 
@@ -603,19 +658,21 @@ class PatchGenerator(object):
         for i in parsed_info:
             selected_templates = {}
             source = i["source"]
+            # Structurally identical locations share match results across locations and files
+            source_hash = MatchCache.hash_source(source)
             # Only Add templates will be matched
             if i['all_added']:
                 selected_templates['Add'] = []
                 for t in self.top_templates['Add']:
                     if self.id2template[t].before_within == None:
-                        selected_templates['Add'] += self.select_template(source, self.id2template[t], added = True)
+                        selected_templates['Add'] += self.select_template(source, self.id2template[t], added = True, source_hash = source_hash)
                 selected_templates['Add'] = self.group_templates(selected_templates['Add'], added = True)
                 selected_templates['Add'] = self.rank_templates(selected_templates['Add'], added = True)
             else:
                 for k in self.top_templates:
                     selected_templates[k] = []
                     for t in self.top_templates[k]:
-                        selected_templates[k] += self.select_template(source, self.id2template[t])
+                        selected_templates[k] += self.select_template(source, self.id2template[t], source_hash = source_hash)
                 for k in selected_templates:
                     selected_templates[k] = self.group_templates(selected_templates[k])
                     selected_templates[k] = self.rank_templates(selected_templates[k])
@@ -642,10 +699,18 @@ class PatchGenerator(object):
             for o in ori2new:
                 logger.debug('    From: {} to {}'.format(ast.dump(o), ast.dump(ori2new[o]) if ori2new[o] else None))
         
+    @staticmethod
+    def get_patch_sources(patches):
+        return [('Patch_{}_from_{}.py'.format(i, patches[p][1]), ast.unparse(patches[p][0])) for i, p in enumerate(patches)]
+
+    @staticmethod
+    def write_patch_sources(sources, filerepo):
+        for name, source in sources:
+            with open(os.path.join(filerepo, name), 'w', encoding = 'utf-8') as pf:
+                pf.write(source)
+
     def dump_patches(self, patches, filerepo):
-        for i, p in enumerate(patches):
-            with open(os.path.join(filerepo, 'Patch_{}_from_{}.py'.format(i, patches[p][1])), 'w', encoding = 'utf-8') as pf:
-                pf.write(ast.unparse(patches[p][0]))
+        PatchGenerator.write_patch_sources(PatchGenerator.get_patch_sources(patches), filerepo)
 
         
             
@@ -698,70 +763,136 @@ class PatchGenerator(object):
 
 
 
-    def implement_templates(self, parsed_info):
-        patches = {}
-        index = 0
-        for p in parsed_info:
-            #if 1838 not in p["buglines"]:
-            #    continue
-            templates = p["selected_templates"]
+    def iter_templates(self, templates, ranked = False):
+        # Yield selected templates of a location, with ranked = True the i-th ranked groups of all categories go before the (i+1)-th ones
+        if not ranked:
             for k in templates:
-                #if k != 'Add':
-                #    continue
                 for group in templates[k]:
                     for t in group:
-                        #if t.id != 13226:
-                        #    continue
-                        logger.debug(f'-----------------Implementing template #{t.id}----------------')
-                        if t.before_within != None:
-                            matched_subtrees, nodemaps = TemplateNode.subtrees_match_all(t.before_within.root, p["source"].before.root)
-                            self.print_matched_nodes(matched_subtrees, nodemaps, p)
-                            ori2news = []
-                            opnodes = []
-                            for i, sub in enumerate(matched_subtrees):
-                                try:
-                                    ast_generator = ASTNodeGenerator(sub, nodemaps[i], t)
-                                    ori2new, opnode = ast_generator.gen()
-                                    ori2news += ori2new
-                                    opnodes.append(opnode)
-                                except Exception as e:
-                                    logger.debug(f'Patch generation failed, reason: {e}, skipped.')
-                                    continue
-                        else:
-                            ori2news = []
-                            opnodes = []
-                            try:
-                                if int(p["added"][0]) == 1:
-                                    after = False
-                                else:
-                                    after = True
-                                ast_generator = ASTNodeGenerator(None, None, t, parent = p["parent"])
-                                ori2new, opnode = ast_generator.gen(after = after)
-                                ori2news += ori2new
-                                opnodes.append(opnode)
-                            except Exception as e:
-                                traceback.print_exc()
-                                logger.debug(f'Patch generation failed, reason: {e}, skipped.')
-                                continue
-                        #self.print_ast_changes(ori2news)
-                        cur_num = 0
-                        for i, ori2new in enumerate(ori2news):
-                            if cur_num > 20:
-                                logger.debug('Too many patches generated, select the first 20.')
-                                break
-                            logger.debug(f'Applying AST change #{i}')
-                            transformer = ASTTransformer(ori2new, opnodes[i], remove_comment = self.remove_comment)
-                            source, new_root = transformer.run(self.buggy_root)
-                            if source != None and source != self.formatted_buggy_source:
-                                #patches[source] = [new_root, t.id, t.action]
-                                patches[index] = [new_root, t.id, t.action, source]
-                                index += 1
-                                if 'VALUE_MASK VALUE_MASK VALUE_MASK' in source:
-                                    newsource = source.replace('VALUE_MASK VALUE_MASK VALUE_MASK', 'VALUE_MASK')
-                                    patches[index] = [new_root, t.id, t.action, newsource]
-                                    index += 1
-                                cur_num += 1
-        self.dump_patches(patches, 'patches/{}'.format(self.benchmark))
+                        yield k, t
+        else:
+            max_rank = max([len(templates[k]) for k in templates] + [0])
+            for r in range(0, max_rank):
+                for k in templates:
+                    if r < len(templates[k]):
+                        for t in templates[k][r]:
+                            yield k, t
+
+    def apply_template(self, p, t, patches, index, seen = None, until = None):
+        # seen - sources of the patches already generated for the location, only used with max_patches
+        # until - called with each new patch, PatchFound is raised once it returns True
+        logger.debug(f'-----------------Implementing template #{t.id}----------------')
+        if t.before_within != None:
+            matched_subtrees, nodemaps = TemplateNode.subtrees_match_all(t.before_within.root, p["source"].before.root)
+            self.print_matched_nodes(matched_subtrees, nodemaps, p)
+            ori2news = []
+            opnodes = []
+            for i, sub in enumerate(matched_subtrees):
+                work_budget.check()
+                try:
+                    ast_generator = ASTNodeGenerator(sub, nodemaps[i], t)
+                    ori2new, opnode = ast_generator.gen()
+                    ori2news += ori2new
+                    opnodes.append(opnode)
+                except BudgetExhausted:
+                    raise
+                except Exception as e:
+                    logger.debug(f'Patch generation failed, reason: {e}, skipped.')
+                    continue
+        else:
+            ori2news = []
+            opnodes = []
+            try:
+                if int(p["added"][0]) == 1:
+                    after = False
+                else:
+                    after = True
+                ast_generator = ASTNodeGenerator(None, None, t, parent = p["parent"])
+                ori2new, opnode = ast_generator.gen(after = after)
+                ori2news += ori2new
+                opnodes.append(opnode)
+            except BudgetExhausted:
+                raise
+            except Exception as e:
+                traceback.print_exc()
+                logger.debug(f'Patch generation failed, reason: {e}, skipped.')
+                return index
+        #self.print_ast_changes(ori2news)
+        cur_num = 0
+        for i, ori2new in enumerate(ori2news):
+            if cur_num > 20:
+                logger.debug('Too many patches generated, select the first 20.')
+                break
+            if seen != None and len(seen) >= self.max_patches:
+                break
+            work_budget.check()
+            logger.debug(f'Applying AST change #{i}')
+            transformer = ASTTransformer(ori2new, opnodes[i], remove_comment = self.remove_comment)
+            source, new_root = transformer.run(self.buggy_root)
+            if source != None and source != self.formatted_buggy_source:
+                if seen != None:
+                    if source in seen:
+                        logger.debug('Duplicated patch, skipped.')
+                        continue
+                    seen.add(source)
+                #patches[source] = [new_root, t.id, t.action]
+                patches[index] = [new_root, t.id, t.action, source]
+                index += 1
+                if until != None and until(patches[index - 1]):
+                    raise PatchFound(index - 1)
+                if 'VALUE_MASK VALUE_MASK VALUE_MASK' in source:
+                    newsource = source.replace('VALUE_MASK VALUE_MASK VALUE_MASK', 'VALUE_MASK')
+                    # The collapsed variant is a distinct patch too, so it must not exceed max_patches
+                    if seen == None or (newsource not in seen and len(seen) < self.max_patches):
+                        if seen != None:
+                            seen.add(newsource)
+                        patches[index] = [new_root, t.id, t.action, newsource]
+                        index += 1
+                        if until != None and until(patches[index - 1]):
+                            raise PatchFound(index - 1)
+                cur_num += 1
+        return index
+
+    def implement_templates(self, parsed_info, dump = True, until = None, file_budget = None):
+        # file_budget - budget of the file already charged by template selection, a new one from self.file_budget if None
+        patches = {}
+        index = 0
+        self.budget_report = {"templates": {}, "file": None}
+        self.found_index = None
+        if file_budget == None:
+            file_budget = Budget.from_config(self.file_budget)
+        try:
+            for p in parsed_info:
+                #if 1838 not in p["buglines"]:
+                #    continue
+                templates = p["selected_templates"]
+                seen = set() if self.max_patches != None else None
+                # Under a file budget or max_patches templates are applied in rank order so the best ranked ones are tried first
+                for k, t in self.iter_templates(templates, ranked = file_budget != None or self.max_patches != None):
+                    if seen != None and len(seen) >= self.max_patches:
+                        logger.debug('Found {} distinct patches at line #{}, remaining templates skipped.'.format(len(seen), p["buglines"]))
+                        break
+                    #if t.id != 13226:
+                    #    continue
+                    template_budget = Budget.from_config(self.template_budget, parent = file_budget)
+                    work_budget.activate(template_budget if template_budget != None else file_budget)
+                    try:
+                        index = self.apply_template(p, t, patches, index, seen = seen, until = until)
+                    except BudgetExhausted as e:
+                        if e.budget == file_budget:
+                            self.budget_report["file"] = dict(file_budget.usage(), template = t.id, stage = "application")
+                            raise
+                        self.budget_report["templates"][t.id] = e.budget.usage()
+                        logger.info('Budget of template #{} exhausted ({}) when generating patches for {}, skipped.'.format(t.id, e.reason, self.buggy_file))
+                    finally:
+                        work_budget.activate(None)
+        except BudgetExhausted as e:
+            logger.info('Budget of file {} exhausted ({}) at template #{}, remaining templates skipped.'.format(self.buggy_file, e.reason, self.budget_report["file"]["template"]))
+        except PatchFound as e:
+            logger.debug('Found the expected patch #{}, remaining templates skipped.'.format(e.index))
+            self.found_index = e.index
+        if dump:
+            self.dump_patches(patches, 'patches/{}'.format(self.benchmark))
         return patches
 
 
@@ -775,10 +906,14 @@ class PatchGenerator(object):
                 for g in p["selected_templates"][k]:
                     logger.debug("{}".format([(t.id, round(t.before_within.cal_abstract_ratio(), 2) if t.before_within else 0, len(t.instances)) for t in g]))
 
-    def run_one(self, buggy_file, buglines = None, added = None):
+    def run_one(self, buggy_file, buglines = None, added = None, dump = True, until = None):
+        # until - condition checked on each patch right after it is generated, generation stops at the first patch satisfying it,
+        # whose index is then kept in self.found_index
         #os.system('rm -rf figures2/*')
         logger.info('Generating patches for buggy file {}'.format(buggy_file))
         self.buggy_file = buggy_file
+        self.budget_report = {"templates": {}, "file": None}
+        self.found_index = None
         try:
             self.buggy_source = open(self.buggy_file, "r", encoding = "utf-8").read()
             self.buggy_root = ast.parse(self.buggy_source)
@@ -795,17 +930,26 @@ class PatchGenerator(object):
         #    self.draw_location(p, 'figures2')
         
         if len(parsed_info) > 0:
-            parsed_info = self.select_templates(parsed_info)
+            # Template selection runs the same matcher as template application, so it is charged to the file budget too
+            file_budget = Budget.from_config(self.file_budget)
+            work_budget.activate(file_budget)
+            try:
+                parsed_info = self.select_templates(parsed_info)
+            except BudgetExhausted as e:
+                self.budget_report["file"] = dict(file_budget.usage(), template = None, stage = "selection")
+                logger.info('Budget of file {} exhausted ({}) when selecting templates, no template applied.'.format(self.buggy_file, e.reason))
+                return {}
+            finally:
+                work_budget.activate(None)
             self.print_info(parsed_info)
-            patches = self.implement_templates(parsed_info)
+            patches = self.implement_templates(parsed_info, dump = dump, until = until, file_budget = file_budget)
             return patches
         else:
             return {}
         
 
-    def run_all(self, metafile, benchmark_path, benchmark = 'bugsinpy'):
-        self.benchmark = benchmark
-        metadata = json.loads(open(metafile, 'r', encoding = 'utf-8').read())
+    def collect_jobs(self, metadata, benchmark_path, benchmark = 'bugsinpy'):
+        jobs = []
         if benchmark == 'bugsinpy':
             for r in metadata:
                 for i in metadata[r]:
@@ -813,11 +957,14 @@ class PatchGenerator(object):
                     for f in metadata[r][i]['code_files']:
                         if not f.endswith('.py'):
                             continue
-                        buggy_file = os.path.join(path, f)
-                        patch_file = self.run_one(buggy_file, buglines = metadata[r][i]['buglines'][f], added = metadata[r][i]['added'][f])
-                        if patch_file == None:
-                            logger.error('Cannot generate patch files for buggy file {}.'.format(buggy_file))
-                            continue
+                        jobs.append({
+                            "instance": f'{r}-{i}',
+                            "name": f'{r}/{r}-{i}',
+                            "file": f,
+                            "buggy_file": os.path.join(path, f),
+                            "buglines": metadata[r][i]['buglines'][f],
+                            "added": metadata[r][i]['added'][f]
+                        })
         elif benchmark == 'typebugs':
             for r in metadata:
                 if r != 'numpy/numpy-9999':
@@ -826,8 +973,72 @@ class PatchGenerator(object):
                 for f in metadata[r]['code_files']:
                     if not f.endswith('.py'):
                         continue
-                    buggy_file = os.path.join(path, f)
-                    patches = self.run_one(buggy_file, buglines = metadata[r]['buglines'][f], added = metadata[r]['added'][f])
+                    jobs.append({
+                        "instance": r,
+                        "name": r,
+                        "file": f,
+                        "buggy_file": os.path.join(path, f),
+                        "buglines": metadata[r]['buglines'][f],
+                        "added": metadata[r]['added'][f]
+                    })
+        return jobs
+
+    def run_job(self, job, dump = True):
+        # dump - write the patch files, otherwise their names and sources are kept in self.patch_sources for the caller to write
+        start = time.time()
+        result = {"instance": job["instance"], "file": job["file"], "status": "succeed", "patch_num": 0, "reason": None}
+        self.patch_sources = []
+        try:
+            patches = self.run_one(job["buggy_file"], buglines = job["buglines"], added = job["added"], dump = dump)
+            if patches == None:
+                result["status"] = "failed"
+                result["reason"] = "Cannot parse buggy file."
+            else:
+                result["patch_num"] = len(patches)
+                if not dump:
+                    self.patch_sources = PatchGenerator.get_patch_sources(patches)
+                if self.store != None:
+                    self.store.add_patches(self.benchmark, job["name"], job["file"], job["file"], patches, buglines = job["buglines"], added = job["added"])
+            if len(self.budget_report["templates"]) > 0 or self.budget_report["file"] != None:
+                result["budget"] = self.budget_report
+        except Exception as e:
+            traceback.print_exc()
+            result["status"] = "failed"
+            result["reason"] = f"{e}"
+        result["time"] = time.time() - start
+        if result["status"] == "failed":
+            logger.error('Cannot generate patch files for buggy file {}.'.format(job["buggy_file"]))
+        return result
+
+    def run_all(self, metafile, benchmark_path, benchmark = 'bugsinpy', workers = 1):
+        self.benchmark = benchmark
+        metadata = json.loads(open(metafile, 'r', encoding = 'utf-8').read())
+        jobs = self.collect_jobs(metadata, benchmark_path, benchmark = benchmark)
+        results = []
+        if workers <= 1:
+            for job in jobs:
+                results.append(self.run_job(job))
+        else:
+            # Workers are forked after templates are loaded, so they share id2template copy-on-write
+            # Patch files of all jobs share one directory, workers return their sources and they are written here in job order as without workers
+            global _worker_generator
+            _worker_generator = self
+            filerepo = 'patches/{}'.format(self.benchmark)
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(processes = workers) as pool:
+                for result, sources, match_results in tqdm(pool.imap(_run_patch_job, jobs, chunksize = 1), total = len(jobs), desc = 'Generating patches'):
+                    PatchGenerator.write_patch_sources(sources, filerepo)
+                    results.append(result)
+                    self.match_cache.merge(match_results)
+            _worker_generator = None
+        self.match_cache.save()
+        
+        summary_path = 'patches/{}'.format(self.benchmark)
+        if not os.path.exists(summary_path):
+            os.system('mkdir -p {}'.format(summary_path))
+        with open(os.path.join(summary_path, 'summary.json'), 'w', encoding = 'utf-8') as sf:
+            sf.write(json.dumps(results, sort_keys=True, indent=4, separators=(',', ': ')))
+        return results
 
     def test_one(self, metadata, template):
         for index, i in enumerate(template.instances):
@@ -857,7 +1068,7 @@ class PatchGenerator(object):
             logger.info('Generating patches for buggy file {}'.format(buggy_file))
             self.buggy_file = buggy_file
             try:
-                self.buggy_root = ast.parse(open(self.buggy_file, "r", encoding = "utf-8").read())
+                self.buggy_root = ast.parse(read_source(self.buggy_file))
             except Exception as e:
                 logger.error('Cannot parse buggy file {}, reason: {}, skipped.'.format(self.buggy_file, e))
                 return None
@@ -904,6 +1115,12 @@ class PatchGenerator(object):
         
 
 
+_worker_generator = None
+
+def _run_patch_job(job):
+    result = _worker_generator.run_job(job, dump = False)
+    return result, _worker_generator.patch_sources, _worker_generator.match_cache.pop_new_results()
+
 
 if __name__ == "__main__":
     generator = PatchGenerator('large_mined_templates.json')
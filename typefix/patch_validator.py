@@ -0,0 +1,84 @@
+from code_layout import CodeLayout
+
+
+
+def validate_predictions(patch_data, predictions, mask_all = False):
+    # Fill the masks of a codet5 prompt with each prediction and return the masked code of the ones that can be parsed
+    # It only depends on patch_data so that it can run in worker processes
+    pred_code = []
+    # The original masked lines are valid code in both modes since VALUE_MASK is a name
+    layout = CodeLayout(patch_data["code"]["pre_code"], patch_data["code"]["masked_code"], patch_data["code"]["post_code"])
+    for pred in predictions:
+        #print(pred)
+        curpred = pred
+        pred_map = {}
+        failed = False
+        for i in range(0, patch_data["prompt"]["max_mask_id"]):
+            if f"<extra_id_{i}>" not in curpred:
+                failed = True
+                break
+            else:
+                items = curpred.split(f"<extra_id_{i}>")
+                if len(items) != 2:
+                    failed = True
+                    break
+                prefix, curpred = items
+                if i != 0:
+                    pred_map[i-1] = prefix
+        if failed:
+            continue
+        if "<extra_id" not in curpred:
+            pred_map[patch_data["prompt"]["max_mask_id"] - 1] = curpred
+        else:
+            pred_map[patch_data["prompt"]["max_mask_id"] - 1] = curpred.split("<extra_id_{}>".format(patch_data["prompt"]["max_mask_id"]))[0]
+        if not mask_all:
+            masked_code = "\n".join(patch_data["prompt"]["masked_lines"])
+            for i in pred_map:
+                masked_code = masked_code.replace(f"<extra_id_{i}>", pred_map[i])
+            if layout.is_valid(masked_code):
+                pred_code.append(masked_code)
+        else:
+            # Indent the predicted lines as the surrounding blocks allow, try all 4 levels of each line if it cannot be inferred
+            masked_code = layout.infer_layouts([pred_map[p] for p in pred_map])
+            if masked_code != None:
+                for c in set(masked_code):
+                    if layout.is_valid(c):
+                        pred_code.append(c)
+                continue
+            # Lines that are not complete logical lines may pair with code outside the enclosing function, parse the whole file for them
+            masked_code = [""]
+            for p in pred_map:
+                new_masked_code = []
+                for i in range(0, 4):
+                    if i > 0:
+                        for c in masked_code:
+                            if len(c) != 0:
+                                new_masked_code.append(c + "\n" + "    " * i + pred_map[p])
+                            else:
+                                new_masked_code.append(c + "    " * i + pred_map[p])
+                    else:
+                        for c in masked_code:
+                            if len(c) != 0:
+                                new_masked_code.append(c + "\n" + pred_map[p])
+                            else:
+                                new_masked_code.append(c + pred_map[p])
+                masked_code = new_masked_code
+                new_masked_code = [""]
+
+            masked_code = list(set(masked_code))
+            for c in masked_code:
+                if layout.is_valid(c, whole = True):
+                    pred_code.append(c)
+
+        #with open("patch.py", "w", encoding = "utf-8") as pf:
+        #    pf.write(patch)
+        #exit()
+    return pred_code
+
+
+def get_patches(patch_data, predictions, mask_all = False):
+    patches = {}
+    for p in validate_predictions(patch_data, predictions, mask_all = mask_all):
+        if p not in patches:
+            patches[p] = 2
+    return patches
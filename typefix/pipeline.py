@@ -0,0 +1,130 @@
+import os
+import json
+import ast
+import queue
+import threading
+import traceback
+from tqdm import tqdm
+from patch_generator import PatchGenerator
+from repair import Prompt
+from __init__ import logger
+
+
+
+class RepairPipeline(object):
+    # Runs patch generation, prompt building, model inference and validation of buggy files as four stages connected by bounded queues.
+    # Each stage runs in its own thread, so AST work of the other stages overlaps with decoding, which releases the GIL inside torch.
+    def __init__(self, generator, prompt, queue_size = 4):
+        self.generator = generator
+        self.prompt = prompt
+        self.queue_size = queue_size
+        self.failed_cases = []
+        self.lock = threading.Lock()
+
+    def fail(self, job, e):
+        traceback.print_exc()
+        logger.error(f'Error occurred: {e}')
+        with self.lock:
+            self.failed_cases.append([job["instance"], job["file"], job["buggy_file_name"], f"{e}"])
+
+    def generate_stage(self, jobs, out_queue):
+        for job in jobs:
+            try:
+                patches = self.generator.run_one(job["buggy_file"], buglines = job["buglines"], added = job["added"], dump = False)
+                if patches == None:
+                    raise ValueError('Cannot parse buggy file {}.'.format(job["buggy_file"]))
+                if self.generator.store != None:
+                    self.generator.store.add_patches(job["benchmark"], job["instance"], job["file"], job["buggy_file_name"], patches, buglines = job["buglines"], added = job["added"])
+                # Same file names and contents as PatchGenerator.dump_patches
+                patch_sources = {}
+                for i, p in enumerate(patches):
+                    patch_sources['Patch_{}_from_{}.py'.format(i, patches[p][1])] = ast.unparse(patches[p][0])
+                out_queue.put((job, patch_sources))
+            except Exception as e:
+                self.fail(job, e)
+        out_queue.put(None)
+
+    def prompt_stage(self, in_queue, out_queue):
+        while True:
+            item = in_queue.get()
+            if item == None:
+                break
+            job, patch_sources = item
+            try:
+                old_code, buggy_code = self.prompt.get_buggy_code(job["buggy_file"], job["buglines"])
+                patch_data, pending = self.prompt.prepare_patch_data(patch_sources, buggy_code)
+                out_queue.put((job, patch_data, pending))
+            except Exception as e:
+                self.fail(job, e)
+        out_queue.put(None)
+
+    def inference_stage(self, in_queue, out_queue):
+        while True:
+            item = in_queue.get()
+            if item == None:
+                break
+            job, patch_data, pending = item
+            try:
+                if self.prompt.adaptive != None:
+                    # The adaptive policy validates while decoding
+                    self.prompt.predict_all(pending)
+                    predictions = None
+                else:
+                    predictions = self.prompt.decode_prompts([p["prompt"] for p in pending])
+                out_queue.put((job, patch_data, pending, predictions))
+            except Exception as e:
+                self.fail(job, e)
+        out_queue.put(None)
+
+    def validate_stage(self, in_queue, progress):
+        while True:
+            item = in_queue.get()
+            if item == None:
+                break
+            job, patch_data, pending, predictions = item
+            try:
+                if predictions != None:
+                    for p, sub_predictions in zip(pending, predictions):
+                        p["patches"] = self.prompt.validate_predictions(p, sub_predictions)
+                self.prompt.write_result(job, patch_data, store = self.prompt.store)
+            except Exception as e:
+                self.fail(job, e)
+            progress.update(1)
+
+    def run(self, jobs):
+        queues = [queue.Queue(maxsize = self.queue_size) for i in range(0, 3)]
+        progress = tqdm(total = len(jobs), desc = 'Repairing buggy files')
+        threads = [
+            threading.Thread(target = self.generate_stage, args = (jobs, queues[0])),
+            threading.Thread(target = self.prompt_stage, args = (queues[0], queues[1])),
+            threading.Thread(target = self.inference_stage, args = (queues[1], queues[2])),
+            threading.Thread(target = self.validate_stage, args = (queues[2], progress))
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        progress.close()
+        return self.failed_cases
+
+    def run_all(self, metafile, benchmark_path, final_patch_path, benchmark = 'bugsinpy'):
+        metadata = json.loads(open(metafile, 'r', encoding = 'utf-8').read())
+        self.generator.benchmark = benchmark
+        jobs, failed_cases = self.prompt.collect_jobs(metadata, 'patches/{}'.format(benchmark), benchmark_path, final_patch_path, benchmark = benchmark)
+        self.failed_cases = failed_cases
+        self.run(jobs)
+        self.generator.match_cache.save()
+        if not os.path.exists(final_patch_path):
+            os.system('mkdir -p {}'.format(final_patch_path))
+        with open(os.path.join(final_patch_path, "failed_cases.json"), "w", encoding = "utf-8") as ff:
+            ff.write(json.dumps(self.failed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
+        if self.prompt.store != None:
+            self.prompt.store.set_failures(benchmark, 'prompt', self.failed_cases)
+        return self.failed_cases
+
+
+
+if __name__ == "__main__":
+    pipeline = RepairPipeline(PatchGenerator('large_mined_templates.json'), Prompt())
+    pipeline.run_all("benchmarks/all_bug_info_typebugs.json", "benchmarks/typebugs", "prompt_patches/typebugs", benchmark = "typebugs")
+    pipeline.run_all("benchmarks/all_bug_info_bugsinpy.json", "benchmarks/bugsinpy", "prompt_patches/bugsinpy", benchmark = "bugsinpy")
@@ -0,0 +1,416 @@
+import os
+import re
+import ast
+import json
+import time
+import shutil
+import signal
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
+from tqdm import tqdm
+from evaluate import collect_instances, get_buggy_files, load_results
+from bug_locator import FunctionLocator
+from __init__ import logger
+try:
+    from coverage import CoverageData
+except ImportError:
+    CoverageData = None
+
+
+
+# Harness used by the worker processes, set before they are forked
+_worker_harness = None
+
+def _validate_job(job):
+    try:
+        return job, _worker_harness.validate(job), None
+    except Exception as e:
+        return job, None, f"{e}"
+
+
+def _check_instance(job):
+    try:
+        return job, _worker_harness.check(job), None
+    except Exception as e:
+        return job, None, f"{e}"
+
+
+def _cover_instance(instance):
+    try:
+        return instance, _worker_harness.cover(instance), None
+    except Exception as e:
+        return instance, None, f"{e}"
+
+
+# pytest invocation of a test command, run under coverage in the coverage pass
+PYTEST_COMMAND = re.compile(r'(^|\s)(python3? -m )?pytest(?=\s|$)')
+# Exit codes of pytest meaning that the tests did not run, rather than that they failed
+# 2 is also returned for collection errors, which a candidate can cause, so it only counts as an error on the buggy version
+PYTEST_ERRORS = [3, 4, 5]
+PYTEST_BASELINE_ERRORS = [2, 3, 4, 5]
+
+
+class PlausibilityHarness(object):
+    # Runs the test.sh of benchmark instances against candidate patches locally, each candidate in its own temporary copy of the project.
+    # Candidates are validated in parallel, the tests of a candidate stop at the first failure and outcomes are cached by (instance, patch hash).
+    # No dependency is installed, the tests run with the packages of the current environment, and instances whose tests cannot run on
+    # their buggy version are not validated.
+    # With coverage_guided, a coverage pass on the buggy version of each instance maps its tests to the lines they execute, and the tests covering
+    # the function changed by a candidate are run first, the rest of the suite is only run for candidates passing them.
+    def __init__(self, benchmark_path, benchmark = 'bugsinpy', env_paths = {}, workers = None, timeout = 300, cache_file = None, tmp_dir = None, coverage_guided = True, coverage_file = None, store = None):
+        # env_paths - prepared project directory of each repo, e.g., a full checkout of the buggy version, the benchmark instance is copied over it
+        #             the benchmark instance alone is used for repos without one
+        # timeout - seconds allowed for each test command of test.sh
+        # cache_file - jsonl log of validated candidates, candidates already in it are not run again
+        # tmp_dir - where temporary copies of projects are created, the system default if None
+        # coverage_file - json file of the executed lines of each test of each instance, instances already in it are not covered again
+        # store - ResultsStore the plausible patches are also written to
+        self.benchmark_path = benchmark_path
+        self.benchmark = benchmark
+        self.env_paths = env_paths
+        self.workers = workers if workers != None else (os.cpu_count() or 1)
+        self.timeout = timeout
+        self.cache_file = cache_file
+        self.tmp_dir = tmp_dir
+        self.coverage_guided = coverage_guided
+        self.coverage_file = coverage_file
+        self.store = store
+        # instance key -> test command -> code file -> executed lines, None if the lines of a test are unknown
+        self.coverage = {}
+        # Ranges of the functions changed by candidates, keyed by instance, code file and buglines
+        self.function_ranges = {}
+
+    @staticmethod
+    def hash_patch(source):
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_tests(instance_path):
+        # Each non-empty line of test.sh is a test command
+        test_file = os.path.join(instance_path, 'test.sh')
+        if not os.path.exists(test_file):
+            return []
+        tests = []
+        for line in open(test_file, 'r', encoding = 'utf-8').read().splitlines():
+            if len(line.strip()) > 0 and not line.strip().startswith('#'):
+                tests.append(line.strip())
+        return tests
+
+    def collect_candidates(self, instance, final_patch_path, ori_patch_path, buggy_files = None):
+        # Patched sources of all validated patches of an instance, in the layout evaluate_exactmatch reads them
+        # buggy_files - only collect candidates of these buggy files if not None
+        entry = instance["entry"]
+        candidates = []
+        for f in entry['code_files']:
+            if not f.endswith('.py'):
+                continue
+            for bf in get_buggy_files(entry, f):
+                if buggy_files != None and bf not in buggy_files:
+                    continue
+                patch_file_path = os.path.join(final_patch_path, *instance["result_dir"], bf.replace('/', '_').replace('.py', '.json'))
+                if not os.path.exists(patch_file_path):
+                    continue
+                patch = json.loads(open(patch_file_path, "r").read())
+                hashes = {}
+                for p in patch:
+                    if p == "buggy_code" or "patches" not in patch[p]:
+                        continue
+                    buggy_source = None
+                    if "code" in patch[p]:
+                        ori_patch_file_path = os.path.join(ori_patch_path, *instance["ori_dir"], (instance["ori_prefix"] + bf).replace('/', '_'), p)
+                        buggy_source = open(ori_patch_file_path, "r").read()
+                        masked_line = "\n".join(patch[p]["code"]["masked_code"])
+                        if masked_line not in buggy_source:
+                            logger.error("Cannot find the masked lines in pre-patch.")
+                            continue
+                    for index, c in enumerate(patch[p]["patches"]):
+                        source = c if buggy_source == None else buggy_source.replace(masked_line, c)
+                        try:
+                            ast.parse(source)
+                        except Exception as e:
+                            logger.debug(f'Cannot parse patched source, reason: {e}')
+                            continue
+                        patch_hash = PlausibilityHarness.hash_patch(source)
+                        if patch_hash in hashes:
+                            continue
+                        hashes[patch_hash] = True
+                        candidates.append({
+                            "key": "{}:{}".format(instance["key"], patch_hash),
+                            "instance": instance["key"],
+                            "name": "/".join(instance["result_dir"]),
+                            "repo": instance["r"].split("/")[0],
+                            "path": instance["path"],
+                            "file": f,
+                            "buggy_file": bf,
+                            "patch": p,
+                            "index": index,
+                            "buglines": entry["buglines"].get(bf, []),
+                            "source": source
+                        })
+        return candidates
+
+    def prepare(self, job):
+        # Temporary copy of the project with the patched file, the buggy version if job has no source
+        workdir = tempfile.mkdtemp(prefix = 'typefix_', dir = self.tmp_dir)
+        project = os.path.join(workdir, 'project')
+        if job["repo"] in self.env_paths:
+            shutil.copytree(self.env_paths[job["repo"]], project, symlinks = True)
+            shutil.copytree(job["path"], project, symlinks = True, dirs_exist_ok = True, ignore = shutil.ignore_patterns('correct'))
+        else:
+            shutil.copytree(job["path"], project, symlinks = True, ignore = shutil.ignore_patterns('correct'))
+        if job.get("source") != None:
+            with open(os.path.join(project, job["file"]), 'w', encoding = 'utf-8') as pf:
+                pf.write(job["source"])
+        return workdir, project
+
+    def run_test(self, command, cwd, extra_env = {}, exitfirst = True, errors = PYTEST_ERRORS):
+        # Return (status, output) of one test command, the whole process group is killed on timeout
+        # exitfirst - stop pytest at the first failed test of the command
+        # errors - exit codes of pytest commands reported as "error", e.g., no tests collected
+        env = dict(os.environ)
+        env.update(extra_env)
+        env["PYTEST_ADDOPTS"] = (env.get("PYTEST_ADDOPTS", "") + (" -x" if exitfirst else "") + " -p no:cacheprovider").strip()
+        env["PYTHONDONTWRITEBYTECODE"] = "1"
+        process = subprocess.Popen(command, shell = True, cwd = cwd, env = env, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, start_new_session = True)
+        try:
+            output = process.communicate(timeout = self.timeout)[0]
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            output = process.communicate()[0]
+            return "timeout", output.decode('utf-8', errors = 'replace')
+        if process.returncode == 0:
+            return "passed", output.decode('utf-8', errors = 'replace')
+        if process.returncode in errors and PYTEST_COMMAND.search(command) != None:
+            return "error", output.decode('utf-8', errors = 'replace')
+        return "failed", output.decode('utf-8', errors = 'replace')
+
+    def check(self, job):
+        # Run the tests of the buggy version of the instance of a candidate, return why they cannot run, None if they can
+        tests = PlausibilityHarness.get_tests(job["path"])
+        if len(tests) == 0:
+            return "No test found."
+        workdir, project = self.prepare({"repo": job["repo"], "path": job["path"]})
+        try:
+            for test in tests:
+                status, output = self.run_test(test, project, errors = PYTEST_BASELINE_ERRORS)
+                if status in ["error", "timeout"]:
+                    return "Test {} ends with {} on the buggy version: {}".format(test, status, output[-500:])
+        finally:
+            shutil.rmtree(workdir, ignore_errors = True)
+        return None
+
+    def cover(self, instance):
+        # Executed lines of the code files of an instance for each of its tests, measured on the buggy version
+        tests = PlausibilityHarness.get_tests(instance["path"])
+        workdir, project = self.prepare({"repo": instance["r"].split("/")[0], "path": instance["path"]})
+        coverage = {}
+        try:
+            for i, test in enumerate(tests):
+                coverage[test] = None
+                if PYTEST_COMMAND.search(test) == None:
+                    continue
+                data_file = os.path.join(workdir, 'coverage_{}'.format(i))
+                command = PYTEST_COMMAND.sub(lambda m: m.group(1) + 'python -m coverage run -m pytest', test, count = 1)
+                status, output = self.run_test(command, project, extra_env = {"COVERAGE_FILE": data_file}, exitfirst = False)
+                if status == "timeout" or not os.path.exists(data_file):
+                    logger.debug('Cannot measure the coverage of test {} in Case#{}, it always runs.'.format(test, instance["key"]))
+                    continue
+                data = CoverageData(basename = data_file)
+                data.read()
+                coverage[test] = {}
+                for f in instance["entry"]["code_files"]:
+                    lines = data.lines(os.path.realpath(os.path.join(project, f)))
+                    coverage[test][f] = sorted(lines) if lines != None else []
+        finally:
+            shutil.rmtree(workdir, ignore_errors = True)
+        return coverage
+
+    def get_function_range(self, job):
+        # Rows of the body of the function containing the buglines of a candidate in the buggy version, None if they are not within a function
+        # The header is left out since it is executed whenever the module is imported
+        key = (job["instance"], job["file"], tuple(job["buglines"]))
+        if key not in self.function_ranges:
+            self.function_ranges[key] = None
+            if len(job["buglines"]) > 0:
+                root = ast.parse(open(os.path.join(job["path"], job["file"]), 'r', encoding = 'utf-8').read())
+                node = FunctionLocator().run(root, job["buglines"])
+                if type(node) in [ast.FunctionDef, ast.AsyncFunctionDef]:
+                    self.function_ranges[key] = [node.body[0].lineno, node.end_lineno]
+        return self.function_ranges[key]
+
+    def order_tests(self, job, tests):
+        # Tests covering the changed function first, followed by the rest of the suite
+        # Tests of unknown coverage count as covering, all tests do if the changed function or the coverage of the instance is unknown
+        coverage = self.coverage.get(job["instance"])
+        if coverage == None:
+            return tests, []
+        function_range = self.get_function_range(job)
+        if function_range == None:
+            return tests, []
+        covering = []
+        rest = []
+        for test in tests:
+            lines = coverage.get(test)
+            if lines == None or len([l for l in lines.get(job["file"], []) if l >= function_range[0] and l <= function_range[1]]) > 0:
+                covering.append(test)
+            else:
+                rest.append(test)
+        return covering, rest
+
+    def validate(self, job):
+        # Run the tests of a candidate until the first failed one
+        start = time.time()
+        tests = PlausibilityHarness.get_tests(job["path"])
+        if len(tests) == 0:
+            return {"status": "error", "test": None, "output": "No test found.", "time": 0}
+        covering, rest = self.order_tests(job, tests)
+        workdir, project = self.prepare(job)
+        try:
+            for test in covering + rest:
+                status, output = self.run_test(test, project)
+                if status != "passed":
+                    return {"status": status, "test": test, "covering": len(covering), "output": output[-2000:], "time": time.time() - start}
+        finally:
+            shutil.rmtree(workdir, ignore_errors = True)
+        return {"status": "plausible", "test": None, "covering": len(covering), "output": None, "time": time.time() - start}
+
+    def map_coverage(self, instances):
+        # Run the coverage pass of the instances not in coverage_file on a pool of workers
+        if self.coverage_file != None and os.path.exists(self.coverage_file):
+            self.coverage = json.loads(open(self.coverage_file, 'r', encoding = 'utf-8').read())
+        todo = [ins for ins in instances if ins["key"] not in self.coverage]
+        if len(todo) == 0:
+            return
+        logger.info('Measuring the test coverage of {} instances.'.format(len(todo)))
+        for ins, result, error in self.imap(_cover_instance, todo, 'Covering Instances'):
+            if error != None:
+                logger.error('Error occurred when covering instance {}, reason: {}, run all of its tests instead.'.format(ins["key"], error))
+                continue
+            self.coverage[ins["key"]] = result
+        if self.coverage_file != None:
+            if not os.path.exists(os.path.dirname(os.path.abspath(self.coverage_file))):
+                os.system('mkdir -p {}'.format(os.path.dirname(os.path.abspath(self.coverage_file))))
+            with open(self.coverage_file, 'w', encoding = 'utf-8') as cf:
+                cf.write(json.dumps(self.coverage, sort_keys=True, indent=4, separators=(',', ': ')))
+
+    def imap(self, func, items, desc):
+        # Yield func(item) for the items in any order, on a pool of forked workers if workers > 1
+        global _worker_harness
+        _worker_harness = self
+        pool = None
+        if self.workers > 1 and len(items) > 1:
+            pool = multiprocessing.get_context('fork').Pool(processes = self.workers)
+            iterator = pool.imap_unordered(func, items, chunksize = 1)
+        else:
+            iterator = map(func, items)
+        try:
+            for result in tqdm(iterator, total = len(items), desc = desc):
+                yield result
+        finally:
+            if pool != None:
+                pool.terminate()
+                pool.join()
+            _worker_harness = None
+
+    def check_instances(self, jobs):
+        # Reasons why the tests of the instances of the candidates cannot run, by instance key
+        instances = {}
+        for job in jobs:
+            if job["instance"] not in instances:
+                instances[job["instance"]] = job
+        broken = {}
+        for job, reason, error in self.imap(_check_instance, list(instances.values()), 'Checking Instances'):
+            if error != None:
+                reason = error
+            if reason != None:
+                logger.error('Cannot run the tests of Case#{}, reason: {}, its candidates are not validated.'.format(job["instance"], reason))
+                broken[job["instance"]] = reason
+        return broken
+
+    def run(self, jobs):
+        # Validate the candidates not in the cache on a pool of workers, return the outcomes of all candidates by key
+        # Candidates whose tests cannot run are reported with status "error" and are not cached
+        cached = load_results(self.cache_file)
+        todo = [job for job in jobs if job["key"] not in cached]
+        logger.info('Validating {} of {} candidates, the others are cached.'.format(len(todo), len(jobs)))
+        errors = {}
+        broken = self.check_instances(todo)
+        for job in todo:
+            if job["instance"] in broken:
+                errors[job["key"]] = {"status": "error", "test": None, "output": broken[job["instance"]], "time": 0}
+        todo = [job for job in todo if job["instance"] not in broken]
+        log = None
+        if self.cache_file != None:
+            if not os.path.exists(os.path.dirname(os.path.abspath(self.cache_file))):
+                os.system('mkdir -p {}'.format(os.path.dirname(os.path.abspath(self.cache_file))))
+            log = open(self.cache_file, 'a', encoding = 'utf-8')
+        try:
+            for job, result, error in self.imap(_validate_job, todo, 'Validating Candidates'):
+                if error != None:
+                    logger.error('Error occurred when validating patch #{} of {} in File#{} of Case#{}, reason: {}, skipped.'.format(job["index"], job["patch"], job["buggy_file"], job["instance"], error))
+                    continue
+                if result["status"] == "error":
+                    errors[job["key"]] = result
+                    continue
+                cached[job["key"]] = {"key": job["key"], "result": result}
+                if log != None:
+                    log.write(json.dumps(cached[job["key"]]) + '\n')
+                    log.flush()
+        finally:
+            if log != None:
+                log.close()
+        results = {job["key"]: cached[job["key"]]["result"] for job in jobs if job["key"] in cached}
+        results.update(errors)
+        return results
+
+    def run_all(self, metafile, final_patch_path, ori_patch_path, failed_file = None):
+        # failed_file - only validate the buggy files listed in it, e.g., exactmatch_failed_cases.json
+        metadata = json.loads(open(metafile, "r", encoding = "utf-8").read())
+        if self.cache_file == None:
+            self.cache_file = os.path.join(final_patch_path, "plausibility_cache.jsonl")
+        selected = None
+        if failed_file != None:
+            selected = {}
+            for c in json.loads(open(failed_file, "r", encoding = "utf-8").read()):
+                selected.setdefault(c[0], []).append(c[1])
+        jobs = []
+        instances = []
+        for ins in collect_instances(metadata, self.benchmark_path, benchmark = self.benchmark):
+            if selected != None and ins["key"] not in selected:
+                continue
+            candidates = self.collect_candidates(ins, final_patch_path, ori_patch_path, buggy_files = selected[ins["key"]] if selected != None else None)
+            if len(candidates) > 0:
+                instances.append(ins)
+                jobs += candidates
+        if self.coverage_guided:
+            if CoverageData == None:
+                logger.warning('Package coverage is not installed, run all tests of each candidate in their original order.')
+            else:
+                if self.coverage_file == None:
+                    self.coverage_file = os.path.join(final_patch_path, "test_coverage.json")
+                self.map_coverage(instances)
+        results = self.run(jobs)
+        plausible_cases = []
+        evaluations = []
+        files = {}
+        for job in jobs:
+            files[(job["instance"], job["buggy_file"])] = True
+            if job["key"] in results and results[job["key"]]["status"] == "plausible":
+                plausible_cases.append([job["instance"], job["buggy_file"], job["patch"], job["index"]])
+                evaluations.append([job["name"], "succeed", plausible_cases[-1]])
+        if self.store != None:
+            self.store.set_evaluations(self.benchmark, "plausibility", evaluations)
+        with open(os.path.join(final_patch_path, "plausible_cases.json"), "w", encoding = "utf-8") as pf:
+            pf.write(json.dumps(plausible_cases, sort_keys=True, indent=4, separators=(',', ': ')))
+        logger.info("Totally {} buggy files, {} plausible patches for {} buggy files.".format(len(files), len(plausible_cases), len(set([(c[0], c[1]) for c in plausible_cases]))))
+        return results
+
+
+
+if __name__ == "__main__":
+    harness = PlausibilityHarness('benchmarks/typebugs', benchmark = 'typebugs')
+    harness.run_all('benchmarks/all_bug_info_typebugs.json', 'prompt_patches/typebugs', 'patches/typebugs', failed_file = 'prompt_patches/typebugs/exactmatch_failed_cases.json')
+    harness = PlausibilityHarness('benchmarks/bugsinpy', benchmark = 'bugsinpy')
+    harness.run_all('benchmarks/all_bug_info_bugsinpy.json', 'prompt_patches/bugsinpy', 'patches/bugsinpy', failed_file = 'prompt_patches/bugsinpy/exactmatch_failed_cases.json')
@@ -0,0 +1,50 @@
+import os
+import json
+import hashlib
+from __init__ import logger
+
+
+
+class PredictionCache(object):
+    def __init__(self, cache_dir = None):
+        # cache_dir - directory keeping the raw predictions of each prompt in a json file, None only keeps them during the run
+        self.cache_dir = cache_dir
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir != None and not os.path.exists(self.cache_dir):
+            os.system('mkdir -p {}'.format(self.cache_dir))
+
+    @staticmethod
+    def get_key(model_id, prompt, settings):
+        # settings - decoding settings that change the predictions, e.g., beam number and length range
+        return hashlib.sha1(json.dumps([model_id, prompt, settings], sort_keys = True).encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], '{}.json'.format(key))
+
+    def get(self, key):
+        if key in self.results:
+            self.hits += 1
+            return self.results[key]
+        if self.cache_dir != None and os.path.exists(self.get_path(key)):
+            try:
+                self.results[key] = json.loads(open(self.get_path(key), 'r', encoding = 'utf-8').read())
+                self.hits += 1
+                return self.results[key]
+            except Exception as e:
+                logger.error('Cannot load cached predictions {}, reason: {}, ignored.'.format(self.get_path(key), e))
+        self.misses += 1
+        return None
+
+    def put(self, key, predictions):
+        self.results[key] = predictions
+        if self.cache_dir == None:
+            return
+        path = self.get_path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.system('mkdir -p {}'.format(os.path.dirname(path)))
+        # Write to a temporary file of this process first so that a crash or another process writing the same key never leaves a partial entry
+        with open('{}.{}.tmp'.format(path, os.getpid()), 'w', encoding = 'utf-8') as pf:
+            pf.write(json.dumps(predictions))
+        os.replace('{}.{}.tmp'.format(path, os.getpid()), path)
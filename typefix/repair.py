@@ -1,30 +1,50 @@
 import os
 import json
-import torch
-import ast
 from tqdm import tqdm
-from transformers import RobertaTokenizer, RobertaForMaskedLM, T5ForConditionalGeneration
-from beam_search import BeamSearch
+from inference_backend import TorchBackend, default_device
+from prediction_cache import PredictionCache
+from patch_validator import validate_predictions, get_patches
 from __init__ import logger
 import timeout_decorator
 import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 
 from patch_generator import PatchGenerator
 os.environ["CUDA_VISIBLE_DEVICES"] = "0,1,2,3"
 
-DEVICE = "cuda:1" if torch.cuda.is_available() else "cpu"
-
 
 class Prompt(object):
-    def __init__(self):
+    def __init__(self, single_pass = True, batch_size = 8, max_batch_tokens = None, num_threads = None, prediction_cache_dir = None, validation_workers = 0, backend = None, adaptive = None, store = None):
+        # backend - InferenceBackend decoding the prompts, the fp32 TorchBackend built from single_pass, batch_size and max_batch_tokens if None
+        # adaptive - AdaptiveDecoding policy deciding the beam widths and lengths of each prompt, None decodes all lengths with backend.num_beams beams
+        # store - ResultsStore the final patch files and failed cases are also written to
         #self.model = RobertaForMaskedLM.from_pretrained("microsoft/codebert-base-mlm", cache_dir = './transformers').to(DEVICE)
         #self.tokenizer = RobertaTokenizer.from_pretrained("microsoft/codebert-base-mlm", cache_dir = './transformers')
-        self.model = T5ForConditionalGeneration.from_pretrained("Salesforce/codet5-base", cache_dir = './transformers').to(DEVICE)
-        #self.model = torch.load("/data/pengyun/typefix/models/typefix_3.bin", map_location = "cuda:1")
-        self.tokenizer = RobertaTokenizer.from_pretrained("Salesforce/codet5-base", cache_dir = './transformers')
+        if backend == None:
+            backend = TorchBackend(single_pass = single_pass, batch_size = batch_size, max_batch_tokens = max_batch_tokens)
+        self.backend = backend
+        self.model = backend.model
+        self.tokenizer = backend.tokenizer
         self.mask_token = '<mask>'
         self.model_type = "codet5"
+        # Raw predictions of each distinct prompt, kept on disk if prediction_cache_dir is given so that re-runs only validate them
+        self.prediction_cache = PredictionCache(cache_dir = prediction_cache_dir)
+        # Number of processes validating predictions while the next batch is decoded, 0 validates in this process
+        self.validation_workers = validation_workers
+        self.validation_pool = None
+        self.adaptive = adaptive
+        self.store = store
+        if num_threads != None:
+            import torch
+            torch.set_num_threads(num_threads)
+
+    def __getstate__(self):
+        # The validation pool cannot be sent to other processes, they create their own
+        state = self.__dict__.copy()
+        state["validation_pool"] = None
+        return state
 
     def process_file(self, patch_source, buggy_lines = None, added = None):
         if buggy_lines == None:
@@ -65,6 +85,42 @@ class Prompt(object):
         }
 
     
+    def count_tokens(self, text):
+        return self.backend.count_tokens(text)
+
+    def fit_linesize(self, build_input, code, fixed_input, limit, max_linesize = 50):
+        # Find the largest linesize whose input has less than limit tokens, the same as trying linesize from max_linesize down to 1, 0 if no linesize fits
+        # Each context line is tokenized once to estimate the token numbers with prefix sums, the estimation is then corrected with full tokenizations
+        # since the token number of the input never decreases when a line is added
+        pre_sums = [0]
+        for x in reversed(code["pre_code"][-max_linesize: ]):
+            pre_sums.append(pre_sums[-1] + self.backend.count_line_tokens(" " + x.strip()))
+        post_sums = [0]
+        for x in code["post_code"][:max_linesize]:
+            post_sums.append(post_sums[-1] + self.backend.count_line_tokens(" " + x.strip()))
+        base = self.count_tokens(fixed_input)
+        def estimate(linesize):
+            return base + pre_sums[min(linesize, len(pre_sums) - 1)] + post_sums[min(linesize, len(post_sums) - 1)]
+        low = 0
+        high = max_linesize
+        while low < high:
+            mid = (low + high + 1) // 2
+            if estimate(mid) < limit:
+                low = mid
+            else:
+                high = mid - 1
+        # Inputs do not change once all context lines are included
+        full = max(len(pre_sums), len(post_sums)) - 1
+        linesize = max(min(low, full), 1)
+        if self.count_tokens(build_input(linesize)) < limit:
+            while linesize < full and self.count_tokens(build_input(linesize + 1)) < limit:
+                linesize += 1
+            return max_linesize if linesize >= full else linesize
+        linesize -= 1
+        while linesize > 0 and self.count_tokens(build_input(linesize)) >= limit:
+            linesize -= 1
+        return linesize
+
     def build_prompt(self, code, buggy_code, max_mask_size, added = False, mask_all = False):
         inputs = {}
         if self.model_type == "codebert":
@@ -79,15 +135,12 @@ class Prompt(object):
                     line = line.replace("VALUE_MASK", self.mask_token * i)
                     masked_lines.append(line)
                 masked_input = " ".join([x.strip() for x in masked_lines]).strip()
-                linesize = 50
-                input_line = None
-                while linesize > 0:
+                def build_input(linesize):
                     pre_code_input = "</s> " + " ".join([x.strip() for x in code["pre_code"][-linesize: ]])
                     post_code_input = " ".join([x.strip() for x in code["post_code"][:linesize]]).strip()
-                    input_line = pre_code_input + " " + masked_input + " " + post_code_input
-                    if self.tokenizer(input_line, return_tensors='pt')['input_ids'].size()[1] < 490:
-                        break
-                    linesize -= 1
+                    return pre_code_input + " " + masked_input + " " + post_code_input
+                linesize = self.fit_linesize(build_input, code, "</s> " + masked_input, 490)
+                input_line = build_input(linesize) if linesize > 0 else None
                 if linesize <= 0:
                     return None
                 else:
@@ -129,16 +182,13 @@ class Prompt(object):
                 max_len = 128
                 min_len = 2
             masked_input = " ".join([x.strip() for x in masked_lines]).strip()
-            linesize = 50
-            input_line = None
             buggy_line = "\"\"\"" + " ".join([x.strip() for x in buggy_code]) + "\"\"\""
-            while linesize > 0:
+            def build_input(linesize):
                 pre_code_input = " ".join([x.strip() for x in code["pre_code"][-linesize: ]])
                 post_code_input = " ".join([x.strip() for x in code["post_code"][:linesize]]).strip()
-                input_line = " ".join([buggy_line, pre_code_input, masked_input, post_code_input])
-                if (not mask_all and self.tokenizer(input_line, return_tensors='pt')['input_ids'].size()[1] < 490) or (mask_all and self.tokenizer(input_line, return_tensors='pt')['input_ids'].size()[1] < 390):
-                    break
-                linesize -= 1
+                return " ".join([buggy_line, pre_code_input, masked_input, post_code_input])
+            linesize = self.fit_linesize(build_input, code, " ".join([buggy_line, masked_input]), 390 if mask_all else 490)
+            input_line = build_input(linesize) if linesize > 0 else None
             if linesize <= 0:
                 return None
             else:
@@ -167,83 +217,16 @@ class Prompt(object):
             if mask_index != len(predictions):
                 raise ValueError('Inconsistent mask index and prediction length: {} and {}'.format(mask_index, len(predictions)))
         elif self.model_type == "codet5":
-            pred_code = []
-            for pred in predictions:
-                #print(pred)
-                curpred = pred
-                pred_map = {}
-                failed = False
-                for i in range(0, patch_data["prompt"]["max_mask_id"]):
-                    if f"<extra_id_{i}>" not in curpred:
-                        failed = True
-                        break
-                    else:
-                        items = curpred.split(f"<extra_id_{i}>")
-                        if len(items) != 2:
-                            failed = True
-                            break
-                        prefix, curpred = items
-                        if i != 0:
-                            pred_map[i-1] = prefix
-                if failed:
-                    continue
-                if "<extra_id" not in curpred:
-                    pred_map[patch_data["prompt"]["max_mask_id"] - 1] = curpred
-                else:
-                    pred_map[patch_data["prompt"]["max_mask_id"] - 1] = curpred.split("<extra_id_{}>".format(patch_data["prompt"]["max_mask_id"]))[0]
-                if not mask_all:
-                    masked_code = "\n".join(patch_data["prompt"]["masked_lines"])
-                    for i in pred_map:
-                        masked_code = masked_code.replace(f"<extra_id_{i}>", pred_map[i])
-                    patch = "\n".join(patch_data["code"]["pre_code"]) + "\n" + masked_code + "\n" + "\n".join(patch_data["code"]["post_code"])
-                    try:
-                        ast.parse(patch)
-                        pred_code.append(masked_code)
-                    except Exception as e:
-                        #print(e)
-                        pass
-                else:
-                    masked_code = [""]
-                    for p in pred_map:
-                        new_masked_code = []
-                        for i in range(0, 4):
-                            if i > 0:
-                                for c in masked_code:
-                                    if len(c) != 0:
-                                        new_masked_code.append(c + "\n" + "    " * i + pred_map[p])
-                                    else:
-                                        new_masked_code.append(c + "    " * i + pred_map[p])
-                            else:
-                                for c in masked_code:
-                                    if len(c) != 0:
-                                        new_masked_code.append(c + "\n" + pred_map[p])
-                                    else:
-                                        new_masked_code.append(c + pred_map[p])
-                        masked_code = new_masked_code
-                        new_masked_code = [""]
-
-                    masked_code = list(set(masked_code))
-                    for c in masked_code:
-                        patch = "\n".join(patch_data["code"]["pre_code"]) + "\n" + c + "\n" + "\n".join(patch_data["code"]["post_code"])
-                        try:
-                            ast.parse(patch)
-                            pred_code.append(c)
-                        except Exception as e:
-                            #print(e)
-                            pass
-
-                #with open("patch.py", "w", encoding = "utf-8") as pf:
-                #    pf.write(patch)
-                #exit()
-            return pred_code
+            return validate_predictions(patch_data, predictions, mask_all = mask_all)
             
 
     def get_prediction(self, patch_data, mask_all = False):
         if self.model_type == "codebert":
+            from beam_search import BeamSearch
             for i in patch_data["prompt"]:
                 if i != 2:
                     continue
-                beam_engine = BeamSearch(self.model, self.tokenizer, patch_data["prompt"][i]["input"], DEVICE,
+                beam_engine = BeamSearch(self.model, self.tokenizer, patch_data["prompt"][i]["input"], default_device(),
                                         beam_width=25, re_rank=True)
                 beam_list, masked_index = beam_engine.generate_beam()
                 ret = []
@@ -251,49 +234,149 @@ class Prompt(object):
                     print("".join(beam[2]))
                     ret.append(("".join(beam[2]), beam[2], beam[0], prompt))
         elif self.model_type == 'codet5':
-            inputs = self.tokenizer(patch_data["prompt"]["input"], return_tensors = "pt").to(DEVICE)
-            input_ids = inputs["input_ids"]
-            attention_mask = inputs["attention_mask"]
-            patches = {}
-            for i in range(patch_data["prompt"]["min_len"], patch_data["prompt"]["max_len"]):
-                outputs = self.model.generate(input_ids, max_length = i, num_beams = 50, num_return_sequences = 50)
-                predictions = self.tokenizer.batch_decode(outputs)
-                sub_patches = self.validate_patch(patch_data, predictions, mask_all = mask_all)
-                for p in sub_patches:
-                    if p not in patches:
-                        patches[p] = 2
-            return patches
+            return self.get_batch_predictions([patch_data], mask_all = mask_all)[0]
         
             
         
         
             
+    def get_prediction_key(self, prompt):
+        return PredictionCache.get_key(self.backend.model_id, prompt["input"], {"num_beams": self.backend.num_beams, "min_len": prompt["min_len"], "max_len": prompt["max_len"]})
+
+    def iter_decoded(self, prompts):
+        # Yield (i, raw predictions of prompts[i]) as soon as they are available, identical prompts are decoded once and cached predictions are reused
+        keys = [self.get_prediction_key(prompt) for prompt in prompts]
+        predictions = {}
+        pending = []
+        waiting = {}
+        for i, k in enumerate(keys):
+            if k in predictions:
+                waiting[k].append(i)
+                continue
+            predictions[k] = self.prediction_cache.get(k)
+            waiting[k] = [i]
+            if predictions[k] == None:
+                pending.append(i)
+        if len(pending) < len(prompts):
+            logger.debug('Decoding {} of {} prompts, the others are duplicated or cached.'.format(len(pending), len(prompts)))
+        for k in waiting:
+            if predictions[k] != None:
+                for i in waiting[k]:
+                    yield i, predictions[k]
+        for i, p in self.backend.iter_decode([prompts[i] for i in pending]):
+            i = pending[i]
+            self.prediction_cache.put(keys[i], p)
+            for j in waiting[keys[i]]:
+                yield j, p
+
+    def decode_prompts(self, prompts):
+        # Raw predictions of each prompt in order
+        predictions = [None for prompt in prompts]
+        for i, p in self.iter_decoded(prompts):
+            predictions[i] = p
+        return predictions
+
+    def validate_predictions(self, patch_data, predictions, mask_all = False):
+        patches = {}
+        for p in self.validate_patch(patch_data, predictions, mask_all = mask_all):
+            if p not in patches:
+                patches[p] = 2
+        return patches
+
+    def get_validation_pool(self):
+        if self.validation_pool == None and self.validation_workers > 0:
+            # Workers only need patch_validator, spawn them instead of forking the process holding the model
+            self.validation_pool = ProcessPoolExecutor(max_workers = self.validation_workers, mp_context = multiprocessing.get_context('spawn'))
+        return self.validation_pool
+
+    def decode_adaptive(self, patch_data, mask_all = False):
+        # Decode a prompt with the adaptive policy, which needs the validation results of each step
+        # The steps depend on the code around the masks too, so it is part of the cache key
+        key = PredictionCache.get_key(self.backend.model_id, patch_data["prompt"]["input"], {"adaptive": self.adaptive.settings(), "min_len": patch_data["prompt"]["min_len"], "max_len": patch_data["prompt"]["max_len"],
+                                      "code": patch_data["code"], "masked_lines": patch_data["prompt"]["masked_lines"], "mask_all": mask_all})
+        result = self.prediction_cache.get(key)
+        if result != None:
+            patch_data["decoding"] = result["decoding"]
+            return self.validate_predictions(patch_data, result["predictions"], mask_all = mask_all)
+        # The policy validates the new predictions of every step in the order they are generated, keep its patches instead of validating all predictions again
+        patches = {}
+        def validate(new_predictions):
+            valid = validate_predictions(patch_data, new_predictions, mask_all = mask_all)
+            for p in valid:
+                if p not in patches:
+                    patches[p] = 2
+            return valid
+        predictions, decoding = self.adaptive.decode(self.backend, patch_data["prompt"], validate)
+        self.prediction_cache.put(key, {"predictions": predictions, "decoding": decoding})
+        patch_data["decoding"] = decoding
+        return patches
+
+    def get_batch_predictions(self, patch_data_list, mask_all = False):
+        # Decode the prompts of several patch files together, return the validated patches of each one in order
+        # With validation workers, predictions of a batch are validated while the next batch is decoded
+        if self.adaptive != None:
+            return [self.decode_adaptive(patch_data, mask_all = mask_all) for patch_data in patch_data_list]
+        results = [None for patch_data in patch_data_list]
+        pool = self.get_validation_pool()
+        for i, predictions in self.iter_decoded([patch_data["prompt"] for patch_data in patch_data_list]):
+            if pool != None:
+                results[i] = pool.submit(get_patches, patch_data_list[i], predictions, mask_all = mask_all)
+            else:
+                results[i] = self.validate_predictions(patch_data_list[i], predictions, mask_all = mask_all)
+        if pool != None:
+            results = [r.result() for r in results]
+        return results
+
+    def predict_all(self, patch_data_list, mask_all = False):
+        if self.model_type == "codet5":
+            for patch_data, patches in zip(patch_data_list, self.get_batch_predictions(patch_data_list, mask_all = mask_all)):
+                patch_data["patches"] = patches
+        else:
+            for patch_data in patch_data_list:
+                patch_data["patches"] = self.get_prediction(patch_data, mask_all = mask_all)
+
+    def read_patch_files(self, patch_path):
+        patch_sources = {}
+        for f in os.listdir(patch_path):
+            if f.endswith('.py'):
+                patch_sources[f] = open(os.path.join(patch_path, f)).read()
+        return patch_sources
+
+    def get_buggy_code(self, buggy_file, buggy_lines):
+        old_code = open(buggy_file, 'r').read().splitlines()
+        return old_code, [old_code[int(i)-1] for i in buggy_lines]
+
+    def prepare_patch_data(self, patch_sources, buggy_code):
+        # Build the prompts of template generated patches, return the patch data and the entries that still need predictions
+        patch_data = {"buggy_code": buggy_code}
+        pending = []
+        for f in patch_sources:
+            #if f != "102_from_23371.py":
+            #    continue
+            patch_data[f] = {}
+            patch_source = patch_sources[f]
+            if 'VALUE_MASK' in patch_source:
+                patch_data[f]["code"] = self.process_file(patch_source)
+                patch_data[f]["prompt"] = self.build_prompt(patch_data[f]["code"], patch_data["buggy_code"], 10)
+                if patch_data[f]["prompt"] != None:
+                    pending.append(patch_data[f])
+                else:
+                    patch_data[f]["patches"] = {}
+            else:
+                patch_data[f]["patches"] = {patch_source: 1}
+        return patch_data, pending
+
     @timeout_decorator.timeout(7200)
     def run_one(self, patch_path, buggy_file, buggy_lines, added, mask_all = False):
-        old_code = open(buggy_file, 'r').read().splitlines()
-        buggy_code = [old_code[int(i)-1] for i in buggy_lines]
+        return self.process_one(patch_path, buggy_file, buggy_lines, added, mask_all = mask_all)
+
+    def process_one(self, patch_path, buggy_file, buggy_lines, added, mask_all = False):
+        # run_one without the signal based timeout, for callers that enforce deadlines themselves
+        old_code, buggy_code = self.get_buggy_code(buggy_file, buggy_lines)
         if not mask_all:
-            patch_files = []
-            for f in os.listdir(patch_path):
-                if f.endswith('.py'):
-                    patch_files.append(f)
-            patch_data = {"buggy_code": buggy_code}
-            num = 0
-            for f in patch_files:
-                #if f != "102_from_23371.py":
-                #    continue
-                patch_data[f] = {}
-                patch_source = open(os.path.join(patch_path, f)).read()
-                if 'VALUE_MASK' in patch_source:
-                    patch_data[f]["code"] = self.process_file(patch_source)
-                    patch_data[f]["prompt"] = self.build_prompt(patch_data[f]["code"], patch_data["buggy_code"], 10)
-                    if patch_data[f]["prompt"] != None:
-                        patch_data[f]["patches"] = self.get_prediction(patch_data[f])
-                    else:
-                        patch_data[f]["patches"] = {}
-                else:
-                    patch_data[f]["patches"] = {patch_source: 1}
-                num += len(patch_data[f]["patches"])
+            patch_data, pending = self.prepare_patch_data(self.read_patch_files(patch_path), buggy_code)
+            # Prompts of all patch files are decoded together
+            self.predict_all(pending)
         else:
             patch_data = {"buggy_code": buggy_code}
             patch_data["code"] = self.process_file(old_code, buggy_lines = buggy_lines, added = added)
@@ -315,11 +398,13 @@ class Prompt(object):
         
 
 
-    def run_all(self, metafile, patch_path, benchmark_path, final_patch_path, benchmark = 'bugsinpy', mask_all = False):
-        metadata = json.loads(open(metafile, 'r', encoding = 'utf-8').read())
+    @staticmethod
+    def collect_jobs(metadata, patch_path, benchmark_path, final_patch_path, benchmark = 'bugsinpy'):
+        # Return the buggy files that have no final patch file yet, and the failed cases of files that cannot be handled
+        jobs = []
+        failed_cases = []
         if benchmark == 'bugsinpy':
-            failed_cases = []
-            for r in tqdm(metadata, desc = 'Generate prompt for instances'):
+            for r in metadata:
                 for i in metadata[r]:
                     for f in metadata[r][i]["code_files"]:
                         if not f.endswith(".py"):
@@ -333,29 +418,26 @@ class Prompt(object):
                             if len(buggy_files) == 0:
                                 buggy_files.append(f)
                             for bf in buggy_files:
-                                logger.debug('Handling File#{} in Case#{}'.format(bf, f'{r}-{i}'))
                                 final_patch_file_path = os.path.join(final_patch_path, r, f'{r}-{i}', bf.replace('/', '_').replace('.py', '.json'))
                                 if os.path.exists(final_patch_file_path):
                                     continue
-                                path = os.path.join(patch_path, r, i, ('TypeErrorFix/benchmarks/bugsinpy/' + r + '/' + f'{r}-{i}' + '/' + bf).replace('/', '_'))
-                                buggy_file = os.path.join(benchmark_path, r, f'{r}-{i}', bf)
-                                try:
-                                    patch_data = self.run_one(path, buggy_file, metadata[r][i]["buglines"][bf], metadata[r][i]["added"][bf], mask_all = mask_all)
-                                    if not os.path.exists(os.path.join(final_patch_path, r, f'{r}-{i}')):
-                                        os.system('mkdir -p {}'.format(os.path.join(final_patch_path, r, f'{r}-{i}')))
-                                    with open(final_patch_file_path, 'w', encoding = 'utf-8') as pf:
-                                        pf.write(json.dumps(patch_data, sort_keys=True, indent=4, separators=(',', ': ')))
-                                except Exception as e:
-                                    traceback.print_exc()
-                                    logger.error(f'Error occurred: {e}')
-                                    failed_cases.append([f'{r}/{r}-{i}', f, bf, f"{e}"])
+                                jobs.append({
+                                    "benchmark": benchmark,
+                                    "instance": f'{r}/{r}-{i}',
+                                    "file": f,
+                                    "buggy_file_name": bf,
+                                    "patch_path": os.path.join(patch_path, r, i, ('TypeErrorFix/benchmarks/bugsinpy/' + r + '/' + f'{r}-{i}' + '/' + bf).replace('/', '_')),
+                                    "buggy_file": os.path.join(benchmark_path, r, f'{r}-{i}', bf),
+                                    "buglines": metadata[r][i]["buglines"][bf],
+                                    "added": metadata[r][i]["added"][bf],
+                                    "output": final_patch_file_path
+                                })
                         except Exception as e:
                             traceback.print_exc()
                             logger.error(f'Error occurred: {e}')
                             failed_cases.append([f'{r}/{r}-{i}', f, f"{e}"])
         elif benchmark == 'typebugs':
-            failed_cases = []
-            for r in tqdm(metadata, desc = 'Generate prompt for instances'):
+            for r in metadata:
                 if r in ["core/core-8065", "salt/salt-56381"]:
                     continue
                 #if r != "pandas/pandas-22378":
@@ -374,29 +456,53 @@ class Prompt(object):
                         for bf in buggy_files:
                             #if bf != "zappa/cli-1838.py":
                             #    continue
-                            logger.debug('Handling File#{} in Case#{}'.format(bf, r))
                             final_patch_file_path = os.path.join(final_patch_path, r, bf.replace('/', '_').replace('.py', '.json'))
                             if os.path.exists(final_patch_file_path):
                                 continue
-                            path = os.path.join(patch_path, r, ('TypeErrorFix/benchmarks/typebugs/' + r + '/' + bf).replace('/', '_'))
-                            buggy_file = os.path.join(benchmark_path, r, bf)
-                            try:
-                                patch_data = self.run_one(path, buggy_file, metadata[r]["buglines"][bf], metadata[r]["added"][bf], mask_all = mask_all)
-                                if not os.path.exists(os.path.join(final_patch_path, r)):
-                                    os.system('mkdir -p {}'.format(os.path.join(final_patch_path, r)))
-                                with open(final_patch_file_path, 'w', encoding = 'utf-8') as pf:
-                                    pf.write(json.dumps(patch_data, sort_keys=True, indent=4, separators=(',', ': ')))
-                            except Exception as e:
-                                traceback.print_exc()
-                                logger.error(f'Error occurred: {e}')
-                                failed_cases.append([r, f, bf, f"{e}"])
+                            jobs.append({
+                                "benchmark": benchmark,
+                                "instance": r,
+                                "file": f,
+                                "buggy_file_name": bf,
+                                "patch_path": os.path.join(patch_path, r, ('TypeErrorFix/benchmarks/typebugs/' + r + '/' + bf).replace('/', '_')),
+                                "buggy_file": os.path.join(benchmark_path, r, bf),
+                                "buglines": metadata[r]["buglines"][bf],
+                                "added": metadata[r]["added"][bf],
+                                "output": final_patch_file_path
+                            })
                     except Exception as e:
                         traceback.print_exc()
                         logger.error(f'Error occurred: {e}')
                         failed_cases.append([r, f, f"{e}"])
+        return jobs, failed_cases
+
+    @staticmethod
+    def write_result(job, patch_data, store = None):
+        if not os.path.exists(os.path.dirname(job["output"])):
+            os.system('mkdir -p {}'.format(os.path.dirname(job["output"])))
+        with open(job["output"], 'w', encoding = 'utf-8') as pf:
+            pf.write(json.dumps(patch_data, sort_keys=True, indent=4, separators=(',', ': ')))
+        if store != None:
+            store.add_prompts(job["benchmark"], job["instance"], job["file"], job["buggy_file_name"], patch_data, buglines = job["buglines"], added = job["added"])
+
+    def run_all(self, metafile, patch_path, benchmark_path, final_patch_path, benchmark = 'bugsinpy', mask_all = False):
+        metadata = json.loads(open(metafile, 'r', encoding = 'utf-8').read())
+        jobs, failed_cases = Prompt.collect_jobs(metadata, patch_path, benchmark_path, final_patch_path, benchmark = benchmark)
+        for job in tqdm(jobs, desc = 'Generate prompt for instances'):
+            logger.debug('Handling File#{} in Case#{}'.format(job["buggy_file_name"], job["instance"]))
+            try:
+                patch_data = self.run_one(job["patch_path"], job["buggy_file"], job["buglines"], job["added"], mask_all = mask_all)
+                self.write_result(job, patch_data, store = self.store)
+            except Exception as e:
+                traceback.print_exc()
+                logger.error(f'Error occurred: {e}')
+                failed_cases.append([job["instance"], job["file"], job["buggy_file_name"], f"{e}"])
         
+        logger.info('Reused predictions for {} prompts and decoded {} prompts.'.format(self.prediction_cache.hits, self.prediction_cache.misses))
         with open(os.path.join(final_patch_path, "failed_cases.json"), "w", encoding = "utf-8") as ff:
             ff.write(json.dumps(failed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
+        if self.store != None:
+            self.store.set_failures(benchmark, 'prompt', failed_cases)
         
 
 
@@ -0,0 +1,277 @@
+import os
+import ast
+import json
+import sqlite3
+from contextlib import contextmanager
+from __init__ import logger
+
+
+
+SCHEMA = [
+    # name - directory of the instance in the benchmark, e.g., ansible/ansible-1 for bugsinpy and salt/salt-38947 for typebugs
+    '''CREATE TABLE IF NOT EXISTS instances (
+        id INTEGER PRIMARY KEY,
+        benchmark TEXT NOT NULL,
+        name TEXT NOT NULL,
+        UNIQUE (benchmark, name)
+    )''',
+    # buggy_file - file name with the buglines, e.g., zappa/cli-1828.py, same as file if the buglines are not split
+    '''CREATE TABLE IF NOT EXISTS locations (
+        id INTEGER PRIMARY KEY,
+        instance_id INTEGER NOT NULL REFERENCES instances (id) ON DELETE CASCADE,
+        file TEXT NOT NULL,
+        buggy_file TEXT NOT NULL,
+        buglines TEXT,
+        added TEXT,
+        buggy_code TEXT,
+        UNIQUE (instance_id, buggy_file)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS template_applications (
+        id INTEGER PRIMARY KEY,
+        location_id INTEGER NOT NULL REFERENCES locations (id) ON DELETE CASCADE,
+        patch_index INTEGER NOT NULL,
+        template_id INTEGER NOT NULL,
+        action TEXT,
+        source TEXT NOT NULL,
+        UNIQUE (location_id, patch_index)
+    )''',
+    'CREATE INDEX IF NOT EXISTS template_applications_template ON template_applications (template_id)',
+    # name - patch file the prompt is built from, empty for the prompt of the whole buggy file in the mask_all mode
+    # data - the prompt entry of the final patch file without its patches
+    '''CREATE TABLE IF NOT EXISTS prompts (
+        id INTEGER PRIMARY KEY,
+        location_id INTEGER NOT NULL REFERENCES locations (id) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        data TEXT NOT NULL,
+        patches_type TEXT NOT NULL,
+        UNIQUE (location_id, name)
+    )''',
+    # Validated predictions of a prompt in their order in the final patch file
+    '''CREATE TABLE IF NOT EXISTS predictions (
+        id INTEGER PRIMARY KEY,
+        prompt_id INTEGER NOT NULL REFERENCES prompts (id) ON DELETE CASCADE,
+        rank INTEGER NOT NULL,
+        code TEXT NOT NULL,
+        value TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS predictions_prompt ON predictions (prompt_id, rank)',
+    # kind - coverage, exactmatch or plausibility, outcome - succeed or failed, data - the case as written in the case files
+    '''CREATE TABLE IF NOT EXISTS evaluations (
+        id INTEGER PRIMARY KEY,
+        instance_id INTEGER NOT NULL REFERENCES instances (id) ON DELETE CASCADE,
+        kind TEXT NOT NULL,
+        outcome TEXT NOT NULL,
+        data TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS evaluations_instance ON evaluations (instance_id, kind)',
+    'CREATE INDEX IF NOT EXISTS evaluations_kind ON evaluations (kind, outcome)',
+    # Buggy files a stage cannot handle, as written in failed_cases.json
+    '''CREATE TABLE IF NOT EXISTS failures (
+        id INTEGER PRIMARY KEY,
+        benchmark TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        data TEXT NOT NULL
+    )'''
+]
+
+
+# Case files of each evaluation kind, exported by export_evaluations
+EVALUATION_FILES = {
+    "coverage": {"succeed": "succeed_match_cases.json", "failed": "failed_match_cases.json"},
+    "exactmatch": {"succeed": "exactmatch_succeed_cases.json", "failed": "exactmatch_failed_cases.json"},
+    "plausibility": {"succeed": "plausible_cases.json"}
+}
+
+
+def dump_json(obj):
+    return json.dumps(obj, sort_keys=True, indent=4, separators=(',', ': '))
+
+
+class ResultsStore(object):
+    # One SQLite database keeping the outputs of all stages: patches of templates, prompts, validated predictions and evaluation outcomes.
+    # Every write of a stage is one transaction, and the exporters write the same files as the stages do without a store.
+    # Each process opens its own connection, so a store can be passed to forked or spawned workers.
+    def __init__(self, path = 'results.db', timeout = 60):
+        # timeout - seconds a write waits for the writes of other processes
+        self.path = path
+        self.timeout = timeout
+        self.conn = None
+        self.pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["conn"] = None
+        state["pid"] = None
+        return state
+
+    def connect(self):
+        if self.conn == None or self.pid != os.getpid():
+            if os.path.dirname(os.path.abspath(self.path)) and not os.path.exists(os.path.dirname(os.path.abspath(self.path))):
+                os.system('mkdir -p {}'.format(os.path.dirname(os.path.abspath(self.path))))
+            self.conn = sqlite3.connect(self.path, timeout = self.timeout, isolation_level = None)
+            self.pid = os.getpid()
+            self.conn.execute('PRAGMA journal_mode = WAL')
+            self.conn.execute('PRAGMA foreign_keys = ON')
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+        return self.conn
+
+    def close(self):
+        if self.conn != None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+        self.pid = None
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @staticmethod
+    def get_instance(conn, benchmark, name):
+        conn.execute('INSERT OR IGNORE INTO instances (benchmark, name) VALUES (?, ?)', (benchmark, name))
+        return conn.execute('SELECT id FROM instances WHERE benchmark = ? AND name = ?', (benchmark, name)).fetchone()[0]
+
+    @staticmethod
+    def get_location(conn, benchmark, name, file, buggy_file, buglines = None, added = None):
+        instance_id = ResultsStore.get_instance(conn, benchmark, name)
+        conn.execute('INSERT OR IGNORE INTO locations (instance_id, file, buggy_file) VALUES (?, ?, ?)', (instance_id, file, buggy_file))
+        location_id = conn.execute('SELECT id FROM locations WHERE instance_id = ? AND buggy_file = ?', (instance_id, buggy_file)).fetchone()[0]
+        if buglines != None:
+            conn.execute('UPDATE locations SET buglines = ?, added = ? WHERE id = ?', (json.dumps(buglines), json.dumps(added), location_id))
+        return location_id
+
+    def add_patches(self, benchmark, name, file, buggy_file, patches, buglines = None, added = None):
+        # Patches generated by PatchGenerator for a buggy file, replacing the ones stored before, sources are the ones dump_patches writes
+        with self.transaction() as conn:
+            location_id = ResultsStore.get_location(conn, benchmark, name, file, buggy_file, buglines = buglines, added = added)
+            conn.execute('DELETE FROM template_applications WHERE location_id = ?', (location_id, ))
+            conn.executemany('INSERT INTO template_applications (location_id, patch_index, template_id, action, source) VALUES (?, ?, ?, ?, ?)',
+                             [(location_id, i, patches[p][1], patches[p][2], ast.unparse(patches[p][0])) for i, p in enumerate(patches)])
+
+    def add_prompts(self, benchmark, name, file, buggy_file, patch_data, buglines = None, added = None):
+        # Final patch file of a buggy file written by Prompt, replacing the prompts stored before
+        with self.transaction() as conn:
+            location_id = ResultsStore.get_location(conn, benchmark, name, file, buggy_file, buglines = buglines, added = added)
+            conn.execute('UPDATE locations SET buggy_code = ? WHERE id = ?', (json.dumps(patch_data.get("buggy_code")), location_id))
+            conn.execute('DELETE FROM prompts WHERE location_id = ?', (location_id, ))
+            if "prompt" in patch_data:
+                entries = {"": patch_data}
+            else:
+                entries = {p: patch_data[p] for p in patch_data if p != "buggy_code"}
+            for p in entries:
+                data = {k: entries[p][k] for k in entries[p] if k != "patches" and not (p == "" and k == "buggy_code")}
+                patches = entries[p].get("patches")
+                patches_type = "none" if patches == None else ("dict" if isinstance(patches, dict) else "list")
+                prompt_id = conn.execute('INSERT INTO prompts (location_id, name, data, patches_type) VALUES (?, ?, ?, ?)', (location_id, p, json.dumps(data), patches_type)).lastrowid
+                if patches != None:
+                    conn.executemany('INSERT INTO predictions (prompt_id, rank, code, value) VALUES (?, ?, ?, ?)',
+                                     [(prompt_id, i, c, json.dumps(patches[c]) if isinstance(patches, dict) else None) for i, c in enumerate(patches)])
+
+    def set_evaluations(self, benchmark, kind, cases):
+        # Outcomes of one evaluation of a benchmark as [instance name, outcome, case], replacing the previous outcomes of that kind
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM evaluations WHERE kind = ? AND instance_id IN (SELECT id FROM instances WHERE benchmark = ?)', (kind, benchmark))
+            for name, outcome, case in cases:
+                conn.execute('INSERT INTO evaluations (instance_id, kind, outcome, data) VALUES (?, ?, ?, ?)', (ResultsStore.get_instance(conn, benchmark, name), kind, outcome, json.dumps(case)))
+
+    def set_failures(self, benchmark, stage, failed_cases):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM failures WHERE benchmark = ? AND stage = ?', (benchmark, stage))
+            conn.executemany('INSERT INTO failures (benchmark, stage, data) VALUES (?, ?, ?)', [(benchmark, stage, json.dumps(c)) for c in failed_cases])
+
+    def get_patches(self, benchmark, name = None, template_id = None):
+        # Yield (instance name, buggy file, patch index, template id, action, source)
+        query = '''SELECT i.name, l.buggy_file, t.patch_index, t.template_id, t.action, t.source FROM template_applications t
+                   JOIN locations l ON t.location_id = l.id JOIN instances i ON l.instance_id = i.id WHERE i.benchmark = ?'''
+        args = [benchmark]
+        if name != None:
+            query += ' AND i.name = ?'
+            args.append(name)
+        if template_id != None:
+            query += ' AND t.template_id = ?'
+            args.append(template_id)
+        for row in self.connect().execute(query + ' ORDER BY i.name, l.buggy_file, t.patch_index', args):
+            yield row
+
+    def get_patch_data(self, location_id):
+        # Final patch file of a location as Prompt writes it, None if no prompt is stored
+        conn = self.connect()
+        buggy_code = conn.execute('SELECT buggy_code FROM locations WHERE id = ?', (location_id, )).fetchone()[0]
+        prompts = conn.execute('SELECT id, name, data, patches_type FROM prompts WHERE location_id = ? ORDER BY id', (location_id, )).fetchall()
+        if buggy_code == None and len(prompts) == 0:
+            return None
+        patch_data = {"buggy_code": json.loads(buggy_code) if buggy_code != None else None}
+        for prompt_id, p, data, patches_type in prompts:
+            entry = json.loads(data)
+            if patches_type != "none":
+                rows = conn.execute('SELECT code, value FROM predictions WHERE prompt_id = ? ORDER BY rank', (prompt_id, )).fetchall()
+                entry["patches"] = {c: json.loads(v) for c, v in rows} if patches_type == "dict" else [c for c, v in rows]
+            if p == "":
+                patch_data.update(entry)
+            else:
+                patch_data[p] = entry
+        return patch_data
+
+    def get_evaluations(self, benchmark, kind, outcome = None):
+        query = 'SELECT e.data FROM evaluations e JOIN instances i ON e.instance_id = i.id WHERE i.benchmark = ? AND e.kind = ?'
+        args = [benchmark, kind]
+        if outcome != None:
+            query += ' AND e.outcome = ?'
+            args.append(outcome)
+        return [json.loads(row[0]) for row in self.connect().execute(query + ' ORDER BY e.id', args)]
+
+    def export_patches(self, benchmark, patch_path, prefix = None):
+        # Patch files in the layout Prompt reads, i.e., patch_path/{repo}/{id}/{prefix + buggy file}/Patch_{i}_from_{tid}.py for bugsinpy
+        # prefix - path of the benchmark the patches were generated in, as it was when they were dumped
+        if prefix == None:
+            prefix = 'TypeErrorFix/benchmarks/{}/'.format(benchmark)
+        num = 0
+        for name, buggy_file, i, template_id, action, source in self.get_patches(benchmark):
+            if benchmark == 'bugsinpy':
+                r, instance = name.split('/')
+                path = os.path.join(patch_path, r, instance[len(r) + 1:], (prefix + name + '/' + buggy_file).replace('/', '_'))
+            else:
+                path = os.path.join(patch_path, name, (prefix + name + '/' + buggy_file).replace('/', '_'))
+            if not os.path.exists(path):
+                os.system('mkdir -p {}'.format(path))
+            with open(os.path.join(path, 'Patch_{}_from_{}.py'.format(i, template_id)), 'w', encoding = 'utf-8') as pf:
+                pf.write(source)
+            num += 1
+        logger.info('Exported {} patches of {} to {}.'.format(num, benchmark, patch_path))
+
+    def export_prompts(self, benchmark, final_patch_path):
+        # Final patch files and failed_cases.json as Prompt.run_all writes them
+        conn = self.connect()
+        num = 0
+        for location_id, name, buggy_file in conn.execute('SELECT l.id, i.name, l.buggy_file FROM locations l JOIN instances i ON l.instance_id = i.id WHERE i.benchmark = ? ORDER BY l.id', (benchmark, )).fetchall():
+            patch_data = self.get_patch_data(location_id)
+            if patch_data == None:
+                continue
+            path = os.path.join(final_patch_path, name, buggy_file.replace('/', '_').replace('.py', '.json'))
+            if not os.path.exists(os.path.dirname(path)):
+                os.system('mkdir -p {}'.format(os.path.dirname(path)))
+            with open(path, 'w', encoding = 'utf-8') as pf:
+                pf.write(dump_json(patch_data))
+            num += 1
+        # Sharded runs keep the failures of each shard under stage prompt_{i}_of_{n}
+        failed_cases = [json.loads(row[0]) for row in conn.execute("SELECT data FROM failures WHERE benchmark = ? AND (stage = 'prompt' OR stage LIKE 'prompt\\_%' ESCAPE '\\') ORDER BY stage, id", (benchmark, ))]
+        if not os.path.exists(final_patch_path):
+            os.system('mkdir -p {}'.format(final_patch_path))
+        with open(os.path.join(final_patch_path, 'failed_cases.json'), 'w', encoding = 'utf-8') as ff:
+            ff.write(dump_json(failed_cases))
+        logger.info('Exported {} final patch files of {} to {}.'.format(num, benchmark, final_patch_path))
+
+    def export_evaluations(self, benchmark, kind, path):
+        # Case files of an evaluation, e.g., exactmatch_succeed_cases.json and exactmatch_failed_cases.json for exactmatch
+        if not os.path.exists(path):
+            os.system('mkdir -p {}'.format(path))
+        for outcome in EVALUATION_FILES[kind]:
+            with open(os.path.join(path, EVALUATION_FILES[kind][outcome]), 'w', encoding = 'utf-8') as ef:
+                ef.write(dump_json(self.get_evaluations(benchmark, kind, outcome = outcome)))
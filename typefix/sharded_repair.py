@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import hashlib
+import traceback
+import torch
+import torch.multiprocessing as mp
+from multiprocessing.connection import wait
+from tqdm import tqdm
+from repair import Prompt
+from __init__ import logger
+
+
+
+def _run_worker(prompt, conn, mask_all, num_threads):
+    # Worker process, runs the jobs sent by ShardedRunner one by one with the shared model
+    if num_threads != None:
+        torch.set_num_threads(num_threads)
+    while True:
+        job = conn.recv()
+        if job == None:
+            break
+        start = time.time()
+        result = {"id": job["output"], "status": "succeed", "reason": None}
+        try:
+            patch_data = prompt.process_one(job["patch_path"], job["buggy_file"], job["buglines"], job["added"], mask_all = mask_all)
+            Prompt.write_result(job, patch_data, store = prompt.store)
+        except Exception as e:
+            traceback.print_exc()
+            result["status"] = "failed"
+            result["reason"] = f"{e}"
+        result["time"] = time.time() - start
+        conn.send(result)
+    conn.close()
+
+
+def get_shard(key, shard_count):
+    # Shard of a job or failed case, stable across runs whatever jobs are already finished
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % shard_count
+
+
+class ShardedRunner(object):
+    # Runs Prompt jobs on several worker processes sharing the weights of one model.
+    # Deadlines are enforced by the parent, which kills and replaces workers that exceed them, and every job status is kept in a manifest
+    # so that an interrupted run resumes where it stopped and failed or timed out jobs can be retried selectively.
+    def __init__(self, prompt, workers = 2, timeout = 7200, num_threads = None):
+        # num_threads - torch threads of each worker, e.g., the number of cores divided by workers
+        self.prompt = prompt
+        self.workers = workers
+        self.timeout = timeout
+        self.num_threads = num_threads
+        self.ctx = mp.get_context('spawn')
+        self.manifest_file = None
+        self.manifest = {}
+        self.prompt.backend.share_memory()
+
+    def load_manifest(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.manifest = {}
+        if os.path.exists(manifest_file):
+            try:
+                self.manifest = json.loads(open(manifest_file, 'r', encoding = 'utf-8').read())
+            except Exception as e:
+                logger.error('Cannot load manifest {}, reason: {}, start from scratch.'.format(manifest_file, e))
+
+    def save_manifest(self):
+        if not os.path.exists(os.path.dirname(self.manifest_file)):
+            os.system('mkdir -p {}'.format(os.path.dirname(self.manifest_file)))
+        with open(self.manifest_file + '.tmp', 'w', encoding = 'utf-8') as mf:
+            mf.write(json.dumps(self.manifest, sort_keys=True, indent=4, separators=(',', ': ')))
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+
+    def update(self, job, status, reason = None, duration = None, save = True):
+        entry = self.manifest.setdefault(job["output"], {"instance": job["instance"], "file": job["file"], "buggy_file": job["buggy_file_name"], "attempts": 0})
+        entry["status"] = status
+        entry["reason"] = reason
+        if status == "running":
+            entry["attempts"] += 1
+        if duration != None:
+            entry["time"] = duration
+        if save:
+            self.save_manifest()
+
+    def start_worker(self, mask_all):
+        parent_conn, child_conn = self.ctx.Pipe()
+        process = self.ctx.Process(target = _run_worker, args = (self.prompt, child_conn, mask_all, self.num_threads))
+        process.start()
+        child_conn.close()
+        return {"process": process, "conn": parent_conn, "job": None, "start": None}
+
+    def stop_worker(self, worker, kill = False):
+        if kill:
+            worker["process"].terminate()
+        else:
+            try:
+                worker["conn"].send(None)
+            except Exception:
+                worker["process"].terminate()
+        worker["process"].join()
+        worker["conn"].close()
+
+    def select_jobs(self, jobs, retry = []):
+        # Jobs never finished are always run, failed and timed out ones only if their status is in retry
+        selected = []
+        for job in jobs:
+            status = self.manifest.get(job["output"], {}).get("status")
+            if status in [None, "pending", "running"] or status in retry:
+                selected.append(job)
+        return selected
+
+    def run(self, jobs, mask_all = False):
+        todo = list(jobs)
+        for job in todo:
+            self.update(job, "pending", save = False)
+        self.save_manifest()
+        workers = [self.start_worker(mask_all) for i in range(0, min(self.workers, len(todo)))]
+        progress = tqdm(total = len(todo), desc = 'Generate prompt for instances')
+        while True:
+            for w in workers:
+                if w["job"] == None and len(todo) > 0:
+                    w["job"] = todo.pop(0)
+                    w["start"] = time.time()
+                    self.update(w["job"], "running")
+                    w["conn"].send(w["job"])
+            busy = [w for w in workers if w["job"] != None]
+            if len(busy) == 0:
+                break
+            ready = wait([w["conn"] for w in busy], timeout = 1)
+            for i, w in enumerate(workers):
+                if w["job"] == None:
+                    continue
+                if w["conn"] in ready:
+                    try:
+                        result = w["conn"].recv()
+                        self.update(w["job"], result["status"], reason = result["reason"], duration = result["time"])
+                        w["job"] = None
+                    except EOFError:
+                        logger.error('Worker exited when handling File#{} in Case#{}.'.format(w["job"]["buggy_file_name"], w["job"]["instance"]))
+                        self.update(w["job"], "failed", reason = "Worker exited.", duration = time.time() - w["start"])
+                        self.stop_worker(w, kill = True)
+                        workers[i] = self.start_worker(mask_all)
+                    progress.update(1)
+                elif time.time() - w["start"] > self.timeout:
+                    logger.error('Timeout when handling File#{} in Case#{}, restart the worker.'.format(w["job"]["buggy_file_name"], w["job"]["instance"]))
+                    self.update(w["job"], "timeout", reason = "Timeout after {} seconds.".format(self.timeout), duration = time.time() - w["start"])
+                    self.stop_worker(w, kill = True)
+                    workers[i] = self.start_worker(mask_all)
+                    progress.update(1)
+        for w in workers:
+            self.stop_worker(w)
+        progress.close()
+
+    def run_all(self, metafile, patch_path, benchmark_path, final_patch_path, benchmark = 'bugsinpy', mask_all = False, retry = [], shard_index = 0, shard_count = 1):
+        # retry - statuses of jobs run again, e.g., ["failed", "timeout"]
+        # shard_index, shard_count - only run the jobs whose output file hashes to shard_index, to split a benchmark across machines
+        metadata = json.loads(open(metafile, 'r', encoding = 'utf-8').read())
+        jobs, failed_cases = Prompt.collect_jobs(metadata, patch_path, benchmark_path, final_patch_path, benchmark = benchmark)
+        jobs = [job for job in jobs if get_shard(job["output"], shard_count) == shard_index]
+        failed_cases = [c for c in failed_cases if get_shard('{}/{}'.format(c[0], c[1]), shard_count) == shard_index]
+        if shard_count > 1:
+            self.load_manifest(os.path.join(final_patch_path, 'manifest_{}_of_{}.json'.format(shard_index, shard_count)))
+        else:
+            self.load_manifest(os.path.join(final_patch_path, 'manifest.json'))
+        jobs = self.select_jobs(jobs, retry = retry)
+        logger.info('Running {} jobs on {} workers.'.format(len(jobs), self.workers))
+        self.run(jobs, mask_all = mask_all)
+
+        for k in self.manifest:
+            if self.manifest[k]["status"] in ["failed", "timeout"]:
+                failed_cases.append([self.manifest[k]["instance"], self.manifest[k]["file"], self.manifest[k]["buggy_file"], self.manifest[k]["reason"]])
+        with open(os.path.join(final_patch_path, "failed_cases.json" if shard_count == 1 else "failed_cases_{}_of_{}.json".format(shard_index, shard_count)), "w", encoding = "utf-8") as ff:
+            ff.write(json.dumps(failed_cases, sort_keys=True, indent=4, separators=(',', ': ')))
+        if self.prompt.store != None:
+            self.prompt.store.set_failures(benchmark, 'prompt' if shard_count == 1 else 'prompt_{}_of_{}'.format(shard_index, shard_count), failed_cases)
+        return self.manifest
+
+
+
+if __name__ == "__main__":
+    runner = ShardedRunner(Prompt(), workers = 4, num_threads = max(1, (os.cpu_count() or 4) // 4))
+    runner.run_all("benchmarks/all_bug_info_typebugs.json", "patches/typebugs", "benchmarks/typebugs", "prompt_patches/typebugs", benchmark = "typebugs")
+    runner.run_all("benchmarks/all_bug_info_bugsinpy.json", "patches/bugsinpy", "benchmarks/bugsinpy", "prompt_patches/bugsinpy", benchmark = "bugsinpy")
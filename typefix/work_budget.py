@@ -0,0 +1,75 @@
+import time
+
+
+
+# Budget charged by the matcher and generator loops of the current process, None means unlimited
+active_budget = None
+
+
+class BudgetExhausted(Exception):
+    def __init__(self, budget, reason):
+        super().__init__('Budget exhausted: {}'.format(reason))
+        self.budget = budget
+        self.reason = reason
+
+
+class Budget(object):
+    def __init__(self, time_limit = None, node_visits = None, match_states = None, parent = None):
+        # time_limit - seconds allowed
+        # node_visits - template nodes matched and AST nodes generated
+        # match_states - partial matches and generated combinations explored
+        # parent - budget that is charged together with this one, e.g., the per-file budget of a per-template budget
+        self.limits = {"time": time_limit, "node_visits": node_visits, "match_states": match_states}
+        self.parent = parent
+        self.start = time.time()
+        self.used = {"node_visits": 0, "match_states": 0}
+        self.exhausted = None
+
+    @staticmethod
+    def from_config(config, parent = None):
+        if config == None:
+            return None
+        return Budget(time_limit = config.get("time"), node_visits = config.get("node_visits"), match_states = config.get("match_states"), parent = parent)
+
+    def charge(self, counter, num = 1):
+        self.used[counter] += num
+        if self.limits[counter] != None and self.used[counter] > self.limits[counter]:
+            self.exhausted = counter
+            raise BudgetExhausted(self, counter)
+        if self.limits["time"] != None and time.time() - self.start > self.limits["time"]:
+            self.exhausted = "time"
+            raise BudgetExhausted(self, "time")
+        if self.parent != None:
+            self.parent.charge(counter, num = num)
+
+    def check(self):
+        if self.exhausted != None:
+            raise BudgetExhausted(self, self.exhausted)
+        if self.limits["time"] != None and time.time() - self.start > self.limits["time"]:
+            self.exhausted = "time"
+            raise BudgetExhausted(self, "time")
+        if self.parent != None:
+            self.parent.check()
+
+    def usage(self):
+        return {
+            "time": time.time() - self.start,
+            "node_visits": self.used["node_visits"],
+            "match_states": self.used["match_states"],
+            "exhausted": self.exhausted
+        }
+
+
+def activate(budget):
+    global active_budget
+    active_budget = budget
+
+
+def charge(counter, num = 1):
+    if active_budget != None:
+        active_budget.charge(counter, num = num)
+
+
+def check():
+    if active_budget != None:
+        active_budget.check()